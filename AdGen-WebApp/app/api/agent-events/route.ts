@@ -46,6 +46,45 @@ setInterval(() => {
   }
 }, 5 * 60 * 1000); // Check every 5 minutes
 
+// Validate, store and broadcast one agent event; returns false when required fields are missing
+function ingestEvent(raw: any): boolean {
+  const { runId, agent, status, message, step, timestamp } = raw || {};
+
+  if (!runId || !agent || !status) {
+    return false;
+  }
+
+  console.log(`[agent-events] Received event: ${runId} ${agent} ${status} ${message || ''}`);
+
+  // Store event in cache
+  const eventTimestamp = timestamp || Date.now();
+  const event = {
+    id: `${runId}-${eventTimestamp}-${Math.random().toString(36).slice(2,7)}`,
+    agent,
+    status,
+    message: message || '',
+    step: step ?? null,
+    timestamp: eventTimestamp,
+    receivedAt: Date.now(),
+  };
+
+  if (!eventsCache.has(runId)) {
+    eventsCache.set(runId, []);
+  }
+
+  const events = eventsCache.get(runId)!;
+  events.push(event);
+
+  // Keep only last 500 events per run (memory replay)
+  if (events.length > 500) {
+    events.shift();
+  }
+
+  // Broadcast live to SSE subscribers (best-effort)
+  publish(runId, event);
+  return true;
+}
+
 // POST endpoint for receiving webhook events from agents
 export async function POST(req: NextRequest) {
   try {
@@ -57,42 +96,19 @@ export async function POST(req: NextRequest) {
     }
 
     const body = await req.json();
-    const { runId, agent, status, message, step, timestamp } = body;
-
-    if (!runId || !agent || !status) {
-      return Response.json({ error: 'Missing required fields' }, { status: 400 });
-    }
+    // Agents send batches ({ events: [...] }); a bare event is still accepted
+    const incoming: any[] = Array.isArray(body?.events) ? body.events : [body];
 
-    console.log(`[agent-events] Received event: ${runId} ${agent} ${status} ${message || ''}`);
-
-    // Store event in cache
-    const eventTimestamp = timestamp || Date.now();
-    const event = {
-      id: `${runId}-${eventTimestamp}-${Math.random().toString(36).slice(2,7)}`,
-      agent,
-      status,
-      message: message || '',
-      step: step ?? null,
-      timestamp: eventTimestamp,
-      receivedAt: Date.now(),
-    };
-
-    if (!eventsCache.has(runId)) {
-      eventsCache.set(runId, []);
+    let accepted = 0;
+    for (const evt of incoming) {
+      if (ingestEvent(evt)) accepted++;
     }
 
-    const events = eventsCache.get(runId)!;
-    events.push(event);
-
-    // Keep only last 500 events per run (memory replay)
-    if (events.length > 500) {
-      events.shift();
+    if (accepted === 0) {
+      return Response.json({ error: 'Missing required fields' }, { status: 400 });
     }
 
-    // Broadcast live to SSE subscribers (best-effort)
-    publish(runId, event);
-
-    return Response.json({ ok: true });
+    return Response.json({ ok: true, accepted, rejected: incoming.length - accepted });
 
   } catch (error) {
     console.error('[agent-events] Webhook error:', error);
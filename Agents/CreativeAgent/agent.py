@@ -1,22 +1,28 @@
 from google.adk.agents.llm_agent import Agent
 
 
-from google import genai
-from google.cloud import storage
-from google.oauth2 import service_account
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from uuid import uuid4
 from datetime import datetime
 import io
 from typing import List, Dict, Any
 from MasterAgent.firestore_helper import get_firestore_client
+from clients import get_genai_client
+from gcs_uploader import gs_uri, upload_bytes, upload_many
 from webhook import report_progress
+from rate_limiter import after_model_rate_limit, before_model_rate_limit, call_with_rate_limit
+from run_context import current_run_id, submit_in_context
+from genai_models import gemini_model
+from CreativeAgent.image_cache import fingerprint_lock, image_cache_enabled, lookup_image, prompt_fingerprint, store_image
+from CreativeAgent.renditions import create_renditions, rendition_object_name
 import uuid as _uuid
 
 
 def _run_id() -> str:
-    return os.getenv("AGENTS_CURRENT_RUN_ID") or f"local-{_uuid.uuid4().hex[:6]}"
+    return current_run_id() or f"local-{_uuid.uuid4().hex[:6]}"
 
 def _progress(status: str, message: str, *, step: str | None = None, meta: dict | None = None) -> None:
     try:
@@ -37,50 +43,15 @@ def save_content_to_gcs(content: bytes, object_name: str, *, content_type: str =
     - bucket is resolved from env var GCS_EC_BUCKET_NAME (or GCS_CONTENT_BUCKET for backward compatibility)
       and defaults to 'ecommerce-ad-contents'
     - object_name supports folder paths, e.g. 'segmentation_location/image_0.jpg'
-    Returns a public HTTPS URL (tries public access first, then signed URL, then fallback HTTPS URL).
+    Returns the object's URL from bucket configuration (see gcs_uploader.py); identical
+    content already stored under the same name is not uploaded again.
     """
+    return _upload_content(content, object_name, content_type=content_type, bucket_name=bucket_name)["url"]
+
+
+def _upload_content(content: bytes, object_name: str, *, content_type: str = "application/octet-stream", bucket_name: str | None = None) -> dict:
+    """save_content_to_gcs'in gövdesi; upload_bytes sonucunu (url, bucket, object_name, ...) döner."""
     print(f"🧩 [GCS] save_content_to_gcs called: object_name='{object_name}', content_type='{content_type}'")
-    bucket = (
-        bucket_name
-        or os.getenv("GCS_EC_BUCKET_NAME")
-        or os.getenv("GCS_CONTENT_BUCKET")
-        or "ecommerce-ad-contents"
-    )
-    print(f"🪣 [GCS] target bucket resolved: {bucket}")
-    
-    # Try environment-based service account JSON first (Cloud Run compatible)
-    sa_json = os.getenv('GCP_SERVICE_ACCOUNT_JSON') or os.getenv('GCP_SERVICE_ACCOUNT_JSON_BQ')
-    if sa_json:
-        try:
-            import json
-            import base64
-            info = json.loads(sa_json) if sa_json.strip().startswith('{') else json.loads(base64.b64decode(sa_json).decode('utf-8'))
-            credentials = service_account.Credentials.from_service_account_info(
-                info,
-                scopes=[
-                    'https://www.googleapis.com/auth/cloud-platform',
-                    'https://www.googleapis.com/auth/devstorage.read_write',
-                ],
-            )
-            client = storage.Client(credentials=credentials)
-            print("🔐 [GCS] using credentials from GCP_SERVICE_ACCOUNT_JSON(_BQ)")
-        except Exception:
-            # Fall back to default ADC
-            client = storage.Client()
-            print("⚠️  [GCS] failed parsing service account JSON, using default ADC")
-    else:
-        # Fallback to file-based credentials or default ADC
-        creds_path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS_AI")
-        if creds_path and os.path.exists(creds_path):
-            credentials = service_account.Credentials.from_service_account_file(creds_path)
-            client = storage.Client(credentials=credentials)
-            print(f"🔐 [GCS] using GOOGLE_APPLICATION_CREDENTIALS_AI file: {creds_path}")
-        else:
-            # Use default ADC (Application Default Credentials)
-            client = storage.Client()
-            print("ℹ️  [GCS] using default ADC")
-    
-    bucket_obj = client.bucket(bucket)
     # Ensure a subfolder path is used and uniqueness if plain name provided
     # Normalize leading slash if present
     if object_name.startswith("/"):
@@ -89,29 +60,9 @@ def save_content_to_gcs(content: bytes, object_name: str, *, content_type: str =
         # place inside folder with the given name for neat organization
         base = object_name.replace(".jpg", "")
         object_name = f"{base}/{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}-{uuid4().hex}.jpg"
-    print(f"📄 [GCS] final object path: {object_name}")
-    blob = bucket_obj.blob(object_name)
-    blob.upload_from_string(content, content_type=content_type)
-    print("✅ [GCS] upload completed")
-    # Try to make the object publicly accessible and return its public URL.
-    try:
-        blob.make_public()
-        print(f"🔗 [GCS] object made public: {blob.public_url}")
-        return blob.public_url
-    except Exception as e:
-        print(f"⚠️  [GCS] failed to make public: {e}")
-        # Fallback: signed URL (7 days). If this fails, return public HTTPS URL.
-        try:
-            url = blob.generate_signed_url(expiration=3600 * 24 * 7, method="GET")
-            print(f"🔐 [GCS] returning signed URL: {url}")
-            return url
-        except Exception as e2:
-            # Final fallback: convert gs:// to public HTTPS URL
-            # gs://bucket/path -> https://storage.googleapis.com/bucket/path
-            https_url = f"https://storage.googleapis.com/{bucket}/{object_name}"
-            print(f"⚠️  [GCS] failed to generate signed URL: {e2}")
-            print(f"🌐 [GCS] returning public HTTPS URL (fallback): {https_url}")
-            return https_url
+    uploaded = upload_bytes(content, object_name, content_type=content_type, bucket_name=bucket_name)
+    print(f"✅ [GCS] {'unchanged, skipped' if uploaded['skipped'] else 'upload completed'}: gs://{uploaded['bucket']}/{uploaded['object_name']} ({uploaded['bytes']} bytes, {uploaded['seconds']}s)")
+    return uploaded
 
 
 def read_segmentations_to_generate(limit: int = 50):
@@ -154,6 +105,9 @@ def read_segmentations_to_generate(limit: int = 50):
     return items
 
 
+IMAGEN_MODEL = "publishers/google/models/imagen-4.0-generate-001"
+
+
 def create_marketing_image(
     prompt: str,
     number_of_images: int = 1,
@@ -175,7 +129,40 @@ def create_marketing_image(
         output_dir: Directory to save images into.
 
     Returns:
-        A list of saved image file paths.
+        A list of saved image file paths. When the same normalised prompt was already
+        rendered for this segmentation_name/city/country, the stored URIs are returned
+        without calling Imagen (see image_cache.py).
+    """
+    return _create_marketing_image(
+        prompt,
+        number_of_images=number_of_images,
+        aspect_ratio=aspect_ratio,
+        output_dir=output_dir,
+        name=name,
+        object_name=object_name,
+        segmentation_name=segmentation_name,
+        city=city,
+        country=country,
+    )["uris"]
+
+
+def _create_marketing_image(
+    prompt: str,
+    *,
+    number_of_images: int = 1,
+    aspect_ratio: str = "16:9",
+    output_dir: str = "generated",
+    name: str = "segmentation_location",
+    object_name: str = "",
+    segmentation_name: str = "",
+    city: str = "",
+    country: str = "",
+) -> dict:
+    """
+    create_marketing_image'in gövdesi; URL'lerle birlikte rendition map'lerini de döner.
+
+    Returns:
+        {"uris": [...], "renditions": [...], "cached": bool}
     """
     _progress("progress", "Starting create_marketing_image", step="create_marketing_image", meta={"aspect_ratio": aspect_ratio, "number_of_images": number_of_images, "name": name, "segmentation_name": segmentation_name, "city": city, "country": country})
     print(f"🎨 [Creative] create_marketing_image called: aspect_ratio={aspect_ratio}, num_images={number_of_images}, name={name}")
@@ -200,6 +187,54 @@ def create_marketing_image(
         if not computed_prefix:
             computed_prefix = norm_folder(name)
         print(f"🧮 [Creative] computed folder prefix from segmentation: {computed_prefix}")
+    if not image_cache_enabled():
+        rendered = _render_marketing_image(prompt, number_of_images, aspect_ratio, output_dir, name, object_name, computed_prefix)
+        saved_paths = rendered["uris"]
+        _progress("success", "Finished create_marketing_image", step="create_marketing_image", meta={"saved": len(saved_paths), "first_uri": (saved_paths[0] if saved_paths else None)})
+        return {"uris": rendered["uris"], "renditions": rendered["renditions"], "cached": False}
+
+    # Aynı (normalize) prompt + segment/şehir için daha önce üretilen görsel varsa Imagen çağrılmaz
+    fingerprint = prompt_fingerprint(
+        prompt,
+        segmentation_name=segmentation_name,
+        city=city,
+        country=country,
+        aspect_ratio=aspect_ratio,
+        number_of_images=number_of_images,
+        model=IMAGEN_MODEL,
+    )
+    with fingerprint_lock(fingerprint):
+        cached = lookup_image(fingerprint)
+        if cached:
+            print(f"♻️  [Creative] image cache hit {fingerprint[:12]} → {cached['uris'][:1]}")
+            _progress("success", "Finished create_marketing_image (cached)", step="create_marketing_image", meta={"saved": 0, "cached": True, "first_uri": cached["uris"][0]})
+            return {**cached, "cached": True}
+        rendered = _render_marketing_image(prompt, number_of_images, aspect_ratio, output_dir, name, object_name, computed_prefix)
+        saved_paths = rendered["uris"]
+        store_image(
+            fingerprint,
+            rendered["objects"],
+            rendition_objects=rendered["rendition_objects"],
+            prompt=prompt,
+            segmentation_name=segmentation_name,
+            city=city,
+            country=country,
+            aspect_ratio=aspect_ratio,
+            model=IMAGEN_MODEL,
+        )
+
+    _progress("success", "Finished create_marketing_image", step="create_marketing_image", meta={"saved": len(saved_paths), "cached": False, "first_uri": (saved_paths[0] if saved_paths else None)})
+    return {"uris": rendered["uris"], "renditions": rendered["renditions"], "cached": False}
+
+
+def _render_marketing_image(prompt: str, number_of_images: int, aspect_ratio: str, output_dir: str, name: str, object_name: str, computed_prefix: str) -> dict:
+    """
+    Imagen ile görselleri üretir, GCS'e kaydeder ve responsive varyantlarını oluşturur.
+
+    Returns:
+        {"uris": [...], "renditions": [{format: {width: url}}, ...], "objects": [gs://...],
+         "rendition_objects": [{format: {width: gs://...}}, ...]} (hepsi uris ile aynı sırada)
+    """
     # Use Vertex AI (project/location) to avoid 404s on the Imagen predict route
     project_id = (
         os.environ.get("GOOGLE_CLOUD_PROJECT")
@@ -218,14 +253,14 @@ def create_marketing_image(
             "Set your GCP project for Vertex AI image generation."
         )
     print(f"🧭 [Creative] Vertex config: project={project_id}, location={location}")
-    client = genai.Client(
-        vertexai=True,
-        project=project_id,
-        location=location,
-    )
-
-    result = client.models.generate_images(
-        model="publishers/google/models/imagen-4.0-generate-001",
+    # Imagen her zaman Vertex AI üzerinden; run API-key modunda olsa bile
+    client = get_genai_client(project_id, location, vertexai=True)
+
+    # Imagen kotası LLM'den ayrı limiter'da; 429'da hız düşer ve çağrı yeniden denenir
+    result = call_with_rate_limit(
+        IMAGEN_MODEL,
+        client.models.generate_images,
+        model=IMAGEN_MODEL,
         prompt=prompt,
         config=dict(
             number_of_images=number_of_images,
@@ -241,12 +276,14 @@ def create_marketing_image(
 
     if not getattr(result, "generated_images", None):
         print("⚠️  [Creative] no generated_images in result")
-        return []
+        return {"uris": [], "renditions": [], "objects": [], "rendition_objects": []}
 
     out_dir = Path(output_dir)
     out_dir.mkdir(parents=True, exist_ok=True)
 
     saved_paths = []
+    saved_objects = []
+    saved_images = []
     for n, generated_image in enumerate(result.generated_images):
         # Get image bytes directly from the response
         content_bytes = generated_image.image.image_bytes
@@ -258,22 +295,33 @@ def create_marketing_image(
         else:
             target_object = f"{name}/image_{n+1}.jpg"
         print(f"📝 [Creative] saving image {n+1}/{len(result.generated_images)} to '{target_object}'")
-        gcs_uri = save_content_to_gcs(content_bytes, target_object, content_type="image/jpeg")
-        saved_paths.append(gcs_uri)
+        uploaded = _upload_content(content_bytes, target_object, content_type="image/jpeg")
+        saved_paths.append(uploaded["url"])
+        saved_objects.append((uploaded["bucket"], uploaded["object_name"]))
+        saved_images.append((content_bytes, uploaded["object_name"]))
     print(f"✅ [Creative] saved {len(saved_paths)} images → {saved_paths[:2]}{'...' if len(saved_paths)>2 else ''}")
 
-    _progress("success", "Finished create_marketing_image", step="create_marketing_image", meta={"saved": len(saved_paths), "first_uri": (saved_paths[0] if saved_paths else None)})
-    return saved_paths
+    # Küçük genişlikler + WebP/JPEG varyantları (encode process pool'da, upload paralel)
+    renditions = create_renditions(saved_images, upload_many)
+    print(f"🖼️  [Creative] renditions: {[sorted(r.get('webp', {})) for r in renditions]}")
+    # Önbellek süresi dolabilecek URL'leri değil gs:// yollarını saklar (varyantlar aynı bucket'a yüklenir)
+    rendition_objects = [
+        {fmt: {width: gs_uri(bucket, rendition_object_name(object_name, int(width), fmt)) for width in by_width} for fmt, by_width in rendition.items()}
+        for (bucket, object_name), rendition in zip(saved_objects, renditions)
+    ]
+    return {
+        "uris": saved_paths,
+        "renditions": renditions,
+        "objects": [gs_uri(bucket, object_name) for bucket, object_name in saved_objects],
+        "rendition_objects": rendition_objects,
+    }
 
 
 
-def create_marketing_images_batch(items: List[Dict[str, Any]]):
+def _generate_batch_item(item: Dict[str, Any]) -> Dict[str, Any]:
     """
-    Batch helper to generate multiple marketing images.
-    Args:
-        items: List of {"prompt": str, "name": str, optional overrides...}
-    Returns:
-        List of {"name": str, "uris": ["gs://..."] }
+    create_marketing_images_batch'in tek öğesi: görseli üretir, GCS'e kaydeder ve
+    doc_id varsa Firestore'a yazar. Hatalar öğe sonucuna yazılır, batch'i durdurmaz.
     """
     def norm_folder(s: str) -> str:
         return (
@@ -285,34 +333,30 @@ def create_marketing_images_batch(items: List[Dict[str, Any]]):
             .replace(" ", "_")
         )
 
-    _progress("progress", "Starting create_marketing_images_batch", step="create_marketing_images_batch", meta={"items": len(items or [])})
-    print(f"🧺 [Creative] create_marketing_images_batch: items={len(items or [])}")
-    results = []
-    for item in items or []:
-        prompt = item.get("prompt", "").strip()
-        name = item.get("name", "segmentation_location")
-        segmentation_name = item.get("segmentation_name", "") or item.get("segmentation_result", "")
-        city = item.get("city", "")
-        country = item.get("country", "")
-        # Build nested folder path:
-        # - Split segmentation_name by '-' and use each as a folder
-        # - Then append a single folder "City_Country" (city first), normalized
-        seg_parts = [p.strip() for p in str(segmentation_name).split("-") if p.strip()]
-        city_country = ""
-        if city or country:
-            city_country = norm_folder(f"{city}_{country}".strip("_"))
-        nested_parts = seg_parts + ([city_country] if city_country else [])
-        base_prefix = "/".join([p for p in nested_parts if p])
-        # Final object path under the deepest folder
-        object_name = f"{base_prefix}/{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}-{uuid4().hex}.jpg"
-        print(f"🧷 [Creative] item name={name}, seg='{segmentation_name}', city='{city}', country='{country}'")
-        print(f"🧩 [Creative] prompt(len={len(prompt)}): {prompt[:120]}{'...' if len(prompt)>120 else ''}")
-        print(f"📁 [Creative] computed object path: {object_name}")
-        if not prompt:
-            results.append({"name": name, "uris": [], "error": "empty prompt"})
-            continue
-        uris = create_marketing_image(
-            prompt=prompt,
+    prompt = item.get("prompt", "").strip()
+    name = item.get("name", "segmentation_location")
+    segmentation_name = item.get("segmentation_name", "") or item.get("segmentation_result", "")
+    city = item.get("city", "")
+    country = item.get("country", "")
+    # Build nested folder path:
+    # - Split segmentation_name by '-' and use each as a folder
+    # - Then append a single folder "City_Country" (city first), normalized
+    seg_parts = [p.strip() for p in str(segmentation_name).split("-") if p.strip()]
+    city_country = ""
+    if city or country:
+        city_country = norm_folder(f"{city}_{country}".strip("_"))
+    nested_parts = seg_parts + ([city_country] if city_country else [])
+    base_prefix = "/".join([p for p in nested_parts if p])
+    # Final object path under the deepest folder
+    object_name = f"{base_prefix}/{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}-{uuid4().hex}.jpg"
+    print(f"🧷 [Creative] item name={name}, seg='{segmentation_name}', city='{city}', country='{country}'")
+    print(f"🧩 [Creative] prompt(len={len(prompt)}): {prompt[:120]}{'...' if len(prompt)>120 else ''}")
+    print(f"📁 [Creative] computed object path: {object_name}")
+    if not prompt:
+        return {"name": name, "uris": [], "error": "empty prompt"}
+    try:
+        generated = _create_marketing_image(
+            prompt,
             number_of_images=item.get("number_of_images", 1),
             aspect_ratio=item.get("aspect_ratio", "16:9"),
             output_dir=item.get("output_dir", "generated"),
@@ -322,28 +366,92 @@ def create_marketing_images_batch(items: List[Dict[str, Any]]):
             city=city,
             country=country,
         )
-        # Assign back to Firestore if doc_id provided
-        try:
-            doc_id = item.get("doc_id")
-            if doc_id and uris:
-                db = get_firestore_client()
-                seg_doc = db.collection("segmentations").document(str(doc_id))
-                payload = {
-                    "imageUrl": uris[0],
-                    "updated_at": datetime.utcnow().isoformat(timespec="seconds") + "Z",
-                }
-                for k in ("segmentation_name", "city", "country"):
-                    if item.get(k):
-                        payload[k] = item[k]
-                seg_doc.set(payload, merge=True)
-                print(f"📝 [Creative] firestore updated for doc_id={doc_id} with imageUrl={uris[0]}")
-        except Exception as e:
-            results.append({"name": name, "uris": uris, "warning": f"firestore_update_failed: {e}"})
-            print(f"⚠️  [Creative] firestore update failed for doc {item.get('doc_id')}: {e}")
-            continue
-        results.append({"name": name, "uris": uris})
-    print(f"🏁 [Creative] batch generation done, {len(results)} items processed")
-    _progress("success", "Finished create_marketing_images_batch", step="create_marketing_images_batch", meta={"processed": len(results)})
+    except Exception as e:
+        print(f"❌ [Creative] generation failed for {name}: {e}")
+        return {"name": name, "uris": [], "error": f"generation_failed: {e}"}
+    uris = generated["uris"]
+    renditions = generated["renditions"][0] if generated.get("renditions") else {}
+    # Assign back to Firestore if doc_id provided
+    try:
+        doc_id = item.get("doc_id")
+        if doc_id and uris:
+            db = get_firestore_client()
+            seg_doc = db.collection("segmentations").document(str(doc_id))
+            payload = {
+                "imageUrl": uris[0],
+                "updated_at": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+            }
+            if renditions:
+                payload["renditions"] = renditions
+            for k in ("segmentation_name", "city", "country"):
+                if item.get(k):
+                    payload[k] = item[k]
+            seg_doc.set(payload, merge=True)
+            print(f"📝 [Creative] firestore updated for doc_id={doc_id} with imageUrl={uris[0]}")
+    except Exception as e:
+        print(f"⚠️  [Creative] firestore update failed for doc {item.get('doc_id')}: {e}")
+        return {"name": name, "uris": uris, "renditions": renditions, "warning": f"firestore_update_failed: {e}"}
+    return {"name": name, "uris": uris, "renditions": renditions}
+
+
+def create_marketing_images_batch(items: List[Dict[str, Any]]):
+    """
+    Batch helper to generate multiple marketing images.
+
+    Items run concurrently on CREATIVE_BATCH_WORKERS threads (default 4); Imagen
+    calls still go through the shared rate limiter, so throughput tops out at
+    the Imagen quota. Each finished item is reported via _progress as soon as
+    it completes, and a failing item only marks its own result.
+
+    Args:
+        items: List of {"prompt": str, "name": str, optional overrides...}
+    Returns:
+        List of {"name": str, "uris": ["gs://..."] } in input order
+        (failed items carry "error", Firestore write failures "warning")
+    """
+    items = list(items or [])
+    workers = max(1, min(int(os.getenv("CREATIVE_BATCH_WORKERS", "4")), len(items) or 1))
+    _progress("progress", "Starting create_marketing_images_batch", step="create_marketing_images_batch", meta={"items": len(items), "workers": workers})
+    print(f"🧺 [Creative] create_marketing_images_batch: items={len(items)}, workers={workers}")
+
+    started = time.monotonic()
+    results: List[Dict[str, Any]] = [None] * len(items)
+    images = 0
+    failed = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="creative-batch") as pool:
+        futures = {submit_in_context(pool, _generate_batch_item, item): index for index, item in enumerate(items)}
+        for done, future in enumerate(as_completed(futures), start=1):
+            index = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {"name": items[index].get("name", "segmentation_location"), "uris": [], "error": str(e)}
+            results[index] = result
+            images += len(result.get("uris") or [])
+            failed += 1 if result.get("error") else 0
+            elapsed = time.monotonic() - started
+            images_per_min = round(images / elapsed * 60, 2) if elapsed > 0 else 0.0
+            _progress("progress", f"Item {done}/{len(items)} finished", step="create_marketing_images_batch", meta={
+                "index": index,
+                "name": result.get("name"),
+                "uris": result.get("uris"),
+                "error": result.get("error"),
+                "warning": result.get("warning"),
+                "completed": done,
+                "images_per_min": images_per_min,
+            })
+
+    elapsed = time.monotonic() - started
+    images_per_min = round(images / elapsed * 60, 2) if elapsed > 0 else 0.0
+    print(f"🏁 [Creative] batch generation done, {len(results)} items processed, {images} images in {elapsed:.1f}s ({images_per_min} images/min, failed={failed})")
+    _progress("success", "Finished create_marketing_images_batch", step="create_marketing_images_batch", meta={
+        "processed": len(results),
+        "images": images,
+        "failed": failed,
+        "workers": workers,
+        "elapsed_seconds": round(elapsed, 2),
+        "images_per_min": images_per_min,
+    })
     return results
 
 
@@ -391,8 +499,9 @@ INSTRUCTIONS:
 === YOUR WORKFLOW ===
 > WHEN MASTER AGENT TELLS YOU TO CREATE CONTENT FOR THE GIVEN SEGMENT TO WEBSITE:
 1. Use read_segmentations_to_generate to list segmentations missing imageUrl from the 'segmentations' collection.
-2. For each item, craft a detailed prompt and call create_marketing_image (16:9, 1K).
-3. Provide doc_id when calling create_marketing_images_batch so the generated image URL is written back to 'segmentations/<doc_id>.imageUrl'.
+2. For each item, craft a detailed prompt (16:9, 1K).
+3. Call create_marketing_images_batch ONCE with all items (they are generated concurrently) instead of calling create_marketing_image per item.
+   Provide doc_id for each item so the generated image URL is written back to 'segmentations/<doc_id>.imageUrl'.
 
 === FINAL RETURN (STRICT) ===
 After you finish your content creation tasks (and, if asked, updating location segmentation pairs),
@@ -402,7 +511,7 @@ return ONLY the minimal JSON object below, with no extra prose:
 
 
 creative_agent = Agent(
-    model='gemini-2.5-pro', 
+    model=gemini_model('gemini-2.5-pro'),
     name='creative_agent',
     description=CREATIVE_AGENT_DESCRIPTION,
     instruction=CREATIVE_AGENT_INSTRUCTION,
@@ -412,4 +521,6 @@ creative_agent = Agent(
     create_marketing_images_batch,
     create_marketing_video
     ],
+    before_model_callback=before_model_rate_limit,
+    after_model_callback=after_model_rate_limit,
 )
\ No newline at end of file
@@ -0,0 +1,162 @@
+"""
+Prompt-fingerprint → GCS object index for generated marketing images.
+
+Before Imagen is called, the normalised prompt and its targeting fields
+(segmentation_name, city, country, aspect ratio, image count, model) are
+hashed and looked up in the Firestore collection 'image_cache'. A hit returns
+the images rendered earlier, so re-runs after a `segmentations` reset cost no
+Imagen calls. Entries keep gs://bucket/object paths and URLs are derived on
+each hit (gcs_uploader.url_for_gs_uri), so a signed URL stored weeks ago is
+never handed out. Identical requests running concurrently in one process wait
+for the first one instead of generating twice.
+
+IMAGE_CACHE=off disables the index.
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional
+
+from gcs_uploader import url_for_gs_uri
+
+
+IMAGE_CACHE_COLLECTION = "image_cache"
+
+_stats_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "stored": 0, "errors": 0}
+_inflight_lock = threading.Lock()
+# fingerprint -> [lock, bekleyen/çalışan istek sayısı]
+_inflight: Dict[str, list] = {}
+
+
+def image_cache_enabled() -> bool:
+    return os.getenv("IMAGE_CACHE", "on").strip().lower() not in ("off", "0", "false")
+
+
+def _normalize(text) -> str:
+    return re.sub(r"\s+", " ", str(text or "")).strip().lower()
+
+
+def prompt_fingerprint(prompt: str, *, segmentation_name: str = "", city: str = "", country: str = "",
+                       aspect_ratio: str = "", number_of_images: int = 1, model: str = "") -> str:
+    """Whitespace/case-normalised prompt + targeting fields → SHA-256 hex."""
+    key = {
+        "prompt": _normalize(prompt),
+        "segmentation_name": _normalize(segmentation_name),
+        "city": _normalize(city),
+        "country": _normalize(country),
+        "aspect_ratio": str(aspect_ratio or ""),
+        "number_of_images": int(number_of_images or 1),
+        "model": str(model or ""),
+    }
+    canonical = json.dumps(key, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _bump(counter: str, amount: int = 1) -> None:
+    with _stats_lock:
+        _stats[counter] += amount
+
+
+def _collection():
+    from MasterAgent.firestore_helper import get_firestore_client
+    return get_firestore_client().collection(IMAGE_CACHE_COLLECTION)
+
+
+def lookup_image(fingerprint: str) -> Optional[dict]:
+    """
+    Cached {"uris": [...], "renditions": [...]} for the fingerprint, or None.
+    URLs are built from the stored gs:// paths at hit time. Every call counts as a hit or a miss.
+    """
+    try:
+        snap = _collection().document(fingerprint).get()
+    except Exception as e:
+        _bump("errors")
+        _bump("misses")
+        print(f"⚠️  [image_cache] lookup failed: {e}")
+        return None
+    data = (snap.to_dict() or {}) if snap.exists else {}
+    # Eski kayıtlar yalnızca URL tutuyordu (süresi dolmuş olabilir); miss sayılır ve yeniden yazılır
+    objects = data.get("objects")
+    if not objects:
+        _bump("misses")
+        return None
+    try:
+        uris = [url_for_gs_uri(uri) for uri in objects]
+        renditions = [
+            {fmt: {width: url_for_gs_uri(uri) for width, uri in by_width.items()} for fmt, by_width in (rendition or {}).items()}
+            for rendition in (data.get("rendition_objects") or [])
+        ]
+    except Exception as e:
+        _bump("errors")
+        _bump("misses")
+        print(f"⚠️  [image_cache] could not build URLs: {e}")
+        return None
+    _bump("hits")
+    try:
+        from google.cloud import firestore
+        snap.reference.update({"hits": firestore.Increment(1), "last_hit_at": datetime.now(timezone.utc)})
+    except Exception:
+        pass
+    return {"uris": uris, "renditions": renditions}
+
+
+def store_image(fingerprint: str, objects: List[str], rendition_objects: Optional[List[dict]] = None, **fields) -> None:
+    """
+    Record generated images under the fingerprint as gs:// paths (objects) and
+    {format: {width: gs://...}} maps (rendition_objects); fields: prompt, segmentation_name, city, ...
+    """
+    if not objects:
+        return
+    doc = {
+        "objects": list(objects),
+        "rendition_objects": list(rendition_objects or []),
+        "created_at": datetime.now(timezone.utc),
+        "hits": 0,
+        **{k: v for k, v in fields.items() if v not in (None, "")},
+    }
+    if "prompt" in doc:
+        doc["prompt"] = str(doc["prompt"])[:1500]
+    try:
+        _collection().document(fingerprint).set(doc)
+        _bump("stored")
+    except Exception as e:
+        _bump("errors")
+        print(f"⚠️  [image_cache] store failed: {e}")
+
+
+@contextmanager
+def fingerprint_lock(fingerprint: str) -> Iterator[None]:
+    """
+    Per-fingerprint lock so concurrent identical requests render only once.
+    The entry is dropped when the last holder/waiter leaves.
+    """
+    with _inflight_lock:
+        entry = _inflight.get(fingerprint)
+        if entry is None:
+            entry = _inflight[fingerprint] = [threading.Lock(), 0]
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _inflight_lock:
+            entry[1] -= 1
+            if entry[1] == 0 and _inflight.get(fingerprint) is entry:
+                del _inflight[fingerprint]
+
+
+def image_cache_stats() -> dict:
+    with _stats_lock:
+        lookups = _stats["hits"] + _stats["misses"]
+        return {
+            "enabled": image_cache_enabled(),
+            **_stats,
+            "inflight": len(_inflight),
+            "hit_rate": round(_stats["hits"] / lookups, 4) if lookups else 0.0,
+        }
@@ -0,0 +1,158 @@
+"""
+Responsive renditions for generated marketing images.
+
+After Imagen returns a 1K JPEG, each image is resized to a few widths and
+encoded as WebP plus a JPEG fallback (AVIF as well when requested and the
+installed Pillow supports it). Resizing and encoding are CPU-bound, so they
+run in a process pool; the resulting objects are uploaded in parallel next to
+the original and described by a ``renditions`` map:
+
+    {"webp": {"320": url, "640": url, "1024": url}, "jpeg": {...}}
+
+Configuration (environment):
+  IMAGE_RENDITIONS          "off" disables the stage
+  IMAGE_RENDITION_WIDTHS    comma-separated widths (default 320,640,1024)
+  IMAGE_RENDITION_FORMATS   comma-separated formats (default webp,jpeg; avif optional)
+  IMAGE_RENDITION_QUALITY   encoder quality (default 80)
+  IMAGE_RENDITION_WORKERS   process pool size (default min(4, CPU count))
+
+Pillow is optional; without it the stage is skipped and only the original is kept.
+"""
+
+import io
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+CONTENT_TYPES = {"webp": "image/webp", "jpeg": "image/jpeg", "avif": "image/avif"}
+EXTENSIONS = {"webp": "webp", "jpeg": "jpg", "avif": "avif"}
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def renditions_enabled() -> bool:
+    return os.getenv("IMAGE_RENDITIONS", "on").strip().lower() not in ("off", "0", "false")
+
+
+def rendition_widths() -> List[int]:
+    raw = os.getenv("IMAGE_RENDITION_WIDTHS", "320,640,1024")
+    return sorted({int(w) for w in raw.split(",") if w.strip().isdigit() and int(w) > 0})
+
+
+def rendition_formats() -> List[str]:
+    raw = os.getenv("IMAGE_RENDITION_FORMATS", "webp,jpeg")
+    return [f for f in (s.strip().lower() for s in raw.split(",")) if f in CONTENT_TYPES]
+
+
+def encode_renditions(image_bytes: bytes, widths: List[int], formats: List[str], quality: int = 80) -> List[Tuple[int, str, bytes]]:
+    """
+    Resize and encode one image (runs in a worker process).
+
+    Widths larger than the source are skipped (no upscaling). Formats the
+    installed Pillow cannot write are skipped.
+
+    Returns:
+        [(width, format, encoded_bytes), ...]
+    """
+    from PIL import Image, features
+
+    source = Image.open(io.BytesIO(image_bytes))
+    source.load()
+    if source.mode not in ("RGB", "L"):
+        source = source.convert("RGB")
+
+    supported = [f for f in formats if f != "avif" or features.check("avif")]
+    out = []
+    for width in widths:
+        if width > source.width:
+            continue
+        height = max(1, round(source.height * width / source.width))
+        resized = source.resize((width, height), Image.LANCZOS) if width != source.width else source
+        for fmt in supported:
+            buffer = io.BytesIO()
+            if fmt == "jpeg":
+                resized.save(buffer, format="JPEG", quality=quality, optimize=True, progressive=True)
+            elif fmt == "webp":
+                resized.save(buffer, format="WEBP", quality=quality, method=4)
+            else:
+                resized.save(buffer, format="AVIF", quality=quality)
+            out.append((width, fmt, buffer.getvalue()))
+    return out
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            workers = int(os.getenv("IMAGE_RENDITION_WORKERS", str(min(4, os.cpu_count() or 1))))
+            # spawn: the agent process holds gRPC channels and threads that must not be forked
+            _pool = ProcessPoolExecutor(max_workers=max(1, workers), mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def _reset_pool() -> None:
+    global _pool, _pool_lock
+    _pool = None
+    _pool_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_pool)
+
+
+def rendition_object_name(object_name: str, width: int, fmt: str) -> str:
+    """'a/b/img.jpg' → 'a/b/img_w640.webp'."""
+    base = object_name.rsplit(".", 1)[0] if "." in object_name.rsplit("/", 1)[-1] else object_name
+    return f"{base}_w{width}.{EXTENSIONS[fmt]}"
+
+
+def create_renditions(images: List[Tuple[bytes, str]], upload_many: Callable[[List[dict]], List[dict]]) -> List[Dict[str, Dict[str, str]]]:
+    """
+    Build and upload renditions for a list of (image_bytes, object_name) pairs.
+
+    Args:
+        images: original bytes and the object path the original was saved under
+        upload_many: gcs_uploader.upload_many (items → results with "url" or "error", in order)
+
+    Returns:
+        One renditions map per image ({format: {width: url}}); empty maps when the stage is
+        disabled, Pillow is missing or encoding fails.
+    """
+    if not images or not renditions_enabled():
+        return [{} for _ in images]
+    widths, formats = rendition_widths(), rendition_formats()
+    quality = int(os.getenv("IMAGE_RENDITION_QUALITY", "80"))
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        print("⚠️  [renditions] Pillow is not installed, skipping renditions")
+        return [{} for _ in images]
+
+    pool = _get_pool()
+    encode_futures = [pool.submit(encode_renditions, content, widths, formats, quality) for content, _ in images]
+
+    # Tüm görsellerin varyantları tek upload_many çağrısında paralel yüklenir
+    uploads, owners = [], []
+    for index, ((_, object_name), future) in enumerate(zip(images, encode_futures)):
+        try:
+            encoded = future.result()
+        except Exception as e:
+            print(f"⚠️  [renditions] encoding failed for {object_name}: {e}")
+            continue
+        for width, fmt, data in encoded:
+            uploads.append({
+                "content": data,
+                "object_name": rendition_object_name(object_name, width, fmt),
+                "content_type": CONTENT_TYPES[fmt],
+            })
+            owners.append((index, width, fmt))
+
+    results: List[Dict[str, Dict[str, str]]] = [{} for _ in images]
+    for (index, width, fmt), uploaded in zip(owners, upload_many(uploads)):
+        if uploaded.get("url"):
+            results[index].setdefault(fmt, {})[str(width)] = uploaded["url"]
+    return results
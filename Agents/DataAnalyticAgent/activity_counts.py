@@ -0,0 +1,479 @@
+"""
+Incremental per-user activity counts.
+
+Instead of re-aggregating all of `user_events` / `user_orders` every run, the
+incremental mode keeps a persisted counts table plus a watermark (the max
+`event_time` / `order_date` already folded into it). Each run aggregates only
+rows newer than the watermark into its own delta table. Only after the delta's
+users were enqueued (compare_event_counts) is the delta merged into the counts
+table, the watermark advanced and the delta dropped, so a run that stops in
+between leaves the watermark where it was and the next run picks the rows up
+again. A delta computed from a watermark that another run has advanced since
+is not merged (its rows stay after the new watermark and are picked up later).
+
+Tables (dataset = BQ_DATASET, default 'adgen_bq'):
+  user_activity_counts     user_id, event_count, order_count, max_event_time, max_order_date, created_at
+  user_activity_delta_<run>  same shape plus the base watermark, only users touched since
+                           the watermark (expires after a day if never committed)
+  user_activity_watermark  id, events_watermark, orders_watermark, last_full_recompute, updated_at
+
+With ACTIVITY_SNAPSHOT_BACKEND=bigquery the previous snapshot is also kept in
+BigQuery (user_activity_snapshot) and the new-or-increased diff runs as a single
+SQL join, so only changed user_ids leave BigQuery. The counts the diff ran on
+are staged in a run-scoped table (user_activity_snapshot_staging_<run>, expires
+after a day). Once the diff's users are enqueued the staging table is labelled
+diff_committed=true, and only a labelled staging table replaces the snapshot.
+The marker lives in BigQuery, so the swap works from any instance or job
+worker; a run that fails in between leaves the previous snapshot intact and
+its staging table expires.
+
+Rows that arrive late (event_time older than the watermark) are not picked up
+incrementally; the periodic full recompute (USER_ACTIVITY_FULL_RECOMPUTE_HOURS,
+default 24) rebuilds the counts table from scratch to repair that drift.
+"""
+
+import os
+import re
+from datetime import datetime, timedelta, timezone
+
+from .bq_helper import bq_iter_record_batches, bq_to_dataframe, get_bigquery_client, run_query
+
+
+STATE_ID = "user_activity"
+COUNTS_TABLE = "user_activity_counts"
+DELTA_TABLE = "user_activity_delta"
+WATERMARK_TABLE = "user_activity_watermark"
+SNAPSHOT_TABLE = "user_activity_snapshot"
+STAGING_TABLE_PREFIX = "user_activity_snapshot_staging_"
+COMMITTED_LABEL = "diff_committed"
+# Commit edilmeyen run tablolarının (delta/staging) yaşam süresi
+RUN_TABLE_EXPIRATION = "TIMESTAMP_ADD(CURRENT_TIMESTAMP(), INTERVAL 1 DAY)"
+
+_tables_ready = False
+
+
+def _dataset() -> str:
+    return os.getenv('BQ_DATASET', 'adgen_bq')
+
+
+def _project() -> str:
+    return os.getenv('GCP_PROJECT_ID', 'eighth-upgrade-475017-u5')
+
+
+def _run_suffix(run_key: str) -> str:
+    # BigQuery tablo adında sadece harf, rakam ve _ olabilir
+    return re.sub(r"[^A-Za-z0-9_]", "_", str(run_key))[:200]
+
+
+def delta_table_name(run_key: str) -> str:
+    return f"{DELTA_TABLE}_{_run_suffix(run_key)}"
+
+
+def _full_recompute_interval() -> timedelta:
+    return timedelta(hours=float(os.getenv('USER_ACTIVITY_FULL_RECOMPUTE_HOURS', '24')))
+
+
+def _table_reference(table: str) -> dict:
+    return {
+        "project": _project(),
+        "dataset": _dataset(),
+        "table": table,
+        "location": os.getenv('BQ_LOCATION') or None,
+    }
+
+
+def build_ensure_tables_sql() -> str:
+    ds = _dataset()
+    return f"""
+    CREATE TABLE IF NOT EXISTS `{ds}.{COUNTS_TABLE}` (
+        user_id STRING NOT NULL,
+        event_count INT64,
+        order_count INT64,
+        max_event_time DATETIME,
+        max_order_date DATETIME,
+        created_at TIMESTAMP
+    );
+    CREATE TABLE IF NOT EXISTS `{ds}.{WATERMARK_TABLE}` (
+        id STRING NOT NULL,
+        events_watermark DATETIME,
+        orders_watermark DATETIME,
+        last_full_recompute TIMESTAMP,
+        updated_at TIMESTAMP
+    );
+    """
+
+
+def _aggregate_sql(events_filter: str = "", orders_filter: str = "") -> str:
+    """Per-user counts (and the latest timestamps seen) for the given row filters."""
+    ds = _dataset()
+    return f"""
+    WITH events AS (
+        SELECT user_id, COUNT(*) AS event_count, MAX(event_time) AS max_event_time
+        FROM `{ds}.user_events`
+        WHERE user_id != 'anonymous' {events_filter}
+        GROUP BY user_id
+    ),
+    orders AS (
+        SELECT user_id, COUNT(*) AS order_count, MAX(order_date) AS max_order_date
+        FROM `{ds}.user_orders`
+        WHERE TRUE {orders_filter}
+        GROUP BY user_id
+    )
+    SELECT
+        COALESCE(events.user_id, orders.user_id) AS user_id,
+        COALESCE(events.event_count, 0) AS event_count,
+        COALESCE(orders.order_count, 0) AS order_count,
+        events.max_event_time,
+        orders.max_order_date,
+        CURRENT_TIMESTAMP() AS created_at
+    FROM events
+    FULL OUTER JOIN orders ON events.user_id = orders.user_id
+    """
+
+
+def _advance_watermark_sql(full: bool) -> str:
+    ds = _dataset()
+    last_full = "CURRENT_TIMESTAMP()" if full else "T.last_full_recompute"
+    last_full_insert = "CURRENT_TIMESTAMP()" if full else "NULL"
+    # Watermark = latest timestamp folded into the counts table, so it can never
+    # run ahead of what was actually aggregated.
+    return f"""
+    MERGE `{ds}.{WATERMARK_TABLE}` T
+    USING (
+        SELECT
+            '{STATE_ID}' AS id,
+            MAX(max_event_time) AS events_watermark,
+            MAX(max_order_date) AS orders_watermark
+        FROM `{ds}.{COUNTS_TABLE}`
+    ) S
+    ON T.id = S.id
+    WHEN MATCHED THEN UPDATE SET
+        events_watermark = S.events_watermark,
+        orders_watermark = S.orders_watermark,
+        last_full_recompute = {last_full},
+        updated_at = CURRENT_TIMESTAMP()
+    WHEN NOT MATCHED THEN INSERT (id, events_watermark, orders_watermark, last_full_recompute, updated_at)
+        VALUES (S.id, S.events_watermark, S.orders_watermark, {last_full_insert}, CURRENT_TIMESTAMP());
+    """
+
+
+def build_full_recompute_sql() -> str:
+    """Counts tablosunu tüm geçmişten yeniden kurar ve watermark'ı sıfırdan hesaplar."""
+    ds = _dataset()
+    return f"""
+    CREATE OR REPLACE TABLE `{ds}.{COUNTS_TABLE}` AS
+    {_aggregate_sql()};
+    {_advance_watermark_sql(full=True)}
+    """
+
+
+def build_incremental_sql(delta_table: str) -> str:
+    """
+    Watermark'tan yeni satırları run'a özel delta tablosuna toplar. Counts tablosu ve
+    watermark değişmez (build_commit_delta_sql); delta, hesaplandığı watermark'ı
+    base_* kolonlarında taşır. Aynı run'da tekrar çağrılırsa delta aynı watermark'tan
+    yeniden hesaplanır.
+    """
+    ds = _dataset()
+    delta_sql = _aggregate_sql(
+        events_filter="AND (events_wm IS NULL OR event_time > events_wm)",
+        orders_filter="AND (orders_wm IS NULL OR order_date > orders_wm)",
+    )
+    return f"""
+    DECLARE events_wm DATETIME DEFAULT (
+        SELECT events_watermark FROM `{ds}.{WATERMARK_TABLE}` WHERE id = '{STATE_ID}'
+    );
+    DECLARE orders_wm DATETIME DEFAULT (
+        SELECT orders_watermark FROM `{ds}.{WATERMARK_TABLE}` WHERE id = '{STATE_ID}'
+    );
+
+    CREATE OR REPLACE TABLE `{ds}.{delta_table}`
+    OPTIONS (expiration_timestamp = {RUN_TABLE_EXPIRATION}) AS
+    SELECT delta.*, events_wm AS base_events_watermark, orders_wm AS base_orders_watermark
+    FROM ({delta_sql}) delta;
+    """
+
+
+def build_commit_delta_sql(delta_table: str) -> str:
+    """
+    Kullanıcıları kuyruğa yazılmış delta'yı counts tablosuna MERGE eder, watermark'ı
+    ilerletir ve delta'yı siler. MERGE + watermark tek transaction'dadır ve sadece
+    watermark delta'nın hesaplandığı değerdeyse yapılır (başka run ilerletmişse atlanır,
+    aynı satırlar iki kez sayılmaz). Son satır: merged (BOOL).
+    """
+    ds = _dataset()
+    return f"""
+    DECLARE delta_rows INT64 DEFAULT (SELECT COUNT(*) FROM `{ds}.{delta_table}`);
+    DECLARE base_events_wm DATETIME DEFAULT (SELECT ANY_VALUE(base_events_watermark) FROM `{ds}.{delta_table}`);
+    DECLARE base_orders_wm DATETIME DEFAULT (SELECT ANY_VALUE(base_orders_watermark) FROM `{ds}.{delta_table}`);
+    DECLARE events_wm DATETIME;
+    DECLARE orders_wm DATETIME;
+    DECLARE merged BOOL DEFAULT FALSE;
+
+    BEGIN TRANSACTION;
+
+    SET events_wm = (SELECT events_watermark FROM `{ds}.{WATERMARK_TABLE}` WHERE id = '{STATE_ID}');
+    SET orders_wm = (SELECT orders_watermark FROM `{ds}.{WATERMARK_TABLE}` WHERE id = '{STATE_ID}');
+
+    IF delta_rows > 0
+        AND events_wm IS NOT DISTINCT FROM base_events_wm
+        AND orders_wm IS NOT DISTINCT FROM base_orders_wm THEN
+
+        MERGE `{ds}.{COUNTS_TABLE}` T
+        USING `{ds}.{delta_table}` S
+        ON T.user_id = S.user_id
+        WHEN MATCHED THEN UPDATE SET
+            event_count = T.event_count + S.event_count,
+            order_count = T.order_count + S.order_count,
+            max_event_time = IF(S.max_event_time IS NULL OR S.max_event_time < T.max_event_time, T.max_event_time, S.max_event_time),
+            max_order_date = IF(S.max_order_date IS NULL OR S.max_order_date < T.max_order_date, T.max_order_date, S.max_order_date),
+            created_at = S.created_at
+        WHEN NOT MATCHED THEN INSERT (user_id, event_count, order_count, max_event_time, max_order_date, created_at)
+            VALUES (S.user_id, S.event_count, S.order_count, S.max_event_time, S.max_order_date, S.created_at);
+
+        {_advance_watermark_sql(full=False)}
+
+        SET merged = TRUE;
+    END IF;
+
+    COMMIT TRANSACTION;
+
+    DROP TABLE IF EXISTS `{ds}.{delta_table}`;
+
+    SELECT merged;
+    """
+
+
+def _ensure_tables() -> None:
+    global _tables_ready
+    if _tables_ready:
+        return
+    run_query(build_ensure_tables_sql())
+    _tables_ready = True
+
+
+def read_watermark() -> dict:
+    """Son watermark satırını döner; henüz yoksa boş dict."""
+    ds = _dataset()
+    df = bq_to_dataframe(
+        f"""
+        SELECT events_watermark, orders_watermark, last_full_recompute
+        FROM `{ds}.{WATERMARK_TABLE}`
+        WHERE id = '{STATE_ID}'
+        """
+    )
+    if df.empty:
+        return {}
+    row = df.iloc[0]
+    return {
+        "events_watermark": row['events_watermark'],
+        "orders_watermark": row['orders_watermark'],
+        "last_full_recompute": row['last_full_recompute'],
+    }
+
+
+def _needs_full_recompute(watermark: dict) -> bool:
+    last_full = watermark.get("last_full_recompute")
+    if not watermark or last_full is None or str(last_full) in ("NaT", "None"):
+        return True
+    if getattr(last_full, "tzinfo", None) is None:
+        last_full = last_full.replace(tzinfo=timezone.utc)
+    return datetime.now(timezone.utc) - last_full >= _full_recompute_interval()
+
+
+def _isoformat(value):
+    if value is None or str(value) in ("NaT", "None"):
+        return None
+    return value.isoformat() if hasattr(value, "isoformat") else str(value)
+
+
+def refresh_activity_counts(run_key: str, full_recompute: bool = False) -> dict:
+    """
+    Persisted counts tablosunu günceller.
+
+    - full_recompute=True, state yoksa ya da son full recompute
+      USER_ACTIVITY_FULL_RECOMPUTE_HOURS'tan eskiyse: tüm geçmiş yeniden toplanır
+      (mode="full_recompute"; delta yok, compare_event_counts snapshot diff'ine düşer).
+    - Aksi halde sadece watermark sonrası satırlar run'ın delta tablosuna toplanır
+      (mode="incremental"); counts/watermark commit_activity_delta ile güncellenir.
+
+    Returns:
+        dict: {
+            "mode": "incremental" | "full_recompute",
+            "data_reference": counts tablosu referansı (+ delta_table, watermark),
+        }
+    """
+    _ensure_tables()
+    previous = read_watermark()
+    full = full_recompute or _needs_full_recompute(previous)
+
+    if full:
+        print("🔁 Full recompute: user_activity_counts tüm geçmişten yeniden oluşturuluyor")
+        run_query(build_full_recompute_sql())
+    else:
+        print(
+            f"⏩ Incremental: events > {previous.get('events_watermark')}, "
+            f"orders > {previous.get('orders_watermark')}"
+        )
+        run_query(build_incremental_sql(delta_table_name(run_key)))
+
+    current = read_watermark()
+    data_reference = _table_reference(COUNTS_TABLE)
+    data_reference["mode"] = "full_recompute" if full else "incremental"
+    data_reference["watermark"] = {
+        "events_watermark": _isoformat(current.get("events_watermark")),
+        "orders_watermark": _isoformat(current.get("orders_watermark")),
+    }
+    if not full:
+        data_reference["delta_table"] = delta_table_name(run_key)
+    return {"mode": data_reference["mode"], "data_reference": data_reference}
+
+
+def commit_activity_delta(data_reference: dict) -> bool:
+    """
+    Kullanıcıları kuyruğa yazılmış delta'yı counts tablosuna işler, watermark'ı
+    ilerletir ve delta tablosunu siler (build_commit_delta_sql).
+
+    Returns:
+        bool: delta MERGE edildiyse True; boşsa ya da watermark başka run tarafından
+        ilerletilmişse False (satırlar yeni watermark'tan sonra yeniden toplanır)
+    """
+    delta_table = data_reference['delta_table']
+    rows = list(run_query(build_commit_delta_sql(delta_table), location=data_reference.get('location')).result())
+    merged = bool(rows and rows[0][0])
+    print(f"{'✅' if merged else 'ℹ️'} {delta_table} {'counts tablosuna işlendi' if merged else 'işlenmedi (boş ya da watermark değişmiş)'}, delta silindi")
+    return merged
+
+
+def snapshot_backend() -> str:
+    """ACTIVITY_SNAPSHOT_BACKEND: 'firestore' (varsayılan, tek doküman), 'sharded', 'parquet' ya da 'bigquery'."""
+    return os.getenv('ACTIVITY_SNAPSHOT_BACKEND', 'firestore').strip().lower()
+
+
+def snapshot_table_id() -> str:
+    return f"{_project()}.{_dataset()}.{SNAPSHOT_TABLE}"
+
+
+def _ensure_snapshot_table(location: str = None) -> None:
+    run_query(
+        f"""
+        CREATE TABLE IF NOT EXISTS `{snapshot_table_id()}` (
+            user_id STRING NOT NULL,
+            event_count INT64,
+            order_count INT64,
+            created_at TIMESTAMP
+        )
+        """,
+        location=location,
+    )
+
+
+def staging_table_id(run_key: str) -> str:
+    """Run'a özel staging tablosu."""
+    return f"{_project()}.{_dataset()}.{STAGING_TABLE_PREFIX}{_run_suffix(run_key)}"
+
+
+def stage_snapshot_table(data_reference: dict, run_key: str) -> str:
+    """
+    Diff'in çalıştığı counts'u run'a özel staging tablosuna kopyalar (1 gün sonra
+    kendiliğinden silinir). Snapshot'a ancak diff commit edilince taşınır.
+
+    Returns:
+        str: staging tablo id'si
+    """
+    location = data_reference.get('location')
+    current_table_id = f"{data_reference['project']}.{data_reference['dataset']}.{data_reference['table']}"
+    staged = staging_table_id(run_key)
+    run_query(
+        f"""
+        CREATE OR REPLACE TABLE `{staged}`
+        OPTIONS (expiration_timestamp = {RUN_TABLE_EXPIRATION}) AS
+        SELECT user_id, event_count, order_count, created_at
+        FROM `{current_table_id}`
+        """,
+        location=location,
+    )
+    return staged
+
+
+def build_changed_users_sql(current_table_id: str) -> str:
+    """Mevcut counts ile önceki snapshot arasındaki yeni/artan kullanıcıları seçen join."""
+    return f"""
+    SELECT cur.user_id
+    FROM `{current_table_id}` cur
+    LEFT JOIN `{snapshot_table_id()}` prev
+      ON prev.user_id = cur.user_id
+    WHERE prev.user_id IS NULL
+       OR cur.event_count > COALESCE(prev.event_count, 0)
+       OR cur.order_count > COALESCE(prev.order_count, 0)
+    """
+
+
+def changed_user_ids(data_reference: dict, run_key: str) -> list:
+    """
+    Yeni ya da event/order sayısı artmış kullanıcıları BigQuery'de hesaplar.
+    Counts önce staging tablosuna alınır ve diff onun üzerinde çalışır; sadece
+    değişen user_id'ler process'e stream edilir.
+    """
+    location = data_reference.get('location')
+    _ensure_snapshot_table(location)
+    staged = stage_snapshot_table(data_reference, run_key)
+    user_ids = []
+    for batch in bq_iter_record_batches(build_changed_users_sql(staged), location=location):
+        user_ids.extend(str(user_id) for user_id in batch.column('user_id').to_pylist())
+    return user_ids
+
+
+def mark_diff_committed(data_reference: dict, run_key: str) -> None:
+    """
+    Diff'in kullanıcıları kuyruğa yazıldı: run'ın staging tablosu diff_committed=true
+    etiketiyle işaretlenir. İşaret BigQuery'de durduğu için persist_snapshot_table başka
+    bir instance'ta ya da job worker'ında çalışsa da görür.
+    """
+    run_query(
+        f"""
+        ALTER TABLE `{staging_table_id(run_key)}`
+        SET OPTIONS (labels = [('{COMMITTED_LABEL}', 'true')])
+        """,
+        location=data_reference.get('location'),
+    )
+
+
+def _committed_staging(run_key: str):
+    """Run'ın diff_committed etiketli staging tablosu; yoksa ya da işaretsizse None."""
+    from google.api_core.exceptions import NotFound
+
+    try:
+        table = get_bigquery_client().get_table(staging_table_id(run_key))
+    except NotFound:
+        return None
+    return table if (table.labels or {}).get(COMMITTED_LABEL) == 'true' else None
+
+
+def persist_snapshot_table(data_reference: dict, run_key: str) -> dict:
+    """
+    Run'ın diff'i commit edilmişse (staging tablosu diff_committed etiketli) staging'i
+    user_activity_snapshot'ın yerine koyar ve siler (tamamen BigQuery içinde, veri
+    process'e inmez). Commit edilmiş diff yoksa snapshot değiştirilmez; aksi halde
+    kuyruğa yazılmamış kullanıcılar sonraki diff'te görünmezdi. İşaretsiz staging
+    tablosu expiration ile kendiliğinden silinir.
+
+    Returns:
+        dict: {"snapshot_table": "...", "total_users": int, "swapped": bool}
+    """
+    staged = _committed_staging(run_key)
+    if staged is None:
+        print(f"⚠️ {run_key} için commit edilmiş diff yok, {SNAPSHOT_TABLE} değiştirilmedi")
+        return {"snapshot_table": snapshot_table_id(), "total_users": 0, "swapped": False}
+    staged_id = f"{staged.project}.{staged.dataset_id}.{staged.table_id}"
+    run_query(
+        f"""
+        CREATE OR REPLACE TABLE `{snapshot_table_id()}` AS
+        SELECT user_id, event_count, order_count, created_at
+        FROM `{staged_id}`;
+        DROP TABLE IF EXISTS `{staged_id}`;
+        """,
+        location=data_reference.get('location'),
+    )
+    table = get_bigquery_client().get_table(snapshot_table_id())
+    return {"snapshot_table": snapshot_table_id(), "total_users": int(table.num_rows or 0), "swapped": True}
@@ -1,14 +1,62 @@
 from google.adk.agents.llm_agent import Agent
 import time
-from .bq_helper import bq_to_dataframe, query_to_temp_table
+from .bq_helper import (
+    arrow_to_nested_dict,
+    bq_iter_record_batches,
+    bq_to_arrow,
+    query_to_temp_table,
+)
+from .parquet_snapshot import write_parquet_snapshot
+from .snapshot_diff import activity_arrays_from_arrow, activity_arrays_from_dict, diff_activity_snapshots, new_or_increased_indexes, take_ids
+from .user_history import fetch_user_histories, fetch_user_history_tables
+from .segmentation_engine import features_from_rows, format_segment_labels, segment_users
+from .segment_features import build_feature_digests, fetch_segment_features
+from .tool_budget import fit_users_to_budget
+from .segmentation_cache import (
+    feature_fingerprints,
+    forget_fingerprints,
+    get_segmentation_cache,
+    lookup_cached_labels,
+    remember_fingerprints,
+    segmentation_cache_stats,
+    store_segmentation_results,
+)
+from .activity_counts import (
+    changed_user_ids,
+    commit_activity_delta,
+    mark_diff_committed,
+    persist_snapshot_table,
+    refresh_activity_counts,
+    snapshot_backend,
+    stage_snapshot_table,
+)
 import os
 import sys
 from datetime import datetime
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
-from MasterAgent.firestore_helper import get_firestore_client, get_past_events_from_firestore
+from MasterAgent.firestore_helper import (
+    adjust_pending_counter,
+    bulk_write_documents,
+    claim_pending_users,
+    complete_claimed_user,
+    complete_claimed_users,
+    get_firestore_client,
+    get_past_activity_arrays,
+    get_past_events_from_firestore,
+    get_pending_total,
+    release_claims,
+    segmentation_lease_seconds,
+    write_sharded_activity_snapshot,
+)
 from google.cloud import firestore
 import uuid 
+import socket
 from webhook import report_progress
+from rate_limiter import after_model_rate_limit, before_model_rate_limit
+from run_context import current_run_id, remaining_seconds
+from genai_models import gemini_model
+# Python 3.11'de pydantic (ADK tool şeması) typing.TypedDict'i kabul etmiyor
+from typing_extensions import TypedDict
 
 
 # Ortam değişkenlerini .env formatına uyarlama
@@ -26,8 +74,12 @@ if os.getenv('GOOGLE_GENAI_USE_VERTEXAI', '').lower() in ['true', '1']:
         os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = os.getenv('GOOGLE_APPLICATION_CREDENTIALS_AI', '')
 
 
+# Aktif run yokken (lokal script) süreç boyunca sabit kalan kimlik; lease sahibi çağrılar arasında değişmemeli
+_LOCAL_RUN_ID = f"local-{uuid.uuid4().hex[:6]}"
+
+
 def _run_id() -> str:
-    return os.getenv("AGENTS_CURRENT_RUN_ID") or f"local-{uuid.uuid4().hex[:6]}"
+    return current_run_id() or _LOCAL_RUN_ID
 
 def _progress(status: str, message: str, *, step: str | None = None, meta: dict | None = None) -> None:
     try:
@@ -44,11 +96,17 @@ def _progress(status: str, message: str, *, step: str | None = None, meta: dict
 
 
 
-def retrieve_user_activity_counts():
+def retrieve_user_activity_counts(mode: str = "", full_recompute: bool = False):
     """
     Hem event hem order count'larını BigQuery'den çeker ve birleştirir.
     Her user için event_count, order_count ve created_at içeren yapı oluşturur.
     
+    Args:
+        mode: "full" (her çalışmada tüm tabloları GROUP BY ile tarar, temp table döner) ya da
+              "incremental" (sadece watermark sonrası satırları run'a özel delta tablosuna toplar;
+              compare_event_counts kullanıcıları kuyruğa yazınca persisted counts tablosuna MERGE eder). Boşsa USER_ACTIVITY_COUNTS_MODE env'i kullanılır (varsayılan "full").
+        full_recompute: incremental modda counts tablosunu tüm geçmişten yeniden kurar (drift onarımı).
+    
     Returns:
         dict: {
             "status": "success",
@@ -58,9 +116,27 @@ def retrieve_user_activity_counts():
                 "table": "combined_user_activity_..."
             }
         }
+        Incremental modda data_reference ayrıca "mode", "watermark" ve (delta varsa) "delta_table" içerir.
     """
-    _progress("progress", "Starting retrieve_user_activity_counts", step="retrieve_user_activity_counts")
-    print(f"🔍 retrieve_user_activity_counts çağrıldı")
+    mode = (mode or os.getenv('USER_ACTIVITY_COUNTS_MODE', 'full')).strip().lower()
+    _progress("progress", "Starting retrieve_user_activity_counts", step="retrieve_user_activity_counts", meta={"mode": mode})
+    print(f"🔍 retrieve_user_activity_counts çağrıldı (mode={mode})")
+    
+    if mode == "incremental":
+        refreshed = refresh_activity_counts(_run_id(), full_recompute=full_recompute)
+        result = {
+            "status": "success",
+            "message": f"User activity counts refreshed in BigQuery ({refreshed['mode']}).",
+            "data_reference": refreshed["data_reference"],
+        }
+        print(f"✅ retrieve_user_activity_counts RESULT: {result['data_reference']}")
+        _progress(
+            "success",
+            "Finished retrieve_user_activity_counts",
+            step="retrieve_user_activity_counts",
+            meta={"data_reference": result["data_reference"]},
+        )
+        return result
     
     # 1. Event counts query
     events_query = """
@@ -138,26 +214,80 @@ def write_user_activity_to_firestore(data_reference: dict):
         print("❌ Geçersiz tablo referansı!")
         return "Error: Invalid table reference"
     
-    # BigQuery'den veriyi çek
-    full_table_name = f"`{project}.{dataset}.{table}`"
-    query = f"SELECT user_id, event_count, order_count, created_at FROM {full_table_name}"
+    if snapshot_backend() == 'bigquery':
+        # Snapshot BigQuery'de tutulur; Firestore'a sadece küçük bir pointer dokümanı yazılır
+        # Staging tablosu sadece bu run'ın diff'i kuyruğa yazıldıysa snapshot'a taşınır
+        persisted = persist_snapshot_table(data_reference, _run_id())
+        if not persisted['swapped']:
+            msg = f"Snapshot not updated: no committed compare_event_counts diff in this run, {persisted['snapshot_table']} left unchanged"
+            _progress("success", "Finished write_user_activity_to_firestore (snapshot unchanged)", step="write_user_activity_to_firestore", meta={"backend": "bigquery", "swapped": False})
+            return msg
+        db = get_firestore_client()
+        doc_id = f"snapshot_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        pointer = {
+            'backend': 'bigquery',
+            'snapshot_table': persisted['snapshot_table'],
+            'total_users': persisted['total_users'],
+            'createdAt': firestore.SERVER_TIMESTAMP,
+            'table_source': f"{project}.{dataset}.{table}"
+        }
+        if data_reference.get('watermark'):
+            pointer['watermark'] = data_reference['watermark']
+        db.collection('user_activity_counts').document(doc_id).set(pointer)
+        print(f"✅ Snapshot BigQuery'ye yazıldı: {persisted['snapshot_table']} (pointer: user_activity_counts/{doc_id})")
+        msg = f"{persisted['total_users']} user activity records written to {persisted['snapshot_table']} (pointer document: {doc_id})"
+        _progress("success", "Finished write_user_activity_to_firestore", step="write_user_activity_to_firestore", meta={"total_users": persisted['total_users'], "doc_id": doc_id, "backend": "bigquery"})
+        return msg
     
+    if snapshot_backend() == 'parquet':
+        # Kolonlar Arrow olarak okunur, Parquet'e yazılır; Firestore'da sadece pointer tutulur
+        table_arrow = bq_to_arrow(data_reference=data_reference, columns=['user_id', 'event_count', 'order_count'])
+        doc_id = f"snapshot_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        written = write_parquet_snapshot(table_arrow, doc_id)
+        pointer = {
+            'backend': 'parquet',
+            'snapshot_uri': written['uri'],
+            'total_users': written['total_users'],
+            'bytes': written['bytes'],
+            'createdAt': firestore.SERVER_TIMESTAMP,
+            'table_source': f"{project}.{dataset}.{table}"
+        }
+        if data_reference.get('watermark'):
+            pointer['watermark'] = data_reference['watermark']
+        get_firestore_client().collection('user_activity_counts').document(doc_id).set(pointer)
+        msg = f"{written['total_users']} user activity records written to {written['uri']} (pointer document: {doc_id})"
+        _progress("success", "Finished write_user_activity_to_firestore", step="write_user_activity_to_firestore", meta={"total_users": written['total_users'], "doc_id": doc_id, "backend": "parquet"})
+        return msg
+    
+    # BigQuery'den veriyi çek (Storage Read API ile Arrow batch'leri halinde stream edilir)
+    full_table_name = f"`{project}.{dataset}.{table}`"
     print(f"📊 BigQuery'den veri çekiliyor: {full_table_name}")
-    df = bq_to_dataframe(query, location=location)
     
-    # DataFrame'i nested dictionary'ye çevir
+    # Arrow batch'lerini nested dictionary'ye çevir
     # Format: {user_id: {event_count: X, order_count: Y, created_at: Z}}
     user_activity = {}
-    for _, row in df.iterrows():
-        user_id = str(row['user_id'])
-        user_activity[user_id] = {
-            'event_count': int(row['event_count']),
-            'order_count': int(row['order_count']),
-            'created_at': row['created_at'].isoformat() if hasattr(row['created_at'], 'isoformat') else str(row['created_at'])
-        }
+    for batch in bq_iter_record_batches(
+        data_reference=data_reference,
+        columns=['user_id', 'event_count', 'order_count', 'created_at'],
+    ):
+        # Sayılar ve created_at batch başına toplu çevrilir (satır başına int()/isoformat() yok)
+        user_activity.update(
+            arrow_to_nested_dict(batch, 'user_id', int_columns=['event_count', 'order_count'])
+        )
     
     print(f"✅ {len(user_activity)} kullanıcı verisi alındı")
     
+    if snapshot_backend() == 'sharded':
+        # Manifest + hash aralığına göre shard dokümanları (1 MiB limitine takılmaz)
+        written = write_sharded_activity_snapshot(
+            user_activity,
+            table_source=f"{project}.{dataset}.{table}",
+            extra={'watermark': data_reference['watermark']} if data_reference.get('watermark') else None,
+        )
+        msg = f"{written['total_users']} user activity records written to firestore as sharded snapshot: {written['doc_id']} ({written['shard_count']} shards)"
+        _progress("success", "Finished write_user_activity_to_firestore", step="write_user_activity_to_firestore", meta={**written, "backend": "sharded"})
+        return msg
+    
     # Firestore'a tek döküman olarak yaz
     db = get_firestore_client()
     
@@ -165,12 +295,16 @@ def write_user_activity_to_firestore(data_reference: dict):
     doc_id = f"snapshot_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
     doc_ref = db.collection('user_activity_counts').document(doc_id)
     
-    doc_ref.set({
+    snapshot = {
         'user_activity': user_activity,
         'total_users': len(user_activity),
         'createdAt': firestore.SERVER_TIMESTAMP,
         'table_source': f"{project}.{dataset}.{table}"
-    })
+    }
+    # Incremental modda snapshot'ın hangi event_time/order_date'e kadar işlendiği de saklanır
+    if data_reference.get('watermark'):
+        snapshot['watermark'] = data_reference['watermark']
+    doc_ref.set(snapshot)
     
     print(f"✅ Firestore'a yazıldı: user_activity_counts/{doc_id}")
     print(f"   Örnek veri: {list(user_activity.items())[:2]}")
@@ -183,42 +317,55 @@ def write_user_activity_to_firestore(data_reference: dict):
 
 def write_users_to_segmentate(user_ids: list):
     """
-    'users_to_segmentate' collection'ına users'ı tek tek (state=pending) yazar.
+    'users_to_segmentate' collection'ına users'ı (state=pending) BulkWriter ile paralel yazar.
+    Kuyrukta zaten olan (pending ya da processing) kullanıcılar değiştirilmez; böylece
+    processing lease'i silinmez ve pending sayacı yalnızca yeni eklenenler kadar artar.
+    Hız ve hata sayıları _progress ile raporlanır.
     """
+    if not user_ids:
+        return "No users to write"
+    stats = _write_pending_users(user_ids)
+    msg = f"{stats['written']} users written to Firestore collection 'users_to_segmentate' with state: pending"
+    if stats['existing']:
+        msg += f" ({stats['existing']} already queued)"
+    if stats['failed']:
+        msg += f" ({stats['failed']} failed: {stats['errors']})"
+    return msg
+
+
+def _write_pending_users(user_ids: list) -> dict:
+    """write_users_to_segmentate'in gövdesi; bulk_write_documents istatistiklerini döner."""
     _progress("progress", "Starting write_users_to_segmentate", step="write_users_to_segmentate", meta={"count": len(user_ids or [])})
     print(f"🔍 write_users_to_segmentate çağrıldı")
     print(f"📥 {len(user_ids)} kullanıcı yazılacak")
     
-    if not user_ids:
-        return "No users to write"
-    
-    db = get_firestore_client()
-    collection_ref = db.collection('users_to_segmentate')
-    
-    batch = db.batch()
-    count = 0
-    
-    for user_id in user_ids:
-        user_id_str = str(user_id)
-        doc_ref = collection_ref.document(user_id_str)
-        user_data = {
-            'user_id': user_id_str,
+    documents = (
+        (str(user_id), {
+            'user_id': str(user_id),
             'state': 'pending',
             'created_at': firestore.SERVER_TIMESTAMP
-        }
-        batch.set(doc_ref, user_data)
-        count += 1
-        if count % 500 == 0:
-            batch.commit()
-            batch = db.batch()
-            print(f"   ✅ {count} kullanıcı yazıldı...")
+        })
+        for user_id in user_ids
+    )
+    
+    def report(stats: dict):
+        print(f"   ✅ {stats['written']} kullanıcı yazıldı ({stats['docs_per_sec']} doc/sn)...")
+        _progress("progress", "Writing users_to_segmentate", step="write_users_to_segmentate", meta=stats)
     
-    if count % 500 != 0:
-        batch.commit()
+    # create: yalnızca gerçekten oluşturulan dokümanlar sayaca eklenir
+    stats = bulk_write_documents('users_to_segmentate', documents, on_progress=report, create_only=True)
+    count = stats['written']
+    adjust_pending_counter(count)
     
-    print(f"✅ Toplam {count} kullanıcı 'users_to_segmentate' collection'ına yazıldı (state: pending)")
-    _progress("success", "Finished write_users_to_segmentate", step="write_users_to_segmentate", meta={"written": count})
-    return f"{count} users written to Firestore collection 'users_to_segmentate' with state: pending"
+    print(f"✅ Toplam {count} kullanıcı 'users_to_segmentate' collection'ına yazıldı (state: pending) "
+          f"- {stats['docs_per_sec']} doc/sn, {stats['elapsed_seconds']} sn")
+    if stats['existing']:
+        print(f"ℹ️ {stats['existing']} kullanıcı zaten kuyrukta (pending/processing), değiştirilmedi")
+    if stats['failed'] or stats['errors']:
+        print(f"⚠️ Yazma hataları: {stats['errors']} (başarısız: {stats['failed']}, tekrar denenen: {stats['retried']})")
+    status = "success" if not stats['failed'] else "error"
+    _progress(status, "Finished write_users_to_segmentate", step="write_users_to_segmentate", meta=stats)
+    return stats
 
 
 def compare_event_counts(data_reference: dict):
@@ -247,64 +394,117 @@ def compare_event_counts(data_reference: dict):
             "message": "Invalid table reference"
         }
     
+    delta_table = data_reference.get('delta_table')
+    if delta_table:
+        # Incremental mod: delta tablosundaki her kullanıcı watermark'tan beri yeni
+        # event/order almıştır, yani tanım gereği yeni ya da artmış kullanıcıdır.
+        # Counts/watermark ancak bu kullanıcılar kuyruğa yazıldıktan sonra ilerler.
+        delta_reference = {**data_reference, 'table': delta_table}
+        print(f"📊 Delta tablosundan kullanıcılar çekiliyor: `{project}.{dataset}.{delta_table}`")
+        new_or_increased_users = []
+        for batch in bq_iter_record_batches(data_reference=delta_reference, columns=['user_id']):
+            new_or_increased_users.extend(str(user_id) for user_id in batch.column('user_id').to_pylist())
+        print(f"📊 Segmentlenecek kullanıcı sayısı (delta): {len(new_or_increased_users)}")
+        result = _enqueue_users_to_segment(data_reference, new_or_increased_users)
+        if result['status'] != 'success':
+            return result
+        commit_activity_delta(data_reference)
+        if snapshot_backend() == 'bigquery':
+            # Snapshot, delta işlenmiş counts ile güncellensin
+            stage_snapshot_table(data_reference, _run_id())
+            mark_diff_committed(data_reference, _run_id())
+        return result
+    
+    if snapshot_backend() == 'bigquery':
+        # Server-side diff: önceki snapshot BigQuery tablosunda, join BigQuery'de çalışır;
+        # process'e sadece değişen user_id'ler iner.
+        print(f"📊 Server-side diff: `{project}.{dataset}.{table}` vs user_activity_snapshot")
+        new_or_increased_users = changed_user_ids(data_reference, _run_id())
+        print(f"📊 Segmentlenecek kullanıcı sayısı (server-side diff): {len(new_or_increased_users)}")
+        result = _enqueue_users_to_segment(data_reference, new_or_increased_users)
+        if result['status'] == 'success':
+            mark_diff_committed(data_reference, _run_id())
+        return result
+    
     full_table_name = f"`{project}.{dataset}.{table}`"
-    query = f"SELECT user_id, event_count, order_count FROM {full_table_name}"
     print(f"📊 BigQuery'den veri çekiliyor: {full_table_name}")
-    df = bq_to_dataframe(query, location=location)
     
-    current_activity = {
-        str(row['user_id']): {
-            'event_count': int(row['event_count']),
-            'order_count': int(row['order_count'])
-        }
-        for _, row in df.iterrows()
-    }
-    print(f"✅ {len(current_activity)} kullanıcı verisi alındı")
-    
-    past_activity = get_past_events_from_firestore()
+    # Kolonlar Arrow → NumPy olarak alınır, diff vektörel merge ile yapılır (per-user dict lookup yok)
+    cur_ids, cur_events, cur_orders = activity_arrays_from_arrow(
+        bq_to_arrow(data_reference=data_reference, columns=['user_id', 'event_count', 'order_count'])
+    )
+    print(f"✅ {len(cur_ids)} kullanıcı verisi alındı")
     
-    new_or_increased_users = [
-        user_id
-        for user_id, current_data in current_activity.items()
-        if (
-            user_id not in past_activity or 
-            current_data['event_count'] > past_activity.get(user_id, {}).get('event_count', 0) or
-            current_data['order_count'] > past_activity.get(user_id, {}).get('order_count', 0)
-        )
-    ]
+    try:
+        past_ids, past_events, past_orders = get_past_activity_arrays()
+    except Exception as e:
+        print(f"❌ Firestore'dan veri çekerken hata: {e}")
+        past_ids, past_events, past_orders = activity_arrays_from_dict({})
     
-    print(f"📊 Segmentlenecek kullanıcı sayısı: {len(new_or_increased_users)} / {len(current_activity)}")
+    diff = diff_activity_snapshots(cur_ids, cur_events, cur_orders, past_ids, past_events, past_orders)
+    new_or_increased_users = take_ids(cur_ids, new_or_increased_indexes(diff))
+    print(f"   yeni={len(diff['new'])}, artan={len(diff['increased'])}, değişmeyen={len(diff['unchanged'])}, silinen={len(diff['removed'])}")
     
+    print(f"📊 Segmentlenecek kullanıcı sayısı: {len(new_or_increased_users)} / {len(cur_ids)}")
+    return _enqueue_users_to_segment(data_reference, new_or_increased_users)
+
+
+def _enqueue_users_to_segment(data_reference: dict, new_or_increased_users: list) -> dict:
+    """
+    Yeni/artan kullanıcıları pending kuyruğuna yazar ve compare_event_counts sonucunu döner.
+    Yazılamayan kullanıcı varsa status="error" olur; çağıran delta/snapshot'ı ilerletmez.
+    """
+    failed = 0
     if new_or_increased_users:
-        write_result = write_users_to_segmentate(new_or_increased_users)
-        print(f"✅ {write_result}")
+        stats = _write_pending_users(new_or_increased_users)
+        failed = stats['failed']
+        print(f"✅ {stats['written']} kullanıcı kuyruğa yazıldı" + (f", {failed} başarısız: {stats['errors']}" if failed else ""))
     else:
         print("ℹ️ Segmentlenecek yeni kullanıcı bulunamadı")
     
-    _progress("success", "Finished compare_event_counts", step="compare_event_counts", meta={"users_to_segment_count": len(new_or_increased_users)})
-    return {
-        "status": "success",
+    status = "success" if not failed else "error"
+    _progress(status, "Finished compare_event_counts", step="compare_event_counts", meta={"users_to_segment_count": len(new_or_increased_users), "failed": failed})
+    result = {
+        "status": status,
         "data_reference": data_reference,
         "users_to_segment_count": len(new_or_increased_users),
         "written_to_firestore": len(new_or_increased_users) > 0
     }
+    if failed:
+        result["message"] = f"{failed} users could not be queued; activity snapshot not advanced, the next run retries them"
+    return result
+
+
+def _lease_owner() -> str:
+    """Bu worker'ın (host + process + run) lease sahibi kimliği."""
+    return f"{socket.gethostname()}:{os.getpid()}:{_run_id()}"
 
 
 def read_users_to_segmentate():
     """
-    Firestore'dan state=pending olan 10 kullanıcıyı alır ve 
-    BigQuery'den bu kullanıcıların tüm event ve orderlarını çeker.
+    Firestore kuyruğundan en fazla SEGMENTATION_CLAIM_SIZE (varsayılan 5) kullanıcıyı
+    lease ile claim eder (state=processing) ve segmentasyon için verilerini döner.
+    Eşzamanlı worker'lar aynı kullanıcıyı almaz; süresi dolan lease'ler (çöken
+    worker'lar) yeniden claim edilir.
+    
+    SEGMENTATION_READ_OUTPUT=summary (varsayılan): kullanıcı başına sabit boyutlu özet
+    (BigQuery'de hesaplanır; harcama, en çok bakılan kategoriler, event tipi sayıları,
+    son oturum bayrakları). raw: tüm event ve order kayıtları.
+    Sonuç SEGMENTATION_TOOL_TOKEN_BUDGET'a (varsayılan 4000 token) sığdırılır; sığmayan
+    kullanıcılar kuyruğa geri verilir.
+    Feature fingerprint'i segmentasyon cache'inde olan kullanıcılar (SEGMENTATION_CACHE_BACKEND)
+    LLM'e gönderilmeden cache'teki etiketle tamamlanır ve sonuçta yer almaz.
     
     Returns:
         dict: {
             "status": "success" | "no_pending_users",
             "pending_total": int,
+            "lease_expires_in_seconds": int,
+            "output": "summary" | "raw",
             "users": [
-                {
-                    "user_id": "...",
-                    "events": [...],
-                    "orders": [...]
-                },
+                {"user_id": "...", "total_spent": ..., "order_count": ..., "top_categories": {...},
+                 "event_counts": {...}, "last_session": {...}}     # summary
+                {"user_id": "...", "events": [...], "orders": [...]}  # raw
                 ...
             ]
         }
@@ -312,124 +512,208 @@ def read_users_to_segmentate():
     _progress("progress", "Starting read_users_to_segmentate", step="read_users_to_segmentate")
     print(f"🔍 read_users_to_segmentate çağrıldı")
     
-    # Firestore'dan pending kullanıcıları al
-    db = get_firestore_client()
-    
-    # Pending toplam sayısını ölç (karar için kullanılacak)
+    # Pending toplam sayısını ölç (karar için kullanılacak): server-side COUNT ya da sayaç dokümanı
     try:
-        pending_total = sum(
-            1
-            for _ in db.collection('users_to_segmentate')
-            .where('state', '==', 'pending')
-            .stream()
-        )
-    except Exception:
+        pending_total = get_pending_total()
+    except Exception as e:
+        print(f"⚠️ pending_total hesaplanamadı: {e}")
         pending_total = 0
     
-    pending_users_query = (
-        db.collection('users_to_segmentate')
-        .where('state', '==', 'pending')
-        .limit(5)
-        .stream()
-    )
-    
-    pending_users = [doc.to_dict()['user_id'] for doc in pending_users_query]
+    # Kuyruktan kullanıcıları transaction ile claim et (pending ya da süresi dolmuş lease).
+    # Feature fingerprint'i cache'te olan kullanıcılar LLM'e gitmeden tamamlanır; batch'in
+    # tamamı cache'ten çözülürse sıradaki (daha büyük) batch claim edilir.
+    owner = _lease_owner()
+    claim_size = max(1, int(os.getenv('SEGMENTATION_CLAIM_SIZE', '5')))
+    output_mode = os.getenv('SEGMENTATION_READ_OUTPUT', 'summary').strip().lower()
+    cache_enabled = get_segmentation_cache() is not None
+    limit = claim_size
+    cached_users = 0
+    pending_users, feature_rows = [], None
+    while True:
+        claimed = claim_pending_users(owner, limit=limit)
+        if not claimed:
+            break
+        print(f"✅ {len(claimed)} kullanıcı claim edildi (lease: {segmentation_lease_seconds()} sn)")
+        if not cache_enabled:
+            pending_users = claimed
+            break
+        feature_rows = fetch_segment_features(claimed)
+        misses, completed = _complete_from_cache(owner, claimed, feature_rows)
+        cached_users += completed
+        if misses:
+            pending_users = misses[:claim_size]
+            if len(misses) > claim_size:
+                release_claims(owner, misses[claim_size:])
+                forget_fingerprints(misses[claim_size:])
+            break
+        limit = max(claim_size, int(os.getenv('SEGMENTATION_CACHE_DRAIN_SIZE', '100')))
     
     if not pending_users:
         print("⚠️ Pending durumunda kullanıcı bulunamadı")
-        _progress("success", "Finished read_users_to_segmentate (no_pending_users)", step="read_users_to_segmentate", meta={"pending_total": pending_total})
+        _progress("success", "Finished read_users_to_segmentate (no_pending_users)", step="read_users_to_segmentate", meta={
+            "pending_total": pending_total,
+            "cached_users": cached_users,
+            "cache": segmentation_cache_stats(),
+        })
         return {
             "status": "no_pending_users",
             "users": [],
             "pending_total": pending_total
         }
     
-    print(f"✅ {len(pending_users)} pending kullanıcı bulundu")
-    
-    # BigQuery'den bu kullanıcıların eventlerini ve orderlarını çek
-    user_ids_str = "', '".join(pending_users)
-    
-    # Events query
-    events_query = f"""
-    SELECT session_id, user_id, event_name, event_time, path_name, payload, event_location
-    FROM `adgen_bq.user_events`
-    WHERE user_id IN ('{user_ids_str}')
-    ORDER BY user_id, event_time
-    """
-    
-    # Orders query
-    orders_query = f"""
-    SELECT order_id, user_id, session_id, products_payload, paid_amount, order_date, session_location
-    FROM `adgen_bq.user_orders`
-    WHERE user_id IN ('{user_ids_str}')
-    ORDER BY user_id, order_date
-    """
+    if output_mode == 'raw':
+        # BigQuery'den bu kullanıcıların eventlerini ve orderlarını çek: tek parametreli sorgu
+        # (UNNEST(@user_ids)) per tablo, iki sorgu paralel, sonuç tek geçişte kullanıcıya bölünür
+        print(f"📊 BigQuery'den eventler ve orderlar çekiliyor...")
+        histories = fetch_user_histories(pending_users)
+        users_data = [
+            {
+                'user_id': user_id,
+                'events': histories[user_id]['events'],
+                'orders': histories[user_id]['orders']
+            }
+            for user_id in pending_users
+        ]
+    else:
+        output_mode = 'summary'
+        # Ham kayıtlar yerine BigQuery'de hesaplanan sabit boyutlu kullanıcı özetleri
+        print(f"📊 BigQuery'de kullanıcı özetleri hesaplanıyor...")
+        if feature_rows is None:
+            feature_rows = fetch_segment_features(pending_users)
+        users_data = build_feature_digests(feature_rows, pending_users)
     
-    print(f"📊 BigQuery'den eventler çekiliyor...")
-    events_df = bq_to_dataframe(events_query)
+    result = {
+        "status": "success",
+        "users": users_data,
+        "pending_total": pending_total,
+        "lease_expires_in_seconds": segmentation_lease_seconds(),
+        "output": output_mode
+    }
     
-    print(f"📊 BigQuery'den orderlar çekiliyor...")
-    orders_df = bq_to_dataframe(orders_query)
+    # Tool sonucunu token bütçesine sığdır; sığmayan kullanıcıların claim'i geri verilir
+    token_budget = int(os.getenv('SEGMENTATION_TOOL_TOKEN_BUDGET', '4000'))
+    result, dropped, tokens = fit_users_to_budget(result, token_budget, mode=output_mode)
+    if dropped:
+        released = release_claims(_lease_owner(), dropped)
+        forget_fingerprints(dropped)
+        print(f"⚠️ Token bütçesi ({token_budget}) aşıldı: {len(dropped)} kullanıcı kuyruğa geri verildi ({released})")
+        if not result['users']:
+            # Tek kullanıcı bile sığmadı: boş listeyi "kuyruk bitti" sanmasın diye hata döner
+            result = {**result, "status": "error", "message": f"A single user exceeds SEGMENTATION_TOOL_TOKEN_BUDGET ({token_budget} tokens); claims were released"}
     
-    # Her kullanıcı için verileri organize et
-    users_data = []
-    for user_id in pending_users:
-        user_events = events_df[events_df['user_id'] == user_id].to_dict('records')
-        user_orders = orders_df[orders_df['user_id'] == user_id].to_dict('records')
-        
-        users_data.append({
-            'user_id': user_id,
-            'events': user_events,
-            'orders': user_orders
-        })
+    print(f"✅ {len(result['users'])} kullanıcının verileri hazırlandı (~{tokens} token, {output_mode})")
     
-    print(f"✅ {len(users_data)} kullanıcının verileri hazırlandı")
+    _progress("success", "Finished read_users_to_segmentate", step="read_users_to_segmentate", meta={
+        "users_fetched": len(result['users']),
+        "pending_total": pending_total,
+        "output": output_mode,
+        "result_tokens": tokens,
+        "token_budget": token_budget,
+        "users_released": len(dropped),
+        "cached_users": cached_users,
+        "cache": segmentation_cache_stats(),
+    })
+    return result
+
+
+def _complete_from_cache(owner: str, user_ids: list, feature_rows) -> tuple:
+    """
+    Feature fingerprint'i cache'te olan kullanıcıların sonucunu LLM'siz yazar.
+    Kalan kullanıcıların fingerprint'i, sonuçları yazıldığında cache'e eklenmek üzere saklanır.
     
-    _progress("success", "Finished read_users_to_segmentate", step="read_users_to_segmentate", meta={"users_fetched": len(users_data), "pending_total": pending_total})
-    return {
-        "status": "success",
-        "users": users_data,
-        "pending_total": pending_total
-    }
+    Returns:
+        (misses, completed): LLM'e gidecek kullanıcılar (claim sırasıyla) ve cache'ten tamamlanan sayısı
+    """
+    fingerprints = feature_fingerprints(features_from_rows(feature_rows, user_ids))
+    hits = lookup_cached_labels(fingerprints)
+    completed = 0
+    if hits:
+        outcome = complete_claimed_users(owner, hits)
+        completed = len(outcome['success'])
+        print(f"🗃️ {completed} kullanıcı cache'ten segmentlendi (LLM çağrısı yok)")
+    misses = [user_id for user_id in user_ids if user_id not in hits]
+    remember_fingerprints({user_id: fingerprints[user_id] for user_id in misses}, segmentation_lease_seconds())
+    return misses, completed
 
 
 def write_user_segmentation_result(user_id: str, segmentation_result: str):
     """
     Bir kullanıcının segmentasyon sonucunu 'user_segmentations' collection'ına yazar
-    ve 'users_to_segmentate' tablosunda state'ini 'success' olarak günceller.
+    ve kullanıcıyı 'users_to_segmentate' kuyruğundan siler. Yazma lease ile onaylanır:
+    kullanıcı bu worker tarafından claim edilmemişse ya da lease başka worker'a
+    geçmişse sonuç yazılmaz.
     
     Args:
         user_id (str): Kullanıcı ID'si
         segmentation_result (str): Segmentasyon sonucu
         
     Returns:
-        str: Confirmation message
+        str: "success" | "lease_lost" | "not_claimed"
     """
     _progress("progress", "Starting write_user_segmentation_result", step="write_user_segmentation_result", meta={"user_id": user_id})
     print(f"🔍 write_user_segmentation_result çağrıldı: {user_id}")
     
-    db = get_firestore_client()
-    
-    # 1. user_segmentations collection'ına yaz
-    segmentation_doc_ref = db.collection('user_segmentations').document(user_id)
-    segmentation_doc_ref.set({
-        'user_id': user_id,
-        'segmentation_result': segmentation_result,
-        'updated_at': firestore.SERVER_TIMESTAMP
-    })
-    
-    # 2. users_to_segmentate'te state'i success yap
-    pending_doc_ref = db.collection('users_to_segmentate').document(user_id)
-    pending_doc_ref.delete()
+    # Sonuç yazma + kuyruktan silme, lease kontrolüyle tek transaction'da
+    outcome = complete_claimed_user(_lease_owner(), user_id, segmentation_result)
+    if outcome != "success":
+        forget_fingerprints([user_id])
+        print(f"⚠️ Kullanıcı {user_id} sonucu yazılmadı: {outcome}")
+        _progress("progress", "Skipped write_user_segmentation_result", step="write_user_segmentation_result", meta={"user_id": user_id, "outcome": outcome})
+        return outcome
     
     print(f"✅ Kullanıcı {user_id} segmentasyonu tamamlandı (state: success)")
-    # Throttle to avoid LLM QPS/RPM limits between tool calls
-    time.sleep(2.0)
+    store_segmentation_results({user_id: segmentation_result})
     
     _progress("success", "Finished write_user_segmentation_result", step="write_user_segmentation_result", meta={"user_id": user_id})
     return "success"
 
 
+class SegmentationResultItem(TypedDict):
+    """write_user_segmentation_results öğesi; ADK tool şemasında modele alan adları olarak gösterilir."""
+    user_id: str
+    segmentation_result: str
+
+
+def write_user_segmentation_results(results: list[SegmentationResultItem]):
+    """
+    Bir batch kullanıcının segmentasyon sonuçlarını tek çağrıda yazar (write_user_segmentation_result'ın
+    toplu hali, bekleme yok). Tüm upsert'ler ve kuyruk silmeleri lease kontrolüyle tek
+    transaction'da commit edilir (200 kullanıcıya kadar; üstü 200'lük transaction'lara bölünür).
+    
+    Args:
+        results (list[SegmentationResultItem]): [{"user_id": "...", "segmentation_result": "..."}, ...]
+        
+    Returns:
+        dict: {"status": "success" | "partial", "written": int, "lease_lost": [...], "not_claimed": [...]}
+    """
+    _progress("progress", "Starting write_user_segmentation_results", step="write_user_segmentation_results", meta={"count": len(results or [])})
+    print(f"🔍 write_user_segmentation_results çağrıldı: {len(results or [])} kullanıcı")
+    
+    segmentation_results = {}
+    for item in results or []:
+        user_id = str(item.get('user_id', '')).strip()
+        if user_id and item.get('segmentation_result'):
+            segmentation_results[user_id] = item['segmentation_result']
+    
+    outcome = complete_claimed_users(_lease_owner(), segmentation_results)
+    written = len(outcome['success'])
+    # Aynı feature'lara sahip sonraki kullanıcılar LLM'e gitmeden bu etiketleri alır
+    store_segmentation_results({user_id: segmentation_results[user_id] for user_id in outcome['success']})
+    skipped = outcome['lease_lost'] + outcome['not_claimed']
+    if skipped:
+        forget_fingerprints(skipped)
+        print(f"⚠️ {len(skipped)} kullanıcının sonucu yazılmadı (lease_lost={outcome['lease_lost']}, not_claimed={outcome['not_claimed']})")
+    print(f"✅ {written} kullanıcının segmentasyonu tamamlandı")
+    
+    _progress("success", "Finished write_user_segmentation_results", step="write_user_segmentation_results", meta={"written": written, "skipped": len(skipped)})
+    return {
+        "status": "success" if not skipped else "partial",
+        "written": written,
+        "lease_lost": outcome['lease_lost'],
+        "not_claimed": outcome['not_claimed']
+    }
+
+
 def write_segmentation_results_to_firestore(segmentation_results: dict):
     """
     Segmentation sonuçlarını Firestore'a batch olarak yazar.
@@ -518,6 +802,83 @@ def write_segmentation_location_pairs_to_firestore():
     return f"{written} segmentation documents upserted into 'segmentations' with underscore IDs"
 
 
+def segment_pending_users_with_rules():
+    """
+    Kuyruktaki kullanıcıları LLM kullanmadan, kural tabanlı segmentasyon motoruyla segmentler.
+    
+    Kullanıcılar SEGMENTATION_ENGINE_BATCH_SIZE'lık (varsayılan 2000) gruplar halinde lease ile
+    claim edilir, beş kriter kullanıcı başına tek feature satırı olarak BigQuery'de hesaplanır
+    (SEGMENTATION_FEATURES_SOURCE=python ise ham event/order satırları çekilip tek pandas
+    geçişinde hesaplanır) ve sonuçlar lease onayıyla toplu yazılır. SEGMENTATION_ENGINE_MAX_SECONDS
+    (varsayılan 300) ya da run'ın deadline'ı dolunca durur.
+    
+    Returns:
+        dict: {"status": "segmentation_finished" | "continue", "segmented": int,
+               "skipped": int, "pending_total": int}
+    """
+    _progress("progress", "Starting segment_pending_users_with_rules", step="segment_pending_users_with_rules")
+    print(f"🔍 segment_pending_users_with_rules çağrıldı")
+    
+    batch_size = max(1, int(os.getenv('SEGMENTATION_ENGINE_BATCH_SIZE', '2000')))
+    max_seconds = float(os.getenv('SEGMENTATION_ENGINE_MAX_SECONDS', '300'))
+    # Run'ın deadline'ı daha yakınsa onu aşma
+    max_seconds = min(max_seconds, remaining_seconds(max_seconds))
+    features_source = os.getenv('SEGMENTATION_FEATURES_SOURCE', 'bigquery').strip().lower()
+    owner = _lease_owner()
+    started = time.monotonic()
+    segmented = 0
+    skipped = 0
+    
+    while time.monotonic() - started < max_seconds:
+        user_ids = claim_pending_users(owner, limit=batch_size)
+        if not user_ids:
+            break
+        if features_source == 'python':
+            events_table, orders_table = fetch_user_history_tables(user_ids)
+            labels = segment_users(events_table, orders_table, user_ids)
+        else:
+            # Feature'lar BigQuery'de hesaplanır; kullanıcı başına tek satır iner
+            labels = format_segment_labels(features_from_rows(fetch_segment_features(user_ids), user_ids)).to_dict()
+        outcome = complete_claimed_users(owner, labels)
+        segmented += len(outcome['success'])
+        skipped += len(outcome['lease_lost']) + len(outcome['not_claimed'])
+        elapsed = time.monotonic() - started
+        print(f"   ✅ {segmented} kullanıcı segmentlendi ({segmented / max(elapsed, 1e-9):.0f} kullanıcı/sn)")
+        _progress("progress", "Segmenting users with rules", step="segment_pending_users_with_rules", meta={
+            "segmented": segmented,
+            "skipped": skipped,
+            "batch": len(user_ids),
+            "elapsed_seconds": round(elapsed, 1),
+        })
+    
+    try:
+        pending_total = get_pending_total()
+    except Exception as e:
+        print(f"⚠️ pending_total hesaplanamadı: {e}")
+        pending_total = 0
+    status = "continue" if pending_total > 0 else "segmentation_finished"
+    
+    print(f"✅ Kural tabanlı segmentasyon: {segmented} kullanıcı, kalan pending: {pending_total}")
+    _progress("success", "Finished segment_pending_users_with_rules", step="segment_pending_users_with_rules", meta={"segmented": segmented, "skipped": skipped, "pending_total": pending_total})
+    return {
+        "status": status,
+        "segmented": segmented,
+        "skipped": skipped,
+        "pending_total": pending_total
+    }
+
+
+# SEGMENTATION_MODE=rules: STEP 3-5 (LLM ile 5'er kullanıcı) yerine kural tabanlı motor kullanılır
+SEGMENTATION_MODE = os.getenv('SEGMENTATION_MODE', 'llm').strip().lower()
+
+RULES_MODE_INSTRUCTION = """
+=== RULE-BASED SEGMENTATION MODE (ACTIVE) ===
+STEP 3, STEP 4 and STEP 5 are replaced by ONE tool call:
+  call segment_pending_users_with_rules() and return ONLY {"status": <its status>}.
+Do NOT call read_users_to_segmentate, write_user_segmentation_result or write_user_segmentation_results in this mode.
+"""
+
+
 DATA_ANALYTIC_AGENT_INSTRUCTION = """
 You are the Data Analytic Agent. You execute ALL BigQuery/Firestore operations without user interaction.
 Return only the minimal JSON/status expected by the master.
@@ -536,6 +897,8 @@ Return only the minimal JSON/status expected by the master.
       "table": "anonc4ca20ccc0ea49af9846718f5a1779f8e..."
     }
   }
+→ NOTE: data_reference may contain extra keys (mode, watermark, delta_table). Always pass the WHOLE
+  dict unchanged to compare_event_counts and write_user_activity_to_firestore.
 → What it does internally:
   • Queries BOTH `adgen_bq.user_events` AND `adgen_bq.user_orders` tables
   • Uses FULL OUTER JOIN to combine both datasets
@@ -584,25 +947,34 @@ Return only the minimal JSON/status expected by the master.
     }
 
 📊 Tool 3: read_users_to_segmentate()
-→ Purpose: Get 10 pending users and their events/orders from BigQuery
+→ Purpose: Claim up to 5 queued users and get their events/orders from BigQuery
 → Parameters: NONE
 → Returns: dict with status and users array
 → What it does internally:
-  • Queries Firestore for state=pending users (limit: 20)
-  • For each user, queries BigQuery for:
-    - All events from user_events table
-    - All orders from user_orders table
-  • Returns structured data: {user_id, events: [...], orders: [...]}
+  • Claims pending (or lease-expired) users in a Firestore transaction: state = 'processing' with a lease owned by this worker
+  • output="summary" (default): one compact digest per user computed in BigQuery:
+    {user_id, total_spent, order_count, top_categories: {category: views}, event_counts: {event_name: count},
+     last_session: {location, gift_wrap, cart_abandonment, different_location}}
+  • output="raw": {user_id, events: [...], orders: [...]} with every event/order record
+  • The result is kept under a fixed token budget; users that do not fit are returned to the queue
 
 💾 Tool 4: write_user_segmentation_result(user_id: str, segmentation_result: str)
 → Purpose: Save segmentation result and mark user as complete
 → Parameters:
   • user_id (str): User ID
   • segmentation_result (str): Segmentation category/result
-→ Returns: Confirmation message
+→ Returns: "success", or "lease_lost" / "not_claimed" if this worker no longer owns the user (result is not written; just move on)
+→ What it does internally:
+  • Confirms the lease, writes to 'user_segmentations' collection: {user_id, segmentation_result, updated_at}
+  • Removes the user from 'users_to_segmentate' in the same transaction
+
+💾 Tool 4b: write_user_segmentation_results(results: list)
+→ Purpose: Save the results of the WHOLE batch in one call (preferred over calling Tool 4 per user)
+→ Parameters:
+  • results (list): [{"user_id": "...", "segmentation_result": "..."}, ...]
+→ Returns: {"status": "success" | "partial", "written", "lease_lost": [...], "not_claimed": [...]}
 → What it does internally:
-  • Writes to 'user_segmentations' collection: {user_id, segmentation_result, updated_at}
-  • Updates 'users_to_segmentate' document: state = 'success', completed_at = <timestamp>
+  • Confirms the leases, upserts 'user_segmentations' and removes the users from 'users_to_segmentate' in one transaction
 
 💾 Tool 5: write_segmentation_results_to_firestore(segmentation_results: dict)
 → Purpose: Write user segmentation analysis results to Firestore
@@ -613,6 +985,12 @@ Return only the minimal JSON/status expected by the master.
   • Writes results to 'segmentation_results' collection
   • Document ID: 'latest_batch'
 
+🧮 Tool 6: segment_pending_users_with_rules()
+→ Purpose: Segment the whole pending queue deterministically (no AI analysis), same label format as STEP 4.2
+→ Parameters: NONE
+→ Returns: {"status": "segmentation_finished" | "continue", "segmented", "skipped", "pending_total"}
+→ Only used in rule-based segmentation mode (see the end of this instruction)
+
 === MAIN SEGMENTATION WORKFLOW (STRICT) ===
 A. Master agent transfers control to you; perform end-to-end automatically.
 
@@ -650,16 +1028,19 @@ Step 4.1.3. Based on gift wrap in last session. Yes or No
 Step 4.1.4. Based on shopping cart abandonment in last session. Yes or No
 Step 4.1.5. Based on different location in last session. Yes or No 
 Step 4.2. Expected result schema is totalSpentLow-mostViewedCategoryTech-giftWrapYes-cartAbandonmentNo-differentLocationYes
+Step 4.3. With output="summary", use the digest fields directly: total_spent → 4.1.1, the first key of
+top_categories (electronics = Tech) → 4.1.2, last_session.gift_wrap / cart_abandonment / different_location → 4.1.3-4.1.5.
 
 
 
 
-STEP 5: For each user, call write_user_segmentation_result(user_id, result)
-  You:
-  1. Write result to 'user_segmentations' collection
-  2. Mark user as 'success' in 'users_to_segmentate'
-  3. Return confirmation
-After you finish writing results for up to 5 users in this batch, immediately compute the final status (using pending_total from STEP 3) and STOP. Do not produce extra prose or make additional calls; proceed directly to STEP 6.
+STEP 5: Call write_user_segmentation_results ONCE with the results of ALL users in this batch:
+  write_user_segmentation_results([{"user_id": "...", "segmentation_result": "..."}, ...])
+  It:
+  1. Writes every result to 'user_segmentations'
+  2. Removes the users from 'users_to_segmentate' (only those this worker still holds the lease for)
+  3. Returns one summary (users reported as lease_lost / not_claimed were handled elsewhere; just move on)
+After this single call, immediately compute the final status (using pending_total from STEP 3) and STOP. Do not produce extra prose or make additional calls; proceed directly to STEP 6.
 
 
 STEP 6 (FINAL RETURN FORMAT - STRICT):
@@ -708,10 +1089,10 @@ Senior data analyst. Has full control over the bigquery and firestore of the adg
 """
 
 data_analytic_agent = Agent(
-    model='gemini-2.5-pro', 
+    model=gemini_model('gemini-2.5-pro'),
     name='data_analytic_agent',
     description="Retrieves events from the bigquery table 'user_events' and tidies them up based on the request",
-    instruction=DATA_ANALYTIC_AGENT_INSTRUCTION,
+    instruction=DATA_ANALYTIC_AGENT_INSTRUCTION + (RULES_MODE_INSTRUCTION if SEGMENTATION_MODE == 'rules' else ""),
     tools=[
         retrieve_user_activity_counts,
         write_user_activity_to_firestore,
@@ -719,9 +1100,14 @@ data_analytic_agent = Agent(
         compare_event_counts,
         read_users_to_segmentate,
         write_user_segmentation_result,
+        write_user_segmentation_results,
         write_segmentation_results_to_firestore,
         write_segmentation_location_pairs_to_firestore,
+        segment_pending_users_with_rules,
     ],
+    # LLM istekleri paylaşılan RPM/TPM limiter'ından geçer (rate_limiter.py)
+    before_model_callback=before_model_rate_limit,
+    after_model_callback=after_model_rate_limit,
 )
 
 # Bu modülde yalnızca alt ajan tanımlanır; root ajan MasterAgent tarafında belirlenir.
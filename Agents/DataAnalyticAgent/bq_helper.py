@@ -1,57 +1,152 @@
 from google.cloud import bigquery
-from google.oauth2 import service_account
 import os
-import json
-import base64
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+from clients import get_bigquery_client, get_bigquery_storage_client
+# Arrow → Python kayıt dönüşümleri (toplu timestamp/int çevrimi)
+from .arrow_records import arrow_column_to_pylist, arrow_group_records, arrow_to_nested_dict, arrow_to_records
 
 def bq_to_dataframe(query: str, project_id: str = None, credentials=None, location: str = None):
     import pandas as pd
 
-    # .env'den project_id'yi al
-    if project_id is None:
-        project_id = os.getenv('GCP_PROJECT_ID', 'eighth-upgrade-475017-u5')
-    
-    # BigQuery client configuration - prioritize environment-based credentials for Cloud Run
-    client_args = {'project': project_id}
-    
-    # Check for explicit credentials parameter first
-    if credentials is not None:
-        client_args['credentials'] = credentials
-    else:
-        # Try environment-based service account JSON (Cloud Run compatible)
-        sa_json = os.getenv('GCP_SERVICE_ACCOUNT_JSON') or os.getenv('GCP_SERVICE_ACCOUNT_JSON_BQ')
-        if sa_json:
-            try:
-                info = json.loads(sa_json) if sa_json.strip().startswith('{') else json.loads(base64.b64decode(sa_json).decode('utf-8'))
-                client_args['credentials'] = service_account.Credentials.from_service_account_info(
-                    info,
-                    scopes=[
-                        'https://www.googleapis.com/auth/bigquery',
-                        'https://www.googleapis.com/auth/cloud-platform',
-                    ],
-                )
-            except Exception:
-                pass
-        else:
-            # Fallback to file-based credentials (local development only)
-            bq_key_path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS_BQ') or os.getenv('BQ_KEYFILE')
-            if bq_key_path and os.path.exists(bq_key_path):
-                client_args['credentials'] = service_account.Credentials.from_service_account_file(
-                    bq_key_path,
-                    scopes=[
-                        'https://www.googleapis.com/auth/bigquery',
-                        'https://www.googleapis.com/auth/cloud-platform',
-                    ],
-                )
-        # If no explicit credentials found, use default Cloud Run service account (ADC)
-
-    client = bigquery.Client(**client_args)
+    # Process-wide pooled client; credentials are resolved (and parsed) once per
+    # distinct service account config: explicit credentials > GCP_SERVICE_ACCOUNT_JSON(_BQ)
+    # > GOOGLE_APPLICATION_CREDENTIALS_BQ/BQ_KEYFILE > ADC (Cloud Run default service account)
+    client = get_bigquery_client(project_id, credentials=credentials)
     # Location zorunluysa (özellikle temp dataset farklı region'da oluşturulduysa)
     query_job = client.query(query, location=location)
     results = query_job.result()
     df = results.to_dataframe()
     return df
 
+def _storage_read_client(use_storage_api: bool, credentials=None):
+    """Storage Read API client, or None if disabled/not installed (REST fallback)."""
+    if not use_storage_api:
+        return None
+    try:
+        return get_bigquery_storage_client(credentials)
+    except ImportError:
+        print("ℹ️ google-cloud-bigquery-storage yüklü değil, REST pager kullanılacak")
+        return None
+
+
+def _table_id(data_reference: dict) -> str:
+    return f"{data_reference['project']}.{data_reference['dataset']}.{data_reference['table']}"
+
+
+def _row_source(client, query: str = None, data_reference: dict = None, columns: list = None, location: str = None, query_parameters: list = None):
+    """
+    Sorgu ya da doğrudan tablo referansı için yeni bir RowIterator üreten fonksiyon döner.
+    Tablo referansında sorgu job'ı çalışmaz; sadece istenen kolonlar okunur. Sorgu bir kez
+    gönderilir; Storage Read API başarısız olduğunda REST pager'a dönüş aynı sonucu okur.
+    """
+    if data_reference:
+        table = client.get_table(_table_id(data_reference))
+        selected_fields = None
+        if columns:
+            selected_fields = [field for field in table.schema if field.name in set(columns)]
+        return lambda: client.list_rows(table, selected_fields=selected_fields)
+    job_config = bigquery.QueryJobConfig(query_parameters=query_parameters) if query_parameters else None
+    query_job = client.query(query, job_config=job_config, location=location)
+    # İlk result() job'ı bekler; tamamlanmış job'da tekrar çağrılması sorguyu yeniden
+    # çalıştırmaz, aynı sonuç tablosunu baştan okuyan yeni bir RowIterator döner
+    return query_job.result
+
+
+def bq_to_arrow(
+    query: str = None,
+    *,
+    data_reference: dict = None,
+    columns: list = None,
+    project_id: str = None,
+    credentials=None,
+    location: str = None,
+    use_storage_api: bool = True,
+    query_parameters: list = None,
+):
+    """
+    Sorgu sonucunu (ya da temp tabloyu) pyarrow.Table olarak döner.
+
+    BigQuery Storage Read API kullanılabiliyorsa sonuç paralel Arrow stream'leri
+    ile indirilir; kütüphane yoksa veya read session açılamazsa REST pager'a düşer.
+
+    Args:
+        query: Çalıştırılacak SQL (data_reference verilmediyse zorunlu)
+        data_reference: {project, dataset, table, location?} - tabloyu sorgusuz okur
+        columns: data_reference ile okunacak kolonlar (varsayılan: hepsi)
+        use_storage_api: False ise doğrudan REST pager kullanılır
+        query_parameters: bigquery.ScalarQueryParameter / ArrayQueryParameter listesi
+    """
+    if data_reference:
+        location = location or data_reference.get('location')
+    client = get_bigquery_client(project_id, credentials=credentials)
+    row_source = _row_source(client, query, data_reference, columns, location, query_parameters)
+    rows = row_source()
+    bqstorage_client = _storage_read_client(use_storage_api, credentials)
+    if bqstorage_client is not None:
+        try:
+            return rows.to_arrow(bqstorage_client=bqstorage_client, create_bqstorage_client=False)
+        except Exception as e:
+            print(f"⚠️ Storage Read API başarısız, REST pager'a dönülüyor: {e}")
+            rows = row_source()
+    return rows.to_arrow(create_bqstorage_client=False)
+
+
+def bq_iter_record_batches(
+    query: str = None,
+    *,
+    data_reference: dict = None,
+    columns: list = None,
+    project_id: str = None,
+    credentials=None,
+    location: str = None,
+    use_storage_api: bool = True,
+    max_queue_size: int = 2,
+    query_parameters: list = None,
+):
+    """
+    Sorgu sonucunu (ya da temp tabloyu) pyarrow.RecordBatch generator'ı olarak stream eder.
+
+    Bellekte aynı anda yalnızca birkaç batch tutulur (max_queue_size), böylece
+    milyonlarca satır sabit bellekle işlenebilir. Storage Read API ilk batch
+    gelmeden başarısız olursa REST pager'a düşülür.
+
+    Yields:
+        pyarrow.RecordBatch
+    """
+    if data_reference:
+        location = location or data_reference.get('location')
+    client = get_bigquery_client(project_id, credentials=credentials)
+    row_source = _row_source(client, query, data_reference, columns, location, query_parameters)
+    rows = row_source()
+    bqstorage_client = _storage_read_client(use_storage_api, credentials)
+    if bqstorage_client is not None:
+        yielded = False
+        try:
+            for batch in rows.to_arrow_iterable(bqstorage_client=bqstorage_client, max_queue_size=max_queue_size):
+                yielded = True
+                yield batch
+            return
+        except Exception as e:
+            if yielded:
+                raise
+            print(f"⚠️ Storage Read API başarısız, REST pager'a dönülüyor: {e}")
+            rows = row_source()
+    yield from rows.to_arrow_iterable()
+
+
+def run_query(query: str, *, query_parameters: list = None, project_id: str = None, location: str = None):
+    """
+    Sorgu ya da multi-statement script çalıştırır ve tamamlanan QueryJob'ı döner.
+    Parametreler bigquery.ScalarQueryParameter / ArrayQueryParameter listesi olarak verilir.
+    """
+    client = get_bigquery_client(project_id)
+    job_config = bigquery.QueryJobConfig(query_parameters=query_parameters or [])
+    query_job = client.query(query, job_config=job_config, location=location)
+    query_job.result()
+    return query_job
+
+
 def query_to_temp_table(query: str, temp_table_name: str = None, project_id: str = None, dataset_id: str = None):
     """
     BigQuery query çalıştırır ve BigQuery'nin otomatik oluşturduğu temporary table referansını döner.
@@ -65,40 +160,7 @@ def query_to_temp_table(query: str, temp_table_name: str = None, project_id: str
     Returns:
         dict: Temporary table referansı içeren dictionary
     """
-    if project_id is None:
-        project_id = os.getenv('GCP_PROJECT_ID', 'eighth-upgrade-475017-u5')
-    
-    # Credential setup - prioritize environment-based credentials for Cloud Run
-    client_args = {'project': project_id}
-    
-    # Try environment-based service account JSON first (Cloud Run compatible)
-    sa_json = os.getenv('GCP_SERVICE_ACCOUNT_JSON') or os.getenv('GCP_SERVICE_ACCOUNT_JSON_BQ')
-    if sa_json:
-        try:
-            info = json.loads(sa_json) if sa_json.strip().startswith('{') else json.loads(base64.b64decode(sa_json).decode('utf-8'))
-            client_args['credentials'] = service_account.Credentials.from_service_account_info(
-                info,
-                scopes=[
-                    'https://www.googleapis.com/auth/bigquery',
-                    'https://www.googleapis.com/auth/cloud-platform',
-                ],
-            )
-        except Exception:
-            pass
-    else:
-        # Fallback to file-based credentials (local development only)
-        bq_key_path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS_BQ') or os.getenv('BQ_KEYFILE')
-        if bq_key_path and os.path.exists(bq_key_path):
-            client_args['credentials'] = service_account.Credentials.from_service_account_file(
-                bq_key_path,
-                scopes=[
-                    'https://www.googleapis.com/auth/bigquery',
-                    'https://www.googleapis.com/auth/cloud-platform',
-                ],
-            )
-    # If no explicit credentials found, use default Cloud Run service account (ADC)
-
-    client = bigquery.Client(**client_args)
+    client = get_bigquery_client(project_id)
     
     print(f"📊 Query çalıştırılıyor (BigQuery otomatik temp table oluşturacak)...")
     
@@ -0,0 +1,95 @@
+"""
+Columnar Parquet snapshots of user activity counts in GCS.
+
+With ACTIVITY_SNAPSHOT_BACKEND=parquet the snapshot is written as one
+compressed Parquet file (user_id dictionary-encoded, event_count/order_count
+int32, sorted by user_id) and Firestore only holds a small pointer document.
+Reading it back yields Arrow arrays, so the diff can run vectorised instead of
+over a dict of dicts.
+
+Env:
+    ACTIVITY_SNAPSHOT_BUCKET   target bucket (required for this backend)
+    ACTIVITY_SNAPSHOT_PREFIX   object prefix (default 'activity_snapshots')
+"""
+
+import io
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+from clients import get_storage_client
+
+
+def _bucket_name() -> str:
+    bucket = os.getenv('ACTIVITY_SNAPSHOT_BUCKET')
+    if not bucket:
+        raise ValueError("ACTIVITY_SNAPSHOT_BUCKET must be set when ACTIVITY_SNAPSHOT_BACKEND=parquet")
+    return bucket
+
+
+def normalize_activity_table(table):
+    """
+    Arrow tablosunu snapshot şemasına çevirir: user_id string, sayılar int32 (null → 0),
+    user_id'ye göre sıralı. Sıralı id'ler vektörel merge-diff için hazır olur.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    user_id = pc.cast(table.column('user_id'), pa.string())
+    event_count = pc.cast(pc.fill_null(table.column('event_count'), 0), pa.int32())
+    order_count = pc.cast(pc.fill_null(table.column('order_count'), 0), pa.int32())
+    normalized = pa.table({'user_id': user_id, 'event_count': event_count, 'order_count': order_count})
+    return normalized.sort_by([('user_id', 'ascending')])
+
+
+def write_parquet_snapshot(table, doc_id: str) -> dict:
+    """
+    Snapshot tablosunu zstd sıkıştırmalı Parquet olarak GCS'e yazar.
+
+    Returns:
+        dict: {"uri": "gs://...", "total_users": int, "bytes": int}
+    """
+    import pyarrow.parquet as pq
+
+    normalized = normalize_activity_table(table)
+    buffer = io.BytesIO()
+    pq.write_table(
+        normalized,
+        buffer,
+        compression='zstd',
+        use_dictionary=['user_id'],
+    )
+    payload = buffer.getvalue()
+
+    bucket = _bucket_name()
+    prefix = os.getenv('ACTIVITY_SNAPSHOT_PREFIX', 'activity_snapshots').strip('/')
+    object_name = f"{prefix}/{doc_id}.parquet"
+    blob = get_storage_client().bucket(bucket).blob(object_name)
+    blob.upload_from_string(payload, content_type='application/vnd.apache.parquet')
+    uri = f"gs://{bucket}/{object_name}"
+    print(f"✅ Parquet snapshot yüklendi: {uri} ({len(payload)} bytes, {normalized.num_rows} kullanıcı)")
+    return {"uri": uri, "total_users": normalized.num_rows, "bytes": len(payload)}
+
+
+def read_parquet_snapshot(uri: str):
+    """gs:// URI'deki snapshot'ı pyarrow.Table olarak okur (user_id dictionary-encoded)."""
+    import pyarrow.parquet as pq
+
+    if not uri.startswith("gs://"):
+        raise ValueError(f"Expected gs:// URI, got: {uri}")
+    bucket, _, object_name = uri[len("gs://"):].partition("/")
+    payload = get_storage_client().bucket(bucket).blob(object_name).download_as_bytes()
+    return pq.read_table(io.BytesIO(payload), read_dictionary=['user_id'])
+
+
+def activity_table_to_dict(table) -> dict:
+    """Arrow snapshot'ı get_past_events_from_firestore'un {user_id: {...}} formatına çevirir."""
+    import pyarrow.compute as pc
+
+    user_ids = pc.cast(table.column('user_id'), 'string').to_pylist()
+    event_counts = table.column('event_count').to_pylist()
+    order_counts = table.column('order_count').to_pylist()
+    return {
+        user_id: {'event_count': event_count, 'order_count': order_count}
+        for user_id, event_count, order_count in zip(user_ids, event_counts, order_counts)
+    }
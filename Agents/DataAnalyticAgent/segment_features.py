@@ -0,0 +1,193 @@
+"""
+Segmentation feature extraction pushed down into BigQuery.
+
+Instead of downloading every event/order row of the users being segmented,
+one query computes a compact feature row per user inside BigQuery:
+
+  user_id, total_spent, order_count, category_views ARRAY<STRUCT<category, views>>,
+  most_viewed_category, event_counts ARRAY<STRUCT<event_name, events>>,
+  last_session_id, last_session_location, gift_wrap, cart_abandonment,
+  different_location
+
+The last session is found with a window over (user_id ORDER BY event_time);
+session-level flags are aggregated per (user_id, session_id). The rules match
+segmentation_engine.compute_segment_features, so either source produces the
+same labels.
+
+Tables (dataset = BQ_DATASET, default 'adgen_bq'): user_events, user_orders.
+"""
+
+import os
+
+from google.cloud import bigquery
+
+from .bq_helper import bq_to_arrow
+
+
+_GIFT_TRUE = r'"gift"\s*:\s*true'
+_CATEGORY_IN_PAYLOAD = r'"(?:category|slug)"\s*:\s*"([^"]+)"'
+_CATEGORY_IN_PATH = r'^/category/([^/?#]+)'
+
+
+def _dataset() -> str:
+    return os.getenv('BQ_DATASET', 'adgen_bq')
+
+
+def build_segment_features_sql() -> str:
+    """@user_ids (ARRAY<STRING>) için kullanıcı başına tek feature satırı döndüren sorgu."""
+    dataset = _dataset()
+    return f"""
+    WITH ev AS (
+      SELECT
+        user_id, session_id, event_name, event_time, path_name, payload, event_location,
+        FIRST_VALUE(session_id) OVER (
+          PARTITION BY user_id ORDER BY event_time DESC, session_id DESC
+        ) AS last_session_id
+      FROM `{dataset}.user_events`
+      WHERE user_id IN UNNEST(@user_ids)
+    ),
+    orders AS (
+      SELECT user_id, session_id, products_payload, paid_amount
+      FROM `{dataset}.user_orders`
+      WHERE user_id IN UNNEST(@user_ids)
+    ),
+    category_views AS (
+      SELECT user_id, LOWER(category) AS category, COUNT(*) AS views
+      FROM (
+        SELECT
+          user_id,
+          CASE
+            WHEN event_name = 'category_click' THEN REGEXP_EXTRACT(payload, r'{_CATEGORY_IN_PAYLOAD}')
+            WHEN event_name = 'page_view' THEN REGEXP_EXTRACT(path_name, r'{_CATEGORY_IN_PATH}')
+          END AS category
+        FROM ev
+      )
+      WHERE category IS NOT NULL
+      GROUP BY user_id, category
+    ),
+    histogram AS (
+      SELECT user_id, ARRAY_AGG(STRUCT(category, views) ORDER BY views DESC, category) AS category_views
+      FROM category_views
+      GROUP BY user_id
+    ),
+    event_counts AS (
+      SELECT user_id, ARRAY_AGG(STRUCT(event_name, events) ORDER BY events DESC, event_name) AS event_counts
+      FROM (
+        SELECT user_id, event_name, COUNT(*) AS events
+        FROM ev
+        GROUP BY user_id, event_name
+      )
+      GROUP BY user_id
+    ),
+    sessions AS (
+      SELECT
+        user_id,
+        session_id,
+        LOGICAL_OR(session_id = last_session_id) AS is_last,
+        -- segmentation_engine._normalize_location ile aynı: trim + lower, boş konum = NULL (atlanır)
+        ARRAY_AGG(NULLIF(LOWER(TRIM(event_location)), '') IGNORE NULLS ORDER BY event_time DESC LIMIT 1)[SAFE_OFFSET(0)] AS location,
+        LOGICAL_OR(event_name = 'cart_add') AS cart_add,
+        LOGICAL_OR(event_name = 'checkout_success') AS checkout_success,
+        LOGICAL_OR(
+          event_name IN ('cart_gift_toggle', 'checkout_success')
+          AND REGEXP_CONTAINS(IFNULL(payload, ''), r'{_GIFT_TRUE}')
+        ) AS gift_event
+      FROM ev
+      GROUP BY user_id, session_id
+    ),
+    last_session AS (
+      SELECT * FROM sessions WHERE is_last
+    ),
+    usual_location AS (
+      SELECT user_id, location
+      FROM (
+        SELECT
+          user_id,
+          location,
+          ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY COUNT(*) DESC, location) AS location_rank
+        FROM sessions
+        WHERE NOT is_last AND location IS NOT NULL
+        GROUP BY user_id, location
+      )
+      WHERE location_rank = 1
+    ),
+    spent AS (
+      SELECT user_id, SUM(paid_amount) AS total_spent, COUNT(*) AS order_count
+      FROM orders
+      GROUP BY user_id
+    ),
+    last_orders AS (
+      SELECT
+        o.user_id,
+        LOGICAL_OR(REGEXP_CONTAINS(IFNULL(o.products_payload, ''), r'{_GIFT_TRUE}')) AS gift_order
+      FROM orders o
+      JOIN last_session l ON o.user_id = l.user_id AND o.session_id = l.session_id
+      GROUP BY o.user_id
+    )
+    SELECT
+      u AS user_id,
+      ROUND(IFNULL(s.total_spent, 0), 2) AS total_spent,
+      IFNULL(s.order_count, 0) AS order_count,
+      h.category_views,
+      h.category_views[SAFE_OFFSET(0)].category AS most_viewed_category,
+      e.event_counts,
+      l.session_id AS last_session_id,
+      l.location AS last_session_location,
+      IFNULL(l.gift_event, FALSE) OR IFNULL(lo.gift_order, FALSE) AS gift_wrap,
+      IFNULL(l.cart_add, FALSE)
+        AND NOT (IFNULL(l.checkout_success, FALSE) OR lo.user_id IS NOT NULL) AS cart_abandonment,
+      IFNULL(l.location IS NOT NULL AND ul.location IS NOT NULL AND l.location != ul.location, FALSE) AS different_location
+    FROM UNNEST(@user_ids) AS u
+    LEFT JOIN spent s ON s.user_id = u
+    LEFT JOIN histogram h ON h.user_id = u
+    LEFT JOIN event_counts e ON e.user_id = u
+    LEFT JOIN last_session l ON l.user_id = u
+    LEFT JOIN last_orders lo ON lo.user_id = u
+    LEFT JOIN usual_location ul ON ul.user_id = u
+    """
+
+
+def fetch_segment_features(user_ids: list):
+    """
+    Kullanıcı başına feature satırlarını BigQuery'de hesaplar ve pyarrow.Table olarak döner.
+    Ham event/order satırları process'e inmez.
+    """
+    user_ids = [str(u) for u in user_ids]
+    params = [bigquery.ArrayQueryParameter('user_ids', 'STRING', user_ids)]
+    return bq_to_arrow(build_segment_features_sql(), query_parameters=params)
+
+
+def build_feature_digests(rows, user_ids: list, *, top_categories: int = 3, top_events: int = 8) -> list:
+    """
+    Feature satırlarını LLM'e gidecek sabit boyutlu kullanıcı özetlerine çevirir.
+
+    Her özet kullanıcının aktivitesinden bağımsız olarak en fazla top_categories kategori ve
+    top_events event tipi içerir; ham payload'lar hiç yer almaz.
+
+    Returns:
+        list: [{"user_id", "total_spent", "order_count", "top_categories": {kategori: görüntülenme},
+                "event_counts": {event_name: adet}, "last_session": {"location", "gift_wrap",
+                "cart_abandonment", "different_location"}}, ...] (user_ids sırasıyla)
+    """
+    from .arrow_records import arrow_to_records
+
+    by_user = {str(row['user_id']): row for row in arrow_to_records(rows)}
+    digests = []
+    for user_id in (str(u) for u in user_ids):
+        row = by_user.get(user_id, {})
+        categories = row.get('category_views') or []
+        events = row.get('event_counts') or []
+        digests.append({
+            'user_id': user_id,
+            'total_spent': float(row.get('total_spent') or 0),
+            'order_count': int(row.get('order_count') or 0),
+            'top_categories': {c['category']: int(c['views']) for c in categories[:top_categories]},
+            'event_counts': {e['event_name']: int(e['events']) for e in events[:top_events]},
+            'last_session': {
+                'location': row.get('last_session_location'),
+                'gift_wrap': bool(row.get('gift_wrap')),
+                'cart_abandonment': bool(row.get('cart_abandonment')),
+                'different_location': bool(row.get('different_location')),
+            },
+        })
+    return digests
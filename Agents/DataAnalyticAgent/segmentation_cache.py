@@ -0,0 +1,354 @@
+"""
+Memoisation of LLM segmentation results by feature fingerprint.
+
+Users whose segmentation inputs are identical (spend bucket, most viewed
+category and the three last-session flags) get the same label, so the label
+produced once by the LLM is reused for every later user with the same
+fingerprint and those users never reach the LLM.
+
+The fingerprint is a SHA-256 over the canonical JSON of the bucketed feature
+vector plus SEGMENTATION_CACHE_VERSION (bump it when the segmentation
+instruction changes to invalidate old entries).
+
+Backends (SEGMENTATION_CACHE_BACKEND):
+  memory     in-process LRU with TTL (default)
+  sqlite     memory LRU in front of a local SQLite file (SEGMENTATION_CACHE_SQLITE_PATH)
+  firestore  memory LRU in front of the 'segmentation_cache' collection
+  off        disabled
+Entries expire after SEGMENTATION_CACHE_TTL_SECONDS (default 86400); the
+memory layer holds at most SEGMENTATION_CACHE_MAX_ENTRIES (default 10000).
+Fingerprints of users sent to the LLM are remembered until their result is
+written or their claim is released, for at most the lease duration and the
+same entry limit.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional
+
+
+CACHE_COLLECTION = "segmentation_cache"
+
+FINGERPRINT_FIELDS = ("total_spent_label", "most_viewed_category", "gift_wrap", "cart_abandonment", "different_location")
+
+
+def feature_fingerprint(features: dict) -> str:
+    """Bucketed feature vector → stable hex fingerprint."""
+    vector = {field: features.get(field) for field in FINGERPRINT_FIELDS}
+    for flag in ("gift_wrap", "cart_abandonment", "different_location"):
+        vector[flag] = bool(vector[flag])
+    vector["version"] = os.getenv("SEGMENTATION_CACHE_VERSION", "1")
+    canonical = json.dumps(vector, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def feature_fingerprints(features) -> Dict[str, str]:
+    """segmentation_engine feature DataFrame'i (index=user_id) → {user_id: fingerprint}."""
+    records = features[list(FINGERPRINT_FIELDS)].to_dict("index")
+    return {str(user_id): feature_fingerprint(row) for user_id, row in records.items()}
+
+
+class MemoryCache:
+    """Thread-safe LRU with per-entry TTL."""
+
+    name = "memory"
+
+    def __init__(self, max_entries: int, ttl_seconds: int):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, fingerprints: Iterable[str]) -> Dict[str, str]:
+        now = time.time()
+        found = {}
+        with self._lock:
+            for fp in fingerprints:
+                entry = self._entries.get(fp)
+                if entry is None:
+                    continue
+                label, expires_at = entry
+                if expires_at <= now:
+                    del self._entries[fp]
+                    continue
+                self._entries.move_to_end(fp)
+                found[fp] = label
+        return found
+
+    def put_many(self, labels: Dict[str, str], expires_at: Optional[float] = None) -> None:
+        expires_at = expires_at or time.time() + self.ttl_seconds
+        with self._lock:
+            for fp, label in labels.items():
+                self._entries[fp] = (label, expires_at)
+                self._entries.move_to_end(fp)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SQLiteCache:
+    """Persisted entries in a local SQLite file (survives restarts of a single instance)."""
+
+    name = "sqlite"
+
+    def __init__(self, path: str, max_entries: int, ttl_seconds: int):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS segmentation_cache ("
+                " fingerprint TEXT PRIMARY KEY, label TEXT NOT NULL,"
+                " expires_at REAL NOT NULL, used_at REAL NOT NULL)"
+            )
+
+    def get_many(self, fingerprints: Iterable[str]) -> Dict[str, str]:
+        fingerprints = list(fingerprints)
+        if not fingerprints:
+            return {}
+        now = time.time()
+        placeholders = ",".join("?" * len(fingerprints))
+        with self._lock, self._conn:
+            rows = self._conn.execute(
+                f"SELECT fingerprint, label FROM segmentation_cache WHERE fingerprint IN ({placeholders}) AND expires_at > ?",
+                [*fingerprints, now],
+            ).fetchall()
+            if rows:
+                self._conn.executemany(
+                    "UPDATE segmentation_cache SET used_at = ? WHERE fingerprint = ?",
+                    [(now, fp) for fp, _ in rows],
+                )
+        return dict(rows)
+
+    def put_many(self, labels: Dict[str, str]) -> None:
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO segmentation_cache (fingerprint, label, expires_at, used_at) VALUES (?, ?, ?, ?)",
+                [(fp, label, now + self.ttl_seconds, now) for fp, label in labels.items()],
+            )
+            # Süresi dolanları sil, kalanları LRU ile max_entries'e indir
+            self._conn.execute("DELETE FROM segmentation_cache WHERE expires_at <= ?", (now,))
+            self._conn.execute(
+                "DELETE FROM segmentation_cache WHERE fingerprint NOT IN ("
+                " SELECT fingerprint FROM segmentation_cache ORDER BY used_at DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+
+
+class FirestoreCache:
+    """
+    Entries in the 'segmentation_cache' collection (doc id = fingerprint), shared
+    by every instance. expires_at is stored as a timestamp so a Firestore TTL
+    policy on that field can delete old entries server-side.
+    """
+
+    name = "firestore"
+
+    def __init__(self, ttl_seconds: int):
+        self.ttl_seconds = ttl_seconds
+
+    def _db(self):
+        from MasterAgent.firestore_helper import get_firestore_client
+        return get_firestore_client()
+
+    def get_many(self, fingerprints: Iterable[str]) -> Dict[str, str]:
+        from datetime import datetime, timezone
+
+        db = self._db()
+        refs = [db.collection(CACHE_COLLECTION).document(fp) for fp in fingerprints]
+        if not refs:
+            return {}
+        now = datetime.now(timezone.utc)
+        found = {}
+        for snap in db.get_all(refs):
+            if not snap.exists:
+                continue
+            data = snap.to_dict() or {}
+            expires_at = data.get("expires_at")
+            if expires_at is not None and expires_at <= now:
+                continue
+            if data.get("label"):
+                found[snap.id] = data["label"]
+        return found
+
+    def put_many(self, labels: Dict[str, str]) -> None:
+        from datetime import datetime, timedelta, timezone
+
+        db = self._db()
+        now = datetime.now(timezone.utc)
+        items = list(labels.items())
+        # WriteBatch en fazla 500 yazma alır
+        for start in range(0, len(items), 400):
+            batch = db.batch()
+            for fp, label in items[start:start + 400]:
+                batch.set(db.collection(CACHE_COLLECTION).document(fp), {
+                    "label": label,
+                    "updated_at": now,
+                    "expires_at": now + timedelta(seconds=self.ttl_seconds),
+                })
+            batch.commit()
+
+
+class SegmentationCache:
+    """Memory LRU, optionally in front of a persisted backend, with hit/miss counters."""
+
+    def __init__(self, memory: MemoryCache, backend=None):
+        self.memory = memory
+        self.backend = backend
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stored": 0, "backend_errors": 0}
+
+    @property
+    def name(self) -> str:
+        return self.backend.name if self.backend is not None else self.memory.name
+
+    def get_many(self, fingerprints: Iterable[str]) -> Dict[str, str]:
+        wanted = list(dict.fromkeys(fingerprints))
+        found = self.memory.get_many(wanted)
+        missing = [fp for fp in wanted if fp not in found]
+        if missing and self.backend is not None:
+            try:
+                persisted = self.backend.get_many(missing)
+            except Exception as e:
+                persisted = {}
+                self._backend_error()
+                print(f"⚠️ [segmentation_cache] {self.backend.name} read failed: {e}")
+            if persisted:
+                self.memory.put_many(persisted)
+                found.update(persisted)
+        return found
+
+    def _backend_error(self) -> None:
+        with self._lock:
+            self._stats["backend_errors"] += 1
+
+    def record_lookups(self, hits: int, misses: int) -> None:
+        with self._lock:
+            self._stats["hits"] += hits
+            self._stats["misses"] += misses
+
+    def put_many(self, labels: Dict[str, str]) -> None:
+        labels = {fp: label for fp, label in labels.items() if fp and label}
+        if not labels:
+            return
+        self.memory.put_many(labels)
+        if self.backend is not None:
+            try:
+                self.backend.put_many(labels)
+            except Exception as e:
+                self._backend_error()
+                print(f"⚠️ [segmentation_cache] {self.backend.name} write failed: {e}")
+        with self._lock:
+            self._stats["stored"] += len(labels)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {
+                "backend": self.name,
+                **self._stats,
+                "hit_rate": round(self._stats["hits"] / lookups, 4) if lookups else 0.0,
+                "memory_entries": len(self.memory),
+            }
+
+
+_cache: Optional[SegmentationCache] = None
+_cache_lock = threading.Lock()
+# LLM'e gönderilen (cache miss) kullanıcılar: user_id -> (fingerprint, son geçerlilik);
+# sonuç yazılınca cache'e eklenir, claim bırakılınca ya da lease süresi dolunca silinir
+_pending_fingerprints: "OrderedDict[str, tuple]" = OrderedDict()
+
+
+def get_segmentation_cache() -> Optional[SegmentationCache]:
+    """Process-wide cache from the environment; None when SEGMENTATION_CACHE_BACKEND=off."""
+    global _cache
+    backend_name = os.getenv("SEGMENTATION_CACHE_BACKEND", "memory").strip().lower()
+    if backend_name == "off":
+        return None
+    with _cache_lock:
+        if _cache is None:
+            ttl_seconds = int(os.getenv("SEGMENTATION_CACHE_TTL_SECONDS", "86400"))
+            max_entries = int(os.getenv("SEGMENTATION_CACHE_MAX_ENTRIES", "10000"))
+            backend = None
+            if backend_name == "sqlite":
+                path = os.getenv("SEGMENTATION_CACHE_SQLITE_PATH", "segmentation_cache.sqlite3")
+                backend = SQLiteCache(path, max_entries, ttl_seconds)
+            elif backend_name == "firestore":
+                backend = FirestoreCache(ttl_seconds)
+            _cache = SegmentationCache(MemoryCache(max_entries, ttl_seconds), backend)
+            print(f"🗃️ [segmentation_cache] backend={_cache.name}, ttl={ttl_seconds}s, max_entries={max_entries}")
+        return _cache
+
+
+def lookup_cached_labels(fingerprints: Dict[str, str]) -> Dict[str, str]:
+    """
+    {user_id: fingerprint} için cache'teki etiketleri döner ({user_id: label}).
+    Bulunamayan kullanıcıların fingerprint'i remember_fingerprints ile saklanmalıdır.
+    """
+    cache = get_segmentation_cache()
+    if cache is None or not fingerprints:
+        return {}
+    labels = cache.get_many(fingerprints.values())
+    hits = {user_id: labels[fp] for user_id, fp in fingerprints.items() if fp in labels}
+    cache.record_lookups(len(hits), len(fingerprints) - len(hits))
+    return hits
+
+
+def remember_fingerprints(fingerprints: Dict[str, str], ttl_seconds: float) -> None:
+    """
+    Claim edilen kullanıcıların fingerprint'ini sonuç yazılana kadar saklar. Kayıtlar
+    ttl_seconds (lease süresi) sonra düşer; en fazla SEGMENTATION_CACHE_MAX_ENTRIES tutulur.
+    """
+    now = time.monotonic()
+    max_entries = max(1, int(os.getenv("SEGMENTATION_CACHE_MAX_ENTRIES", "10000")))
+    with _cache_lock:
+        for user_id, fp in fingerprints.items():
+            _pending_fingerprints[user_id] = (fp, now + ttl_seconds)
+            _pending_fingerprints.move_to_end(user_id)
+        # Ekleme sırası = son geçerlilik sırası (ttl sabit); baştan süresi dolanlar ve fazlalar atılır
+        while _pending_fingerprints:
+            _, expires_at = next(iter(_pending_fingerprints.values()))
+            if expires_at > now and len(_pending_fingerprints) <= max_entries:
+                break
+            _pending_fingerprints.popitem(last=False)
+
+
+def forget_fingerprints(user_ids: Iterable[str]) -> None:
+    """Claim'i bırakılan / lease'i kaybedilen kullanıcıların fingerprint'ini siler."""
+    with _cache_lock:
+        for user_id in user_ids:
+            _pending_fingerprints.pop(user_id, None)
+
+
+def store_segmentation_results(segmentation_results: Dict[str, str]) -> int:
+    """
+    LLM'in yazdığı sonuçları, read sırasında hatırlanan fingerprint'leriyle cache'e ekler.
+    Returns: cache'e eklenen etiket sayısı.
+    """
+    cache = get_segmentation_cache()
+    now = time.monotonic()
+    with _cache_lock:
+        entries = {user_id: _pending_fingerprints.pop(user_id, None) for user_id in segmentation_results}
+    if cache is None:
+        return 0
+    labels = {entry[0]: segmentation_results[user_id] for user_id, entry in entries.items() if entry and entry[1] > now}
+    cache.put_many(labels)
+    return len(labels)
+
+
+def segmentation_cache_stats() -> dict:
+    cache = get_segmentation_cache()
+    if cache is None:
+        return {"backend": "off"}
+    with _cache_lock:
+        pending = len(_pending_fingerprints)
+    return {**cache.stats(), "pending_fingerprints": pending}
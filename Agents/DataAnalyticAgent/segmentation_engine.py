@@ -0,0 +1,248 @@
+"""
+Deterministic rule-based user segmentation.
+
+Computes the five criteria from DATA_ANALYTIC_AGENT_INSTRUCTION for a whole
+batch of users with grouped pandas/NumPy operations and emits the same label
+strings the LLM produces, e.g.
+
+    totalSpentLow-mostViewedCategoryTech-giftWrapYes-cartAbandonmentNo-differentLocationYes
+
+Rules:
+  totalSpent           sum(paid_amount): Low < 500 <= Medium < 2500 <= High < 10000 <= Extreme
+  mostViewedCategory   most frequent category among category_click payloads and
+                       /category/<slug> page views (ties: alphabetical); None if no views
+  giftWrap             last session has a gift=true cart_gift_toggle / checkout_success,
+                       or its order has a gift item
+  cartAbandonment      last session has cart_add but no checkout_success and no order
+  differentLocation    last session location differs from the user's most frequent
+                       location over earlier sessions (No when there is no earlier session)
+
+The last session is the session of the user's most recent event. The same
+features can be computed inside BigQuery (segment_features) and turned into
+labels with features_from_rows.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+SPENT_BINS = [-np.inf, 500, 2500, 10000, np.inf]
+SPENT_LABELS = ["Low", "Medium", "High", "Extreme"]
+
+# Mağaza kategori slug'ı -> etiket (instruction'daki books|tech|fashion|... listesi)
+CATEGORY_LABELS = {
+    "electronics": "Tech",
+    "tech": "Tech",
+    "fashion": "Fashion",
+    "home": "Home",
+    "sports": "Sports",
+    "beauty": "Beauty",
+    "toys": "Toys",
+    "books": "Books",
+    "grocery": "Grocery",
+    "pets": "Pets",
+    "automotive": "Automotive",
+}
+NO_CATEGORY = "None"
+
+# RE2 (pyarrow.compute) desenleri
+_GIFT_TRUE = r'"gift"\s*:\s*true'
+_CATEGORY_IN_PAYLOAD = r'"(?:category|slug)"\s*:\s*"(?P<value>[^"]+)"'
+_CATEGORY_IN_PATH = r'^/category/(?P<value>[^/?#]+)'
+
+EVENT_COLUMNS = ["user_id", "session_id", "event_name", "event_time", "path_name", "payload", "event_location"]
+ORDER_COLUMNS = ["user_id", "session_id", "products_payload", "paid_amount"]
+
+
+def _frame(data, columns: list) -> pd.DataFrame:
+    """pyarrow.Table / DataFrame / kayıt listesi → sadece gereken kolonları içeren DataFrame."""
+    if data is None:
+        frame = pd.DataFrame(columns=columns)
+    elif isinstance(data, pd.DataFrame):
+        frame = data
+    elif hasattr(data, "to_pandas"):
+        frame = data.to_pandas()
+    else:
+        frame = pd.DataFrame.from_records(list(data))
+    for column in columns:
+        if column not in frame.columns:
+            frame[column] = None
+    frame = frame[columns].copy()
+    frame["user_id"] = frame["user_id"].astype(str)
+    return frame
+
+
+def _extract(values: pd.Series, pattern: str) -> pd.Series:
+    """Regex'in 'value' grubunu Arrow'da (satır başına Python çağrısı olmadan) çıkarır; eşleşmeyen → None."""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    text = pa.array(values.fillna("").astype(str).to_numpy(dtype=object), type=pa.string())
+    extracted = pc.struct_field(pc.extract_regex(text, pattern=pattern), [0])
+    return pd.Series(extracted.to_numpy(zero_copy_only=False), index=values.index, dtype=object)
+
+
+def _matches(values: pd.Series, pattern: str) -> pd.Series:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    text = pa.array(values.fillna("").astype(str).to_numpy(dtype=object), type=pa.string())
+    return pd.Series(pc.match_substring_regex(text, pattern=pattern).to_numpy(zero_copy_only=False), index=values.index, dtype=bool)
+
+
+def _yes_no(mask: pd.Series) -> pd.Series:
+    return pd.Series(np.where(mask.to_numpy(dtype=bool), "Yes", "No"), index=mask.index)
+
+
+def _normalize_location(values: pd.Series) -> pd.Series:
+    # segment_features SQL'i ile aynı kural: NULLIF(LOWER(TRIM(location)), '')
+    normalized = values.fillna("").astype(str).str.strip().str.lower()
+    return normalized.mask(normalized == "")
+
+
+def category_label(slug) -> str:
+    """Kategori slug'ı → etiket ('electronics' → 'Tech'); boşsa 'None'."""
+    if slug is None or (isinstance(slug, float) and np.isnan(slug)) or slug == "":
+        return NO_CATEGORY
+    slug = str(slug).lower()
+    return CATEGORY_LABELS.get(slug, slug[:1].upper() + slug[1:])
+
+
+def _spent_labels(total_spent: pd.Series) -> pd.Series:
+    return pd.cut(total_spent, SPENT_BINS, labels=SPENT_LABELS, right=False).astype(str)
+
+
+def compute_segment_features(events, orders, user_ids=None) -> pd.DataFrame:
+    """
+    Kullanıcı başına beş kriteri hesaplar.
+
+    Args:
+        events: user_events satırları (pyarrow.Table, DataFrame ya da kayıt listesi)
+        orders: user_orders satırları
+        user_ids: sonuçta yer alacak kullanıcılar (varsayılan: events + orders'taki herkes)
+
+    Returns:
+        DataFrame (index=user_id): total_spent, total_spent_label, most_viewed_category,
+        gift_wrap, cart_abandonment, different_location
+    """
+    ev = _frame(events, EVENT_COLUMNS)
+    od = _frame(orders, ORDER_COLUMNS)
+    if user_ids is None:
+        user_ids = pd.unique(pd.concat([ev["user_id"], od["user_id"]], ignore_index=True))
+    index = pd.Index([str(u) for u in user_ids], name="user_id")
+    result = pd.DataFrame(index=index)
+
+    # 1) totalSpent
+    paid = pd.to_numeric(od["paid_amount"], errors="coerce").fillna(0.0)
+    total_spent = paid.groupby(od["user_id"]).sum().reindex(index, fill_value=0.0)
+    result["total_spent"] = total_spent.round(2)
+    result["total_spent_label"] = _spent_labels(total_spent)
+
+    # Son oturum: kullanıcının en son event'inin session_id'si
+    ev["event_time"] = pd.to_datetime(ev["event_time"], errors="coerce")
+    ev = ev.sort_values(["user_id", "event_time"], kind="stable", na_position="first").reset_index(drop=True)
+    last_session = ev.groupby("user_id", sort=False)["session_id"].last()
+    ev["in_last_session"] = ev["session_id"].to_numpy() == ev["user_id"].map(last_session).to_numpy()
+
+    # 2) mostViewedCategory: category_click payload'ı + /category/<slug> sayfa görüntülemeleri
+    clicks = ev["event_name"].eq("category_click")
+    page_views = ev["event_name"].eq("page_view")
+    views = pd.concat([
+        pd.DataFrame({"user_id": ev.loc[clicks, "user_id"], "category": _extract(ev.loc[clicks, "payload"], _CATEGORY_IN_PAYLOAD)}),
+        pd.DataFrame({"user_id": ev.loc[page_views, "user_id"], "category": _extract(ev.loc[page_views, "path_name"], _CATEGORY_IN_PATH)}),
+    ]).dropna()
+    views["category"] = views["category"].str.lower()
+    if len(views):
+        counts = views.value_counts().reset_index(name="views")
+        top = (
+            counts.sort_values(["user_id", "views", "category"], ascending=[True, False, True], kind="stable")
+            .drop_duplicates("user_id")
+            .set_index("user_id")["category"]
+        )
+        labels = top.map(category_label)
+    else:
+        labels = pd.Series(dtype=object)
+    result["most_viewed_category"] = labels.reindex(index).fillna(NO_CATEGORY)
+
+    last = ev[ev["in_last_session"]]
+    last_orders = od[od["session_id"].to_numpy() == od["user_id"].map(last_session).to_numpy()]
+
+    def any_by_user(mask: pd.Series, frame: pd.DataFrame) -> pd.Series:
+        return mask.groupby(frame["user_id"]).any().reindex(index, fill_value=False)
+
+    # 3) giftWrap (son oturum)
+    gift_events = last["event_name"].isin(["cart_gift_toggle", "checkout_success"]) & _matches(last["payload"], _GIFT_TRUE)
+    gift_orders = _matches(last_orders["products_payload"], _GIFT_TRUE)
+    result["gift_wrap"] = any_by_user(gift_events, last) | any_by_user(gift_orders, last_orders)
+
+    # 4) cartAbandonment (son oturum)
+    added = any_by_user(last["event_name"].eq("cart_add"), last)
+    checked_out = any_by_user(last["event_name"].eq("checkout_success"), last)
+    ordered = any_by_user(pd.Series(True, index=last_orders.index), last_orders)
+    result["cart_abandonment"] = added & ~(checked_out | ordered)
+
+    # 5) differentLocation: son oturum konumu vs önceki oturumlardaki en sık konum
+    sessions = (
+        ev.assign(location=_normalize_location(ev["event_location"]))
+        .groupby(["user_id", "session_id"], sort=False)
+        .agg(location=("location", "last"), is_last=("in_last_session", "any"))
+        .reset_index()
+    )
+    sessions = sessions.dropna(subset=["location"])
+    last_location = sessions[sessions["is_last"]].drop_duplicates("user_id").set_index("user_id")["location"]
+    earlier = sessions[~sessions["is_last"]]
+    if len(earlier):
+        usual_location = (
+            earlier.groupby(["user_id", "location"]).size().reset_index(name="sessions")
+            .sort_values(["user_id", "sessions", "location"], ascending=[True, False, True], kind="stable")
+            .drop_duplicates("user_id")
+            .set_index("user_id")["location"]
+        )
+    else:
+        usual_location = pd.Series(dtype=object)
+    last_location = last_location.reindex(index)
+    usual_location = usual_location.reindex(index)
+    result["different_location"] = (
+        last_location.notna() & usual_location.notna() & (last_location != usual_location)
+    ).astype(bool)
+
+    return result
+
+
+def features_from_rows(rows, user_ids=None) -> pd.DataFrame:
+    """
+    segment_features.fetch_segment_features (BigQuery pushdown) satırlarını
+    compute_segment_features ile aynı şekle çevirir.
+    """
+    frame = _frame(rows, ["user_id", "total_spent", "most_viewed_category", "gift_wrap", "cart_abandonment", "different_location"])
+    frame = frame.drop_duplicates("user_id").set_index("user_id")
+    if user_ids is not None:
+        frame = frame.reindex(pd.Index([str(u) for u in user_ids], name="user_id"))
+    result = pd.DataFrame(index=frame.index)
+    result["total_spent"] = pd.to_numeric(frame["total_spent"], errors="coerce").fillna(0.0)
+    result["total_spent_label"] = _spent_labels(result["total_spent"])
+    result["most_viewed_category"] = frame["most_viewed_category"].map(category_label)
+    for flag in ("gift_wrap", "cart_abandonment", "different_location"):
+        result[flag] = frame[flag].fillna(False).astype(bool)
+    return result
+
+
+def format_segment_labels(features: pd.DataFrame) -> pd.Series:
+    """compute_segment_features çıktısından 'totalSpentLow-mostViewedCategoryTech-...' etiketleri."""
+    return (
+        "totalSpent" + features["total_spent_label"]
+        + "-mostViewedCategory" + features["most_viewed_category"]
+        + "-giftWrap" + _yes_no(features["gift_wrap"])
+        + "-cartAbandonment" + _yes_no(features["cart_abandonment"])
+        + "-differentLocation" + _yes_no(features["different_location"])
+    )
+
+
+def segment_users(events, orders, user_ids=None) -> dict:
+    """
+    Bir batch kullanıcıyı tek geçişte segmentler.
+
+    Returns:
+        dict: {user_id: "totalSpentLow-mostViewedCategoryTech-giftWrapYes-cartAbandonmentNo-differentLocationYes"}
+    """
+    return format_segment_labels(compute_segment_features(events, orders, user_ids)).to_dict()
@@ -0,0 +1,153 @@
+"""
+Vectorised merge-diff engine for user activity snapshots.
+
+Both snapshots are given as user_id arrays plus parallel event/order count
+arrays. The ids of both sides are factorised together into dense integer codes
+with one Arrow hash pass (``dictionary_encode``); the merge itself is then a
+few O(n) NumPy scatter/gather operations on those codes instead of per-user
+dict lookups or string comparisons.
+"""
+
+import numpy as np
+
+
+def _as_arrow_strings(ids):
+    """user_id dizisini (list / NumPy / Arrow / dictionary-encoded Arrow) düz Arrow string dizisine çevirir."""
+    import pyarrow as pa
+
+    if isinstance(ids, (pa.Array, pa.ChunkedArray)) and pa.types.is_dictionary(ids.type):
+        ids = ids.cast(pa.string())
+    if isinstance(ids, pa.ChunkedArray):
+        ids = ids.combine_chunks()
+    if isinstance(ids, pa.Array):
+        return ids if ids.type == pa.string() else ids.cast(pa.string())
+    if isinstance(ids, np.ndarray) and ids.dtype.kind not in ("U", "S", "O"):
+        ids = ids.astype(str)
+    return pa.array(ids, type=pa.string())
+
+
+def _as_count_array(counts, size: int) -> np.ndarray:
+    if counts is None:
+        return np.zeros(size, dtype=np.int64)
+    if hasattr(counts, "to_numpy") and not isinstance(counts, np.ndarray):
+        counts = counts.to_numpy(zero_copy_only=False)
+    arr = np.asarray(counts)
+    if arr.dtype.kind == "f":
+        arr = np.nan_to_num(arr, nan=0.0)
+    return arr.astype(np.int64, copy=False)
+
+
+def factorize_ids(cur_ids, past_ids):
+    """
+    İki id dizisini ortak integer kodlara çevirir.
+
+    Null id'ler tek bir ortak kod alır (null_encoding='encode'); mask'lenmiş index
+    NumPy'a NaN olarak geçip geçersiz koda dönüşmez. Kaynak tablolar null user_id'leri
+    zaten eler (activity_arrays_from_arrow).
+
+    Returns:
+        (cur_codes, past_codes, code_count): aynı user_id her iki tarafta aynı kodu alır.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    cur = _as_arrow_strings(cur_ids)
+    past = _as_arrow_strings(past_ids)
+    encoded = pc.dictionary_encode(pa.concat_arrays([cur, past]), null_encoding='encode')
+    codes = encoded.indices.to_numpy(zero_copy_only=False).astype(np.int64, copy=False)
+    return codes[:len(cur)], codes[len(cur):], len(encoded.dictionary)
+
+
+def diff_activity_snapshots(cur_ids, cur_events, cur_orders, past_ids, past_events, past_orders) -> dict:
+    """
+    Mevcut ve önceki snapshot'ı karşılaştırır.
+
+    Args:
+        cur_ids/past_ids: user_id dizileri (her snapshot içinde tekil; list, NumPy ya da Arrow)
+        cur_events/cur_orders, past_events/past_orders: aynı sırada sayı dizileri
+
+    Returns:
+        dict: {
+            "new": mevcut snapshot'ta olup geçmişte olmayan kullanıcıların index'leri,
+            "increased": event ya da order sayısı artmış kullanıcıların index'leri,
+            "unchanged": artmamış (eşit ya da azalmış) kullanıcıların index'leri,
+            "removed": geçmişte olup artık olmayanların past dizisindeki index'leri,
+        }
+        "new"/"increased"/"unchanged" mevcut dizilere, "removed" past dizisine göre
+        index'ler; hepsi artan sırada int64 dizileridir.
+    """
+    cur_codes, past_codes, code_count = factorize_ids(cur_ids, past_ids)
+    cur_events = _as_count_array(cur_events, cur_codes.size)
+    cur_orders = _as_count_array(cur_orders, cur_codes.size)
+    past_events = _as_count_array(past_events, past_codes.size)
+    past_orders = _as_count_array(past_orders, past_codes.size)
+
+    empty = np.empty(0, dtype=np.int64)
+    if past_codes.size == 0:
+        return {
+            "new": np.arange(cur_codes.size, dtype=np.int64),
+            "increased": empty,
+            "unchanged": empty,
+            "removed": empty,
+        }
+
+    # kod -> past dizisindeki konum (-1: geçmişte yok)
+    past_position = np.full(code_count, -1, dtype=np.int64)
+    past_position[past_codes] = np.arange(past_codes.size, dtype=np.int64)
+    match = past_position[cur_codes]
+    found = match >= 0
+    safe_match = np.where(found, match, 0)
+
+    increased_mask = found & (
+        (cur_events > past_events[safe_match]) | (cur_orders > past_orders[safe_match])
+    )
+
+    # Artık görünmeyen geçmiş kullanıcılar
+    seen_now = np.zeros(code_count, dtype=bool)
+    seen_now[cur_codes] = True
+
+    return {
+        "new": np.flatnonzero(~found),
+        "increased": np.flatnonzero(increased_mask),
+        "unchanged": np.flatnonzero(found & ~increased_mask),
+        "removed": np.flatnonzero(~seen_now[past_codes]),
+    }
+
+
+def new_or_increased_indexes(diff: dict) -> np.ndarray:
+    """Segmentasyona girecek (yeni + artan) kullanıcıların mevcut dizideki index'leri."""
+    return np.union1d(diff["new"], diff["increased"])
+
+
+def take_ids(ids, indexes) -> list:
+    """Index dizisindeki user_id'leri Python string listesi olarak döner."""
+    import pyarrow as pa
+
+    return _as_arrow_strings(ids).take(pa.array(np.asarray(indexes, dtype=np.int64))).to_pylist()
+
+
+def activity_arrays_from_arrow(table):
+    """
+    Arrow tablosundan (user_id, event_count, order_count). user_id Arrow dizisi olarak
+    kalır (dictionary-encoded olabilir), sayılar NumPy dizisine çevrilir. user_id'si
+    null satırlar atlanır; segmentlenecek bir kullanıcıya karşılık gelmezler.
+    """
+    import pyarrow.compute as pc
+
+    null_ids = table.column('user_id').null_count
+    if null_ids:
+        print(f"⚠️ {null_ids} satırın user_id'si null, diff dışında bırakıldı")
+        table = table.filter(pc.is_valid(table.column('user_id')))
+    ids = table.column('user_id')
+    events = pc.fill_null(table.column('event_count'), 0).to_numpy()
+    orders = pc.fill_null(table.column('order_count'), 0).to_numpy()
+    return ids, events, orders
+
+
+def activity_arrays_from_dict(activity: dict):
+    """{user_id: {event_count, order_count}} map'inden diziler (eski snapshot formatı)."""
+    size = len(activity)
+    ids = [str(u) for u in activity.keys()]
+    events = np.fromiter((int(v.get('event_count', 0) or 0) for v in activity.values()), dtype=np.int64, count=size)
+    orders = np.fromiter((int(v.get('order_count', 0) or 0) for v in activity.values()), dtype=np.int64, count=size)
+    return ids, events, orders
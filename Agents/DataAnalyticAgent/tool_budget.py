@@ -0,0 +1,85 @@
+"""
+Token budget for tool results that go back into the LLM context.
+
+Tokens are estimated from the compact JSON size (~4 characters per token for
+Gemini on JSON-heavy payloads), which needs no tokenizer round-trip. A result
+over budget is shrunk step by step: first per-user detail is reduced, and only
+then are trailing users dropped, down to none if a single user still does
+not fit. Dropped users are returned so the caller can
+hand their queue claims back.
+"""
+
+import json
+import math
+
+
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(payload) -> int:
+    """JSON sonucunun yaklaşık token sayısı."""
+    text = json.dumps(payload, default=str, ensure_ascii=False, separators=(',', ':'))
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def _trim_summary(user: dict, level: int) -> dict:
+    # 1: event_counts ilk 3 tip, 2: event_counts yok, 3: tek kategori
+    user = dict(user)
+    if level >= 1 and 'event_counts' in user:
+        user['event_counts'] = dict(list(user['event_counts'].items())[:3])
+    if level >= 2:
+        user.pop('event_counts', None)
+    if level >= 3 and 'top_categories' in user:
+        user['top_categories'] = dict(list(user['top_categories'].items())[:1])
+    return user
+
+
+def _trim_raw(user: dict, level: int) -> dict:
+    # Her seviyede en eski event/order'ların yarısı atılır (listeler zaman sırasında)
+    user = dict(user)
+    for key in ('events', 'orders'):
+        records = user.get(key) or []
+        keep = len(records) >> level
+        if keep < len(records):
+            user[key] = records[len(records) - keep:] if keep else []
+            user[f'{key}_truncated'] = len(records) - keep
+    return user
+
+
+def fit_users_to_budget(result: dict, budget: int, *, mode: str = "summary") -> tuple:
+    """
+    result['users'] listesini token bütçesine sığdırır.
+
+    Args:
+        result: tool sonucu ({"users": [...], ...})
+        budget: izin verilen en fazla token
+        mode: "summary" (özetler) ya da "raw" (event/order listeleri)
+
+    Returns:
+        (result, dropped_user_ids, tokens): bütçeye sığmış sonuç, sonuçtan çıkarılan
+        kullanıcılar ve son token tahmini
+    """
+    users = list(result.get('users') or [])
+    tokens = estimate_tokens(result)
+    if budget <= 0 or tokens <= budget:
+        return result, [], tokens
+
+    trim = _trim_summary if mode == "summary" else _trim_raw
+    max_level = 3 if mode == "summary" else 16
+    for level in range(1, max_level + 1):
+        candidate = {**result, 'users': [trim(user, level) for user in users]}
+        tokens = estimate_tokens(candidate)
+        if tokens <= budget:
+            return candidate, [], tokens
+
+    # En küçük detay seviyesinde bile sığmıyor: sondan kullanıcı çıkar. Tek kullanıcı bile
+    # bütçeyi aşıyorsa o da çıkarılır; bütçe kesin sınırdır, claim'leri çağıran geri verir
+    trimmed = [trim(user, max_level) for user in users]
+    dropped = []
+    while trimmed:
+        dropped.insert(0, trimmed.pop()['user_id'])
+        candidate = {**result, 'users': trimmed}
+        tokens = estimate_tokens(candidate)
+        if tokens <= budget:
+            break
+    return candidate, dropped, tokens
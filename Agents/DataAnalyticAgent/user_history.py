@@ -0,0 +1,84 @@
+"""
+Batched event/order history fetch for segmentation.
+
+One parameterised query per table covers the whole batch of users
+(`WHERE user_id IN UNNEST(@user_ids)`), the events and orders queries run
+concurrently, and each Arrow result is split by user in a single pass. The
+cost no longer grows with users x rows, so claim sizes in the thousands are
+practical, and user ids are never spliced into SQL text.
+
+Tables (dataset = BQ_DATASET, default 'adgen_bq'): user_events, user_orders.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from google.cloud import bigquery
+
+from .bq_helper import arrow_group_records, bq_to_arrow
+
+
+EVENT_COLUMNS = ["session_id", "user_id", "event_name", "event_time", "path_name", "payload", "event_location"]
+ORDER_COLUMNS = ["order_id", "user_id", "session_id", "products_payload", "paid_amount", "order_date", "session_location"]
+
+
+def _dataset() -> str:
+    return os.getenv('BQ_DATASET', 'adgen_bq')
+
+
+def build_user_events_sql() -> str:
+    return f"""
+    SELECT {', '.join(EVENT_COLUMNS)}
+    FROM `{_dataset()}.user_events`
+    WHERE user_id IN UNNEST(@user_ids)
+    ORDER BY user_id, event_time
+    """
+
+
+def build_user_orders_sql() -> str:
+    return f"""
+    SELECT {', '.join(ORDER_COLUMNS)}
+    FROM `{_dataset()}.user_orders`
+    WHERE user_id IN UNNEST(@user_ids)
+    ORDER BY user_id, order_date
+    """
+
+
+def fetch_user_history_tables(user_ids: list):
+    """
+    Kullanıcıların event ve order satırlarını iki paralel sorguyla pyarrow.Table olarak döner.
+
+    Returns:
+        (events_table, orders_table)
+    """
+    params = [bigquery.ArrayQueryParameter('user_ids', 'STRING', [str(u) for u in user_ids])]
+
+    # events ve orders sorguları paralel çalışır (pooled BigQuery client thread-safe)
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        events_future = pool.submit(bq_to_arrow, build_user_events_sql(), query_parameters=params)
+        orders_future = pool.submit(bq_to_arrow, build_user_orders_sql(), query_parameters=params)
+        return events_future.result(), orders_future.result()
+
+
+def fetch_user_histories(user_ids: list) -> dict:
+    """
+    Kullanıcıların tüm event ve orderlarını tek seferde çeker.
+
+    Args:
+        user_ids: user_id listesi (sonuç bu sırayı korur)
+
+    Returns:
+        dict: {user_id: {"events": [...], "orders": [...]}}; verisi olmayan kullanıcılar
+        boş listelerle yer alır. event_time/order_date ISO string'dir.
+    """
+    user_ids = [str(u) for u in user_ids]
+    if not user_ids:
+        return {}
+    events_table, orders_table = fetch_user_history_tables(user_ids)
+    events_by_user = arrow_group_records(events_table, 'user_id', keys=user_ids)
+    orders_by_user = arrow_group_records(orders_table, 'user_id', keys=user_ids)
+
+    return {
+        user_id: {'events': events_by_user[user_id], 'orders': orders_by_user[user_id]}
+        for user_id in user_ids
+    }
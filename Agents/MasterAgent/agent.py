@@ -6,11 +6,16 @@ from DataAnalyticAgent.agent import (
     write_user_activity_to_firestore,
     read_users_to_segmentate,
     write_user_segmentation_result,
+    write_user_segmentation_results,
     write_segmentation_results_to_firestore,
+    segment_pending_users_with_rules,
+    SEGMENTATION_MODE,
 )
 from DataAnalyticAgent.bq_helper import bq_to_dataframe
 from .firestore_helper import get_past_events_from_firestore, get_firestore_client
 from google.cloud import firestore
+from rate_limiter import after_model_rate_limit, before_model_rate_limit
+from genai_models import gemini_model
 
 
 
@@ -25,7 +30,7 @@ SEGMENTATION TASK (strict):
    - retrieve_user_activity_counts → compare_event_counts → write_user_activity_to_firestore
    - read_users_to_segmentate
    - If no_pending_users ⇒ return ONLY {"status":"segmentation_finished"}
-   - Otherwise process up to 5 users with write_user_segmentation_result
+   - Otherwise segment the batch and save it with ONE write_user_segmentation_results call
    - Decide:
        remaining = pending_total - 5
        If remaining > 0 ⇒ return {"status":"continue"} else {"status":"segmentation_finished"}
@@ -45,19 +50,29 @@ GENERAL:
 - Never produce extra prose. Always return the minimal JSON status.
 """
 
+MASTER_RULES_MODE_INSTRUCTION = """
+RULE-BASED SEGMENTATION MODE (ACTIVE):
+- When only the pending queue has to be drained (no activity refresh requested), call your own
+  segment_pending_users_with_rules tool directly instead of transferring, and return ONLY
+  {"status": <its status>}.
+"""
+
 MASTER_AGENT_DESCRIPTION = """
 Chief executive of an agent team.  Coordinates the agents.
 """
 
 master_agent = Agent(
-    model='gemini-2.5-pro',
+    model=gemini_model('gemini-2.5-pro'),
     name='master_agent',
     description=MASTER_AGENT_DESCRIPTION,
-    instruction=MASTER_AGENT_INSTRUCTION,
+    instruction=MASTER_AGENT_INSTRUCTION + (MASTER_RULES_MODE_INSTRUCTION if SEGMENTATION_MODE == 'rules' else ""),
+    tools=[segment_pending_users_with_rules],
     sub_agents=[
         data_analytic_agent,
         creative_agent
-    ]
+    ],
+    before_model_callback=before_model_rate_limit,
+    after_model_callback=after_model_rate_limit,
 )
 
 root_agent = master_agent
\ No newline at end of file
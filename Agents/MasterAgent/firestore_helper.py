@@ -1,49 +1,544 @@
 import os
-import json
-import base64
+import sys
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from google.cloud import firestore
-from google.oauth2 import service_account
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+from clients import get_firestore_client as _pooled_firestore_client
 
 
 def get_firestore_client():
     project_id = os.getenv('GCP_PROJECT_ID', 'eighth-upgrade-475017-u5')
     database_id = os.getenv('FIRESTORE_DB_ID', 'adgen-db')
     
-    client_args = {
-        'project': project_id,
-        'database': database_id
+    # Process-wide pooled client: GCP_SERVICE_ACCOUNT_JSON(_BQ) > GOOGLE_APPLICATION_CREDENTIALS_BQ > ADC.
+    # Recreated automatically after a fork or when the credentials change.
+    return _pooled_firestore_client(project_id, database_id)
+
+
+ACTIVITY_COLLECTION = "user_activity_counts"
+SHARD_SUBCOLLECTION = "shards"
+
+# BulkWriter'da tekrar denenecek gRPC kodları: DEADLINE_EXCEEDED, RESOURCE_EXHAUSTED, ABORTED, INTERNAL, UNAVAILABLE
+_RETRYABLE_WRITE_CODES = {4, 8, 10, 13, 14}
+_ALREADY_EXISTS = 6
+
+
+def _write_error_name(code) -> str:
+    try:
+        from google.rpc import code_pb2
+        return code_pb2.Code.Name(int(code))
+    except Exception:
+        return str(code)
+
+
+def bulk_write_documents(collection_name: str, documents, *, on_progress=None, progress_every: int = 10000, create_only: bool = False) -> dict:
+    """
+    (doc_id, data) çiftlerini Firestore BulkWriter ile paralel yazar.
+
+    Sıralı 500'lük WriteBatch commit'leri yerine yazmalar paralel gönderilir;
+    BulkWriter başlangıç hızından maksimum hıza kadar her 5 dakikada %50 artırarak
+    kendisi ramp-up yapar. 500/50/5 kuralındaki 500 ops/sn başlangıcı yeni (trafik
+    almamış) collection'lar içindir; kuyruk collection'ı sürekli yazılıyor ve doc
+    id'leri user_id (sıralı değil) olduğundan başlangıç 2000 ops/sn'dir; aksi halde
+    10k dokümanlık bir yazma ramp-up'a hiç ulaşmadan ~20 sn sürer. Yeni bir
+    veritabanında ilk yüklemede FIRESTORE_BULK_INITIAL_OPS=500 verilmelidir. Tekrar denenebilir hatalar (ABORTED, UNAVAILABLE, ...) max
+    deneme sayısına kadar backoff ile tekrar gönderilir.
+
+    Env:
+        FIRESTORE_BULK_INITIAL_OPS   başlangıç ops/sn (varsayılan 2000)
+        FIRESTORE_BULK_MAX_OPS       ramp-up üst sınırı ops/sn (varsayılan 10000)
+        FIRESTORE_BULK_MAX_ATTEMPTS  doküman başına deneme sayısı (varsayılan 5)
+        FIRESTORE_BULK_SERIAL        '1' ise batch'ler paralel değil sırayla gönderilir
+
+    Args:
+        on_progress: her progress_every dokümanda bir stats dict'i ile çağrılır
+                     (BulkWriter thread'inden)
+        create_only: True ise set yerine create kullanılır; zaten var olan dokümanlar
+                     değiştirilmez, hata sayılmaz ve "existing" altında sayılır
+
+    Returns:
+        dict: {"written", "existing", "failed", "retried", "errors": {kod: adet}, "elapsed_seconds", "docs_per_sec"}
+    """
+    import threading
+    import time
+    from google.cloud.firestore_v1.bulk_writer import BulkRetry, BulkWriterOptions, SendMode
+
+    db = get_firestore_client()
+    collection_ref = db.collection(collection_name)
+    max_attempts = max(1, int(os.getenv('FIRESTORE_BULK_MAX_ATTEMPTS', '5')))
+    initial_ops = max(1, int(os.getenv('FIRESTORE_BULK_INITIAL_OPS', '2000')))
+    max_ops = max(initial_ops, int(os.getenv('FIRESTORE_BULK_MAX_OPS', '10000')))
+    serial = os.getenv('FIRESTORE_BULK_SERIAL', '0') == '1'
+
+    lock = threading.Lock()
+    stats = {"written": 0, "existing": 0, "failed": 0, "retried": 0, "errors": {}}
+    started = time.monotonic()
+
+    def snapshot() -> dict:
+        elapsed = max(time.monotonic() - started, 1e-9)
+        return {
+            **stats,
+            "errors": dict(stats["errors"]),
+            "elapsed_seconds": round(elapsed, 3),
+            "docs_per_sec": round(stats["written"] / elapsed, 1),
+        }
+
+    def on_result(reference, result, writer):
+        report = None
+        with lock:
+            stats["written"] += 1
+            if on_progress and stats["written"] % progress_every == 0:
+                report = snapshot()
+        if report:
+            on_progress(report)
+
+    def on_error(error, writer) -> bool:
+        if create_only and int(error.code) == _ALREADY_EXISTS:
+            with lock:
+                stats["existing"] += 1
+            return False
+        name = _write_error_name(error.code)
+        with lock:
+            stats["errors"][name] = stats["errors"].get(name, 0) + 1
+            retry = int(error.code) in _RETRYABLE_WRITE_CODES and error.attempts < max_attempts
+            if retry:
+                stats["retried"] += 1
+            else:
+                stats["failed"] += 1
+        if not retry:
+            print(f"❌ BulkWriter yazma hatası ({name}, deneme {error.attempts}): {error.message}")
+        return retry
+
+    writer = db.bulk_writer(options=BulkWriterOptions(
+        initial_ops_per_second=initial_ops,
+        max_ops_per_second=max_ops,
+        mode=SendMode.serial if serial else SendMode.parallel,
+        retry=BulkRetry.exponential,
+    ))
+    writer.on_write_result(on_result)
+    writer.on_write_error(on_error)
+    write = writer.create if create_only else writer.set
+    for doc_id, data in documents:
+        write(collection_ref.document(str(doc_id)), data)
+    writer.close()  # flush + bekleyen retry'lar
+
+    return snapshot()
+
+
+PENDING_COLLECTION = "users_to_segmentate"
+QUEUE_STATS_COLLECTION = "queue_stats"
+
+
+def pending_counter_enabled() -> bool:
+    """PENDING_COUNT_MODE=counter ise pending sayısı queue_stats sayaç dokümanından okunur."""
+    return os.getenv('PENDING_COUNT_MODE', 'aggregate').strip().lower() == 'counter'
+
+
+def _pending_counter_ref():
+    return get_firestore_client().collection(QUEUE_STATS_COLLECTION).document(PENDING_COLLECTION)
+
+
+def count_pending_users() -> int:
+    """state == 'pending' dokümanlarını server-side COUNT aggregation ile sayar (dokümanlar indirilmez)."""
+    query = (
+        get_firestore_client()
+        .collection(PENDING_COLLECTION)
+        .where('state', '==', 'pending')
+        .count(alias='pending')
+    )
+    result = query.get()
+    return int(result[0][0].value) if result and result[0] else 0
+
+
+def count_expired_leases() -> int:
+    """
+    Lease süresi dolmuş processing dokümanlarını sayar (çöken worker'ların bıraktıkları).
+    lease_expires_at yalnızca processing dokümanlarda bulunur; release/complete alanı siler.
+    """
+    from datetime import timezone
+
+    query = (
+        get_firestore_client()
+        .collection(PENDING_COLLECTION)
+        .where('lease_expires_at', '<', datetime.now(timezone.utc))
+        .count(alias='expired')
+    )
+    result = query.get()
+    return int(result[0][0].value) if result and result[0] else 0
+
+
+def adjust_pending_counter(delta: int, batch=None) -> None:
+    """
+    Yaklaşık pending sayacını firestore.Increment ile günceller (sayaç modu kapalıysa no-op).
+    batch (WriteBatch ya da Transaction) verilirse işlem ona eklenir, böylece kuyruk
+    yazmasıyla atomik olur.
+    """
+    if not pending_counter_enabled() or not delta:
+        return
+    data = {'pending': firestore.Increment(int(delta)), 'updated_at': firestore.SERVER_TIMESTAMP}
+    if batch is not None:
+        batch.set(_pending_counter_ref(), data, merge=True)
+    else:
+        _pending_counter_ref().set(data, merge=True)
+
+
+def get_pending_total() -> int:
+    """
+    Kuyruktaki pending kullanıcı sayısı; lease süresi dolmuş processing dokümanları da
+    yeniden claim edilebildikleri için dahildir (count_expired_leases).
+
+    Varsayılan: COUNT aggregation (1 okuma / 1000 index girdisi). PENDING_COUNT_MODE=counter
+    ise enqueue/dequeue'da Increment ile tutulan sayaç okunur (tek doküman okuması); sayaç
+    yoksa ya da PENDING_COUNTER_RESYNC_MINUTES'tan (varsayılan 30) eskiyse aggregation ile
+    yeniden senkronlanır. Aynı kullanıcının tekrar kuyruğa yazılması gibi durumlarda sayaç
+    kayabileceği için değer yaklaşıktır. Süresi dolmuş lease'ler her iki modda da COUNT ile sayılır.
+    """
+    expired = count_expired_leases()
+    if not pending_counter_enabled():
+        return count_pending_users() + expired
+
+    from datetime import timedelta, timezone
+
+    counter_ref = _pending_counter_ref()
+    counter = counter_ref.get()
+    data = counter.to_dict() if counter.exists else {}
+    synced_at = data.get('synced_at')
+    resync_after = timedelta(minutes=float(os.getenv('PENDING_COUNTER_RESYNC_MINUTES', '30')))
+    if synced_at is not None and datetime.now(timezone.utc) - synced_at < resync_after:
+        return max(0, int(data.get('pending', 0) or 0)) + expired
+
+    pending = count_pending_users()
+    counter_ref.set({'pending': pending, 'synced_at': firestore.SERVER_TIMESTAMP, 'updated_at': firestore.SERVER_TIMESTAMP})
+    return pending + expired
+
+
+# Firestore transaction/batch başına 500 yazma sınırının altında kal
+_MAX_WRITES_PER_TRANSACTION = 400
+
+
+def segmentation_lease_seconds() -> int:
+    return max(30, int(os.getenv('SEGMENTATION_LEASE_SECONDS', '600')))
+
+
+def _claimable(data: dict, now) -> bool:
+    if data.get('state') == 'pending':
+        return True
+    expires = data.get('lease_expires_at')
+    return data.get('state') == 'processing' and expires is not None and expires < now
+
+
+def claim_pending_users(owner: str, limit: int = 5, lease_seconds: int = None) -> list:
+    """
+    Kuyruktan en fazla `limit` kullanıcıyı transaction ile `processing` durumuna alır.
+
+    Adaylar: süresi dolmuş lease'ler (çöken worker'lar) ve pending dokümanlar. Her aday
+    transaction içinde yeniden okunur; hâlâ claim edilebilir olanlar lease_owner /
+    lease_expires_at ile işaretlenir. Aynı dokümanı claim etmeye çalışan iki worker'dan
+    biri transaction retry'ında dokümanı processing görüp atlar, yani bir kullanıcı aynı
+    anda tek worker'a verilir.
+
+    Returns:
+        list: claim edilen user_id'ler
+    """
+    import random
+    from datetime import timedelta, timezone
+
+    db = get_firestore_client()
+    queue = db.collection(PENDING_COLLECTION)
+    lease_seconds = lease_seconds or segmentation_lease_seconds()
+    claimed = []
+
+    @firestore.transactional
+    def claim(transaction, refs, wanted):
+        now = datetime.now(timezone.utc)
+        expires_at = now + timedelta(seconds=lease_seconds)
+        taken, from_pending = [], 0
+        # Transaction'da tüm okumalar yazmalardan önce yapılmalı
+        snaps = list(transaction.get_all(refs))
+        for snap in snaps:
+            if len(taken) >= wanted:
+                break
+            data = snap.to_dict() if snap.exists else None
+            if not data or not _claimable(data, now):
+                continue
+            from_pending += data.get('state') == 'pending'
+            transaction.update(snap.reference, {
+                'state': 'processing',
+                'lease_owner': owner,
+                'lease_expires_at': expires_at,
+                'claimed_at': firestore.SERVER_TIMESTAMP,
+                'claim_count': firestore.Increment(1),
+            })
+            taken.append(snap.id)
+        # pending sayacı sadece pending → processing geçişlerini sayar
+        adjust_pending_counter(-from_pending, batch=transaction)
+        return taken
+
+    # Turlar halinde: yarışı kaybedilen adaylar atlanır, eksik kalan kısım yeni adaylarla doldurulur.
+    # Tek transaction en fazla _MAX_WRITES_PER_TRANSACTION doküman claim eder.
+    stalled_rounds = 0
+    while len(claimed) < limit and stalled_rounds < 3:
+        wanted = min(limit - len(claimed), _MAX_WRITES_PER_TRANSACTION)
+        now = datetime.now(timezone.utc)
+        expired = [snap.reference for snap in queue.where('lease_expires_at', '<', now).limit(wanted).stream()]
+        pending = [snap.reference for snap in queue.where('state', '==', 'pending').limit(wanted * 3).stream()]
+        # Eşzamanlı worker'lar aynı ilk dokümanlara yığılmasın
+        random.shuffle(pending)
+        candidates = [ref for ref in expired + pending if ref.id not in claimed]
+        if not candidates:
+            break
+        taken = claim(db.transaction(), candidates, wanted)
+        claimed.extend(taken)
+        stalled_rounds = 0 if taken else stalled_rounds + 1
+    return claimed
+
+
+def complete_claimed_user(owner: str, user_id: str, segmentation_result: str) -> str:
+    """
+    Segmentasyon sonucunu lease sahibi olarak onaylar: sonuç user_segmentations'a yazılır
+    ve kuyruk dokümanı silinir (tek transaction).
+
+    Returns:
+        "success" | "lease_lost" (lease başka worker'a geçmiş) | "not_claimed" (doküman yok
+        ya da bu worker'a ait değil; sonuç yazılmaz)
+    """
+    db = get_firestore_client()
+    queue_ref = db.collection(PENDING_COLLECTION).document(user_id)
+    segmentation_ref = db.collection('user_segmentations').document(user_id)
+
+    @firestore.transactional
+    def complete(transaction):
+        snaps = list(transaction.get_all([queue_ref]))
+        data = snaps[0].to_dict() if snaps and snaps[0].exists else None
+        if not data or data.get('state') != 'processing':
+            return "not_claimed"
+        if data.get('lease_owner') != owner:
+            return "lease_lost"
+        transaction.set(segmentation_ref, {
+            'user_id': user_id,
+            'segmentation_result': segmentation_result,
+            'updated_at': firestore.SERVER_TIMESTAMP
+        })
+        transaction.delete(queue_ref)
+        return "success"
+
+    return complete(db.transaction())
+
+
+def release_claims(owner: str, user_ids: list) -> int:
+    """
+    Bu worker'ın claim ettiği ama işlemeyeceği kullanıcıları kuyruğa (state=pending) geri verir.
+    Transaction başına en fazla _MAX_WRITES_PER_TRANSACTION kullanıcı; fazlası sıradaki transaction'lara bölünür.
+
+    Returns:
+        int: geri verilen kullanıcı sayısı
+    """
+    user_ids = list(dict.fromkeys(str(u) for u in user_ids))
+    if not user_ids:
+        return 0
+    db = get_firestore_client()
+    queue = db.collection(PENDING_COLLECTION)
+
+    def release(transaction, chunk):
+        snaps = list(transaction.get_all([queue.document(u) for u in chunk]))
+        released = 0
+        for snap in snaps:
+            data = snap.to_dict() if snap.exists else None
+            if not data or data.get('state') != 'processing' or data.get('lease_owner') != owner:
+                continue
+            transaction.update(snap.reference, {
+                'state': 'pending',
+                'lease_owner': firestore.DELETE_FIELD,
+                'lease_expires_at': firestore.DELETE_FIELD,
+            })
+            released += 1
+        adjust_pending_counter(released, batch=transaction)
+        return released
+
+    released = 0
+    for start in range(0, len(user_ids), _MAX_WRITES_PER_TRANSACTION):
+        chunk = user_ids[start:start + _MAX_WRITES_PER_TRANSACTION]
+        released += firestore.transactional(release)(db.transaction(), chunk)
+    return released
+
+
+def complete_claimed_users(owner: str, segmentation_results: dict) -> dict:
+    """
+    complete_claimed_user'ın toplu hali: {user_id: segmentation_result} sonuçlarını lease
+    kontrolüyle, transaction başına en fazla 200 kullanıcı olacak şekilde paralel onaylar.
+
+    Returns:
+        dict: {"success": [...], "lease_lost": [...], "not_claimed": [...]}
+    """
+    db = get_firestore_client()
+    queue = db.collection(PENDING_COLLECTION)
+    segmentations = db.collection('user_segmentations')
+    items = [(str(user_id), result) for user_id, result in segmentation_results.items()]
+    per_transaction = _MAX_WRITES_PER_TRANSACTION // 2  # kullanıcı başına 2 yazma
+    chunks = [items[i:i + per_transaction] for i in range(0, len(items), per_transaction)]
+
+    def complete(transaction, chunk):
+        results = dict(chunk)
+        refs = [queue.document(user_id) for user_id, _ in chunk]
+        snaps = {snap.id: snap for snap in transaction.get_all(refs)}
+        outcome = {"success": [], "lease_lost": [], "not_claimed": []}
+        for user_id, _ in chunk:
+            snap = snaps.get(user_id)
+            data = snap.to_dict() if snap is not None and snap.exists else None
+            if not data or data.get('state') != 'processing':
+                outcome["not_claimed"].append(user_id)
+                continue
+            if data.get('lease_owner') != owner:
+                outcome["lease_lost"].append(user_id)
+                continue
+            transaction.set(segmentations.document(user_id), {
+                'user_id': user_id,
+                'segmentation_result': results[user_id],
+                'updated_at': firestore.SERVER_TIMESTAMP
+            })
+            transaction.delete(queue.document(user_id))
+            outcome["success"].append(user_id)
+        return outcome
+
+    summary = {"success": [], "lease_lost": [], "not_claimed": []}
+    if not chunks:
+        return summary
+    def run_chunk(chunk):
+        # _Transactional retry/rollback durumunu instance'ta tutar; her chunk kendi wrapper'ını kullanır
+        return firestore.transactional(complete)(db.transaction(), chunk)
+
+    workers = max(1, int(os.getenv('SEGMENTATION_COMPLETE_WORKERS', '8')))
+    with ThreadPoolExecutor(max_workers=min(workers, len(chunks))) as pool:
+        for outcome in pool.map(run_chunk, chunks):
+            for key, user_ids in outcome.items():
+                summary[key].extend(user_ids)
+    return summary
+
+
+def activity_shard_for(user_id: str, shard_count: int) -> int:
+    """
+    user_id'nin 32-bit hash uzayındaki aralığına göre shard index'i.
+    Shard i, [i * 2^32 / N, (i + 1) * 2^32 / N) hash aralığını tutar.
+    """
+    h = int.from_bytes(hashlib.md5(str(user_id).encode('utf-8')).digest()[:4], 'big')
+    return (h * shard_count) >> 32
+
+
+def _shard_id(index: int) -> str:
+    return f"{index:05d}"
+
+
+def write_sharded_activity_snapshot(user_activity: dict, *, table_source: str = "", extra: dict = None) -> dict:
+    """
+    user_activity map'ini bir manifest dokümanı + N shard dokümanı olarak yazar
+    (1 MiB doküman limitine takılmadan milyonlarca kullanıcı).
+
+    - Shard dokümanları: user_activity_counts/<snapshot_id>/shards/<index>, her biri kendi
+      hash aralığındaki kullanıcıların map'ini tutar.
+    - Shard'lar WriteBatch'ler halinde paralel commit edilir; manifest EN SON yazılır,
+      böylece okuyucular yarım kalmış bir snapshot'ı asla görmez.
+
+    Env:
+        ACTIVITY_SNAPSHOT_USERS_PER_SHARD (varsayılan 4000, ~0.5 MiB/shard)
+        ACTIVITY_SNAPSHOT_WRITE_WORKERS (varsayılan 8)
+
+    Returns:
+        dict: {"doc_id": str, "shard_count": int, "total_users": int}
+    """
+    db = get_firestore_client()
+    users_per_shard = max(1, int(os.getenv('ACTIVITY_SNAPSHOT_USERS_PER_SHARD', '4000')))
+    workers = max(1, int(os.getenv('ACTIVITY_SNAPSHOT_WRITE_WORKERS', '8')))
+    shard_count = max(1, -(-len(user_activity) // users_per_shard))
+
+    shards = [{} for _ in range(shard_count)]
+    for user_id, counts in user_activity.items():
+        shards[activity_shard_for(user_id, shard_count)][user_id] = counts
+
+    doc_id = f"snapshot_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    manifest_ref = db.collection(ACTIVITY_COLLECTION).document(doc_id)
+    shard_col = manifest_ref.collection(SHARD_SUBCOLLECTION)
+
+    # Bir batch ~10 MiB'ı aşmasın diye batch başına birkaç shard
+    shards_per_batch = 8
+    groups = [list(range(i, min(i + shards_per_batch, shard_count))) for i in range(0, shard_count, shards_per_batch)]
+
+    def commit_group(indexes):
+        batch = db.batch()
+        for index in indexes:
+            batch.set(shard_col.document(_shard_id(index)), {
+                'shard': index,
+                'shard_count': shard_count,
+                'user_activity': shards[index],
+                'total_users': len(shards[index]),
+            })
+        batch.commit()
+        return len(indexes)
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(groups))) as pool:
+        written_shards = sum(pool.map(commit_group, groups))
+
+    manifest = {
+        'backend': 'sharded',
+        'shard_count': shard_count,
+        'total_users': len(user_activity),
+        'createdAt': firestore.SERVER_TIMESTAMP,
+        'table_source': table_source,
     }
-    
-    # Firestore için gerekli scope'lar
-    scopes = [
-        'https://www.googleapis.com/auth/datastore',
-        'https://www.googleapis.com/auth/cloud-platform',
-    ]
-    
-    # Try environment-based service account JSON first (Cloud Run compatible)
-    sa_json = os.getenv('GCP_SERVICE_ACCOUNT_JSON') or os.getenv('GCP_SERVICE_ACCOUNT_JSON_BQ')
-    if sa_json:
-        try:
-            info = json.loads(sa_json) if sa_json.strip().startswith('{') else json.loads(base64.b64decode(sa_json).decode('utf-8'))
-            credentials = service_account.Credentials.from_service_account_info(info, scopes=scopes)
-            client_args['credentials'] = credentials
-        except Exception:
-            pass
+    manifest.update(extra or {})
+    manifest_ref.set(manifest)
+    print(f"✅ Sharded snapshot yazıldı: {ACTIVITY_COLLECTION}/{doc_id} ({written_shards} shard, {len(user_activity)} kullanıcı)")
+    return {"doc_id": doc_id, "shard_count": shard_count, "total_users": len(user_activity)}
+
+
+def _load_sharded_snapshot(manifest_ref, shard_count: int, user_ids=None) -> dict:
+    """
+    Shard'ları paralel okur. user_ids verilirse sadece o kullanıcıların düştüğü shard'lar okunur
+    ve sonuç o kullanıcılarla sınırlanır.
+    """
+    if user_ids is not None:
+        wanted = {str(u) for u in user_ids}
+        indexes = sorted({activity_shard_for(u, shard_count) for u in wanted})
     else:
-        # Fallback to file-based credentials (local development only)
-        bq_keyfile = os.getenv('GOOGLE_APPLICATION_CREDENTIALS_BQ')
-        if bq_keyfile and os.path.exists(bq_keyfile):
-            credentials = service_account.Credentials.from_service_account_file(bq_keyfile, scopes=scopes)
-            client_args['credentials'] = credentials
-    
-    # If no explicit credentials found, use default Cloud Run service account (ADC)
-    return firestore.Client(**client_args)
+        wanted = None
+        indexes = list(range(shard_count))
+    if not indexes:
+        return {}
+
+    db = get_firestore_client()
+    shard_col = manifest_ref.collection(SHARD_SUBCOLLECTION)
+    workers = max(1, int(os.getenv('ACTIVITY_SNAPSHOT_WRITE_WORKERS', '8')))
+    chunk = max(1, -(-len(indexes) // workers))
+    ref_chunks = [
+        [shard_col.document(_shard_id(i)) for i in indexes[start:start + chunk]]
+        for start in range(0, len(indexes), chunk)
+    ]
+
+    def read_chunk(refs):
+        return [snap.to_dict() or {} for snap in db.get_all(refs) if snap.exists]
 
+    past_user_activity = {}
+    with ThreadPoolExecutor(max_workers=len(ref_chunks)) as pool:
+        for shard_docs in pool.map(read_chunk, ref_chunks):
+            for shard in shard_docs:
+                activity = shard.get('user_activity', {})
+                if wanted is None:
+                    past_user_activity.update(activity)
+                else:
+                    past_user_activity.update({u: v for u, v in activity.items() if u in wanted})
+    return past_user_activity
 
-def get_past_events_from_firestore():
+
+def get_past_events_from_firestore(user_ids=None):
     """
     Firestore'dan en son kaydedilen user activity verilerini çeker.
     
+    Args:
+        user_ids: (opsiyonel) Sadece bu kullanıcılar gerekiyorsa; sharded snapshot'larda
+                  yalnızca ilgili shard'lar okunur.
+    
     Returns:
         dict: {user_id: {event_count, order_count, created_at}, ...} formatında geçmiş veriler
               Veri bulunamazsa boş dict döner
@@ -51,7 +546,7 @@ def get_past_events_from_firestore():
     db = get_firestore_client()
     
     # Firestore koleksiyon yolu (güncellenmiş)
-    COLLECTION_PATH = "user_activity_counts"
+    COLLECTION_PATH = ACTIVITY_COLLECTION
     
     try:
         # En son dokümanı al (createdAt'e göre azalan sıralama, sadece 1 adet)
@@ -67,7 +562,18 @@ def get_past_events_from_firestore():
         
         if latest_doc:
             data = latest_doc.to_dict()
-            past_user_activity = data.get('user_activity', {})
+            if data.get('backend') == 'bigquery':
+                past_user_activity = _load_bigquery_snapshot(data['snapshot_table'])
+            elif data.get('backend') == 'parquet':
+                from DataAnalyticAgent.parquet_snapshot import activity_table_to_dict, read_parquet_snapshot
+                past_user_activity = activity_table_to_dict(read_parquet_snapshot(data['snapshot_uri']))
+            elif data.get('backend') == 'sharded':
+                past_user_activity = _load_sharded_snapshot(latest_doc.reference, int(data.get('shard_count') or 1), user_ids)
+            else:
+                past_user_activity = data.get('user_activity', {})
+            if user_ids is not None and data.get('backend') != 'sharded':
+                wanted = {str(u) for u in user_ids}
+                past_user_activity = {u: v for u, v in past_user_activity.items() if u in wanted}
             print(f"✅ En son geçmiş veri ({latest_doc.id}) yüklendi. Kullanıcı sayısı: {len(past_user_activity)}")
             return past_user_activity
         else:
@@ -78,3 +584,57 @@ def get_past_events_from_firestore():
         print(f"❌ Firestore'dan veri çekerken hata: {e}")
         return {}
 
+
+def get_past_activity_arrays():
+    """
+    En son snapshot'ı vektörel diff için (user_ids, event_counts, order_counts) NumPy
+    dizileri olarak döner. Parquet ve BigQuery snapshot'ları dict'e çevrilmeden doğrudan
+    Arrow'dan okunur. Snapshot yoksa boş diziler döner.
+    """
+    from DataAnalyticAgent.snapshot_diff import activity_arrays_from_arrow, activity_arrays_from_dict
+
+    db = get_firestore_client()
+    docs = (
+        db.collection(ACTIVITY_COLLECTION)
+        .order_by('createdAt', direction=firestore.Query.DESCENDING)
+        .limit(1)
+        .stream()
+    )
+    latest_doc = next(docs, None)
+    if latest_doc is None:
+        print(f"⚠️ {ACTIVITY_COLLECTION} koleksiyonunda herhangi bir doküman bulunamadı.")
+        return activity_arrays_from_dict({})
+
+    data = latest_doc.to_dict()
+    if data.get('backend') == 'parquet':
+        from DataAnalyticAgent.parquet_snapshot import read_parquet_snapshot
+        arrays = activity_arrays_from_arrow(read_parquet_snapshot(data['snapshot_uri']))
+    elif data.get('backend') == 'bigquery':
+        from DataAnalyticAgent.bq_helper import bq_to_arrow
+        project, dataset, table = data['snapshot_table'].split('.')
+        arrays = activity_arrays_from_arrow(bq_to_arrow(
+            data_reference={'project': project, 'dataset': dataset, 'table': table},
+            columns=['user_id', 'event_count', 'order_count'],
+        ))
+    elif data.get('backend') == 'sharded':
+        arrays = activity_arrays_from_dict(_load_sharded_snapshot(latest_doc.reference, int(data.get('shard_count') or 1)))
+    else:
+        arrays = activity_arrays_from_dict(data.get('user_activity', {}))
+    print(f"✅ En son geçmiş veri ({latest_doc.id}) yüklendi. Kullanıcı sayısı: {len(arrays[0])}")
+    return arrays
+
+
+def _load_bigquery_snapshot(snapshot_table: str) -> dict:
+    """Pointer dokümanındaki BigQuery snapshot tablosunu {user_id: {...}} formatına çevirir."""
+    from DataAnalyticAgent.bq_helper import bq_iter_record_batches
+
+    project, dataset, table = snapshot_table.split('.')
+    past_user_activity = {}
+    for batch in bq_iter_record_batches(
+        data_reference={'project': project, 'dataset': dataset, 'table': table},
+        columns=['user_id', 'event_count', 'order_count'],
+    ):
+        cols = batch.to_pydict()
+        for user_id, event_count, order_count in zip(cols['user_id'], cols['event_count'], cols['order_count']):
+            past_user_activity[str(user_id)] = {'event_count': int(event_count or 0), 'order_count': int(order_count or 0)}
+    return past_user_activity
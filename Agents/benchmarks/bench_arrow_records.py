@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark: legacy row-by-row conversions vs. the Arrow-to-records layer.
+
+Two shapes are measured, both starting from the pyarrow data BigQuery hands us:
+
+  snapshot  {user_id: {event_count, order_count, created_at}} as built by
+            write_user_activity_to_firestore (legacy: to_pydict + per-row
+            int()/isoformat()).
+  segment   {user_id: [event records]} as built by read_users_to_segmentate
+            (legacy: to_pandas + per-user boolean mask + to_dict('records')).
+
+Usage:
+  python Agents/benchmarks/bench_arrow_records.py
+  python Agents/benchmarks/bench_arrow_records.py --users 1000000 --events 200000 --segment-users 50
+"""
+
+import argparse
+import datetime as dt
+import importlib.util
+import os
+import time
+
+import numpy as np
+import pyarrow as pa
+
+# Load the conversion layer by path so the benchmark does not need the ADK/GCP
+# stack that DataAnalyticAgent/__init__.py and bq_helper pull in.
+_MODULE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "DataAnalyticAgent", "arrow_records.py")
+_spec = importlib.util.spec_from_file_location("arrow_records", _MODULE_PATH)
+arrow_records = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(arrow_records)
+
+
+def make_activity_batch(n: int, seed: int = 3):
+    rng = np.random.default_rng(seed)
+    base = np.datetime64("2025-01-01T00:00:00", "us")
+    created = base + rng.integers(0, 300 * 24 * 3600 * 10**6, n).astype("timedelta64[us]")
+    return pa.record_batch({
+        "user_id": pa.array([f"user_{i:09d}" for i in range(n)]),
+        "event_count": pa.array(rng.integers(1, 500, n), pa.int64()),
+        "order_count": pa.array(rng.integers(0, 20, n), pa.int64()),
+        "created_at": pa.array(created, pa.timestamp("us")),
+    })
+
+
+def make_events_table(rows: int, users: int, seed: int = 5):
+    rng = np.random.default_rng(seed)
+    user_idx = np.sort(rng.integers(0, users, rows))
+    base = np.datetime64("2025-01-01T00:00:00", "us")
+    event_time = base + rng.integers(0, 300 * 24 * 3600 * 10**6, rows).astype("timedelta64[us]")
+    names = np.array(["page_view", "category_click", "product_click", "cart_add", "checkout_click"])
+    return pa.table({
+        "session_id": pa.array([f"s_{i // 7:08d}" for i in range(rows)]),
+        "user_id": pa.array([f"user_{i:05d}" for i in user_idx]),
+        "event_name": pa.array(names[rng.integers(0, names.size, rows)]),
+        "event_time": pa.array(event_time, pa.timestamp("us")),
+        "path_name": pa.array(["/category/electronics"] * rows),
+        "payload": pa.array(['{"category": "electronics"}'] * rows),
+        "event_location": pa.array(["Istanbul"] * rows),
+    })
+
+
+def legacy_snapshot(batch) -> dict:
+    user_activity = {}
+    cols = batch.to_pydict()
+    for user_id, event_count, order_count, created_at in zip(
+        cols['user_id'], cols['event_count'], cols['order_count'], cols['created_at']
+    ):
+        user_activity[str(user_id)] = {
+            'event_count': int(event_count or 0),
+            'order_count': int(order_count or 0),
+            'created_at': created_at.isoformat() if hasattr(created_at, 'isoformat') else str(created_at)
+        }
+    return user_activity
+
+
+def legacy_segment(table, user_ids: list) -> dict:
+    events_df = table.to_pandas()
+    return {
+        user_id: events_df[events_df['user_id'] == user_id].to_dict('records')
+        for user_id in user_ids
+    }
+
+
+def best_of(fn, repeat: int):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - t0)
+    return min(times), result
+
+
+def _report(label: str, old: float, new: float) -> None:
+    print(f"{label:<44} | legacy {old * 1000:9.1f} ms | arrow {new * 1000:9.1f} ms | speed-up {old / new:5.1f}x")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=1_000_000, help="rows in the activity snapshot")
+    parser.add_argument("--events", type=int, default=200_000, help="event rows fetched for segmentation")
+    parser.add_argument("--segment-users", type=int, default=50, help="users those events belong to")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    batch = make_activity_batch(args.users)
+    old, legacy = best_of(lambda: legacy_snapshot(batch), args.repeat)
+    new, fast = best_of(
+        lambda: arrow_records.arrow_to_nested_dict(batch, 'user_id', int_columns=['event_count', 'order_count']),
+        args.repeat,
+    )
+    sample = next(iter(legacy))
+    assert legacy.keys() == fast.keys()
+    assert legacy[sample]['event_count'] == fast[sample]['event_count']
+    assert dt.datetime.fromisoformat(legacy[sample]['created_at']) == dt.datetime.fromisoformat(fast[sample]['created_at'])
+    _report(f"snapshot dict ({args.users:,d} users)", old, new)
+
+    table = make_events_table(args.events, args.segment_users)
+    user_ids = [f"user_{i:05d}" for i in range(args.segment_users)]
+    old, legacy = best_of(lambda: legacy_segment(table, user_ids), args.repeat)
+    new, fast = best_of(lambda: arrow_records.arrow_group_records(table, 'user_id', keys=user_ids), args.repeat)
+    assert [len(legacy[u]) for u in user_ids] == [len(fast[u]) for u in user_ids]
+    _report(f"segment records ({args.events:,d} events / {args.segment_users} users)", old, new)
+
+
+if __name__ == "__main__":
+    main()
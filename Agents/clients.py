@@ -0,0 +1,343 @@
+"""
+Process-wide client pool for AdGen Agents.
+
+BigQuery, Firestore, GCS and GenAI clients are created once per process and
+credential set, then reused by every tool call. Service-account JSON from the
+environment is parsed once per distinct value. The pool is reset
+automatically in forked children. Clients are keyed by their credential
+fingerprint: when the environment credentials change, new calls get a new
+client and the old one is only dropped from the pool (threads still using it
+keep it; it is never closed underneath them). Caller-supplied credentials
+are pooled per service account and scopes; ones without a service account
+identity get an unpooled client.
+"""
+
+import base64
+import hashlib
+import json
+import os
+import threading
+from typing import Any, Callable, Dict, Hashable, Optional, Sequence, Tuple
+
+from google.oauth2 import service_account
+
+from run_context import current_run
+
+
+BQ_SCOPES = [
+    'https://www.googleapis.com/auth/bigquery',
+    'https://www.googleapis.com/auth/cloud-platform',
+]
+
+FIRESTORE_SCOPES = [
+    'https://www.googleapis.com/auth/datastore',
+    'https://www.googleapis.com/auth/cloud-platform',
+]
+
+GCS_SCOPES = [
+    'https://www.googleapis.com/auth/cloud-platform',
+    'https://www.googleapis.com/auth/devstorage.read_write',
+]
+
+DEFAULT_PROJECT_ID = 'eighth-upgrade-475017-u5'
+
+
+_lock = threading.RLock()
+_pid = os.getpid()
+# (kind, *slot, credential fingerprint) -> client
+_clients: Dict[Tuple, Any] = {}
+# credential fingerprint -> (effective fingerprint, parsed credentials); failures map to ADC
+_credentials: Dict[Hashable, Tuple[Hashable, Any]] = {}
+_stats: Dict[str, Any] = {
+    "created": {},
+    "reused": {},
+    "replaced": {},
+    "unpooled": {},
+    "credentials_parsed": 0,
+    "fork_resets": 0,
+}
+
+
+def _reset_state() -> None:
+    global _lock, _pid
+    _lock = threading.RLock()
+    _pid = os.getpid()
+    _clients.clear()
+    _credentials.clear()
+
+
+def _after_fork_in_child() -> None:
+    # gRPC channels and HTTP sessions must never be shared across processes
+    _reset_state()
+    _stats["fork_resets"] += 1
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def _ensure_same_process() -> None:
+    if os.getpid() != _pid:
+        _after_fork_in_child()
+
+
+def _bump(counter: str, kind: str) -> None:
+    bucket = _stats[counter]
+    bucket[kind] = bucket.get(kind, 0) + 1
+
+
+def default_project_id() -> str:
+    return os.getenv('GCP_PROJECT_ID', DEFAULT_PROJECT_ID)
+
+
+def _service_account_json() -> Optional[str]:
+    return os.getenv('GCP_SERVICE_ACCOUNT_JSON') or os.getenv('GCP_SERVICE_ACCOUNT_JSON_BQ')
+
+
+def resolve_credentials(
+    scopes: Optional[Sequence[str]] = None,
+    keyfile_env_vars: Sequence[str] = ('GOOGLE_APPLICATION_CREDENTIALS_BQ', 'BQ_KEYFILE'),
+) -> Tuple[Hashable, Any]:
+    """
+    Resolve service-account credentials from the environment.
+
+    Order matches the previous per-tool setup: inline/base64 JSON first
+    (Cloud Run), then a key file from ``keyfile_env_vars`` (local development),
+    otherwise ADC. Parsed credentials are cached by fingerprint, so the JSON is
+    decoded only once per distinct value; a value that fails to parse is
+    cached as ADC and not retried (or warned about) on every call.
+
+    Returns:
+        (fingerprint, credentials) where credentials is None for ADC.
+    """
+    scope_key = tuple(scopes or ())
+    sa_json = _service_account_json()
+    if sa_json:
+        digest = hashlib.sha256(sa_json.encode('utf-8')).hexdigest()
+        fingerprint: Hashable = ("json", digest, scope_key)
+    else:
+        key_path = next((os.getenv(v) for v in keyfile_env_vars if os.getenv(v)), None)
+        if key_path and os.path.exists(key_path):
+            fingerprint = ("file", key_path, os.path.getmtime(key_path), scope_key)
+        else:
+            return ("adc",), None
+
+    with _lock:
+        _ensure_same_process()
+        if fingerprint in _credentials:
+            return _credentials[fingerprint]
+
+        resolved: Tuple[Hashable, Any]
+        try:
+            if fingerprint[0] == "json":
+                info = json.loads(sa_json) if sa_json.strip().startswith('{') else json.loads(base64.b64decode(sa_json).decode('utf-8'))
+                credentials = service_account.Credentials.from_service_account_info(info, scopes=scopes or None)
+            else:
+                credentials = service_account.Credentials.from_service_account_file(fingerprint[1], scopes=scopes or None)
+            _stats["credentials_parsed"] += 1
+            resolved = (fingerprint, credentials)
+        except Exception as e:
+            # Invalid JSON/key file: fall back to ADC like the old per-tool code did
+            print(f"⚠️ [clients] failed to load service account credentials, using ADC: {e}")
+            resolved = (("adc",), None)
+        # Cached under the original fingerprint so the same bad value is not parsed again
+        _credentials[fingerprint] = resolved
+        return resolved
+
+
+def _is_explicit(fingerprint: Hashable) -> bool:
+    return isinstance(fingerprint, tuple) and bool(fingerprint) and fingerprint[0] == "explicit"
+
+
+def _explicit_fingerprint(credentials) -> Optional[Tuple]:
+    """
+    Stable pool key for caller-supplied credentials: service account email plus
+    scopes, so repeated calls with freshly built credential objects share one
+    client. Credentials without a service account identity return None and are
+    not pooled.
+    """
+    email = getattr(credentials, "service_account_email", None)
+    if not isinstance(email, str) or not email or email == "default":
+        return None
+    scopes = getattr(credentials, "scopes", None) or getattr(credentials, "default_scopes", None) or ()
+    return ("explicit", email, tuple(sorted(scopes)))
+
+
+def get_or_create(kind: str, slot: Tuple, fingerprint: Hashable, factory: Callable[[], Any]) -> Any:
+    """
+    Return the pooled client for (kind, slot, fingerprint), creating it with
+    ``factory`` if missing. A ``None`` fingerprint (credentials that cannot be
+    identified) returns a new, unpooled client.
+
+    A client for a new environment fingerprint retires the slot's clients built
+    from older environment credentials. They are removed from the pool but not
+    closed, since other threads may still hold them. Explicit credentials
+    (``("explicit", ...)``) get entries of their own and never retire others.
+    """
+    if fingerprint is None:
+        with _lock:
+            _bump("unpooled", kind)
+        return factory()
+    prefix = (kind,) + tuple(slot)
+    key = prefix + (fingerprint,)
+    with _lock:
+        _ensure_same_process()
+        client = _clients.get(key)
+        if client is not None:
+            _bump("reused", kind)
+            return client
+        client = factory()
+        if not _is_explicit(fingerprint):
+            for stale in [k for k in _clients if k[:-1] == prefix and not _is_explicit(k[-1])]:
+                del _clients[stale]
+                _bump("replaced", kind)
+        _clients[key] = client
+        _bump("created", kind)
+        return client
+
+
+def _close_quietly(client: Any) -> None:
+    close = getattr(client, "close", None)
+    if callable(close):
+        try:
+            close()
+        except Exception:
+            pass
+
+
+def get_bigquery_client(project_id: Optional[str] = None, credentials=None):
+    """Pooled ``bigquery.Client``; explicit credentials are pooled per service account and scopes."""
+    from google.cloud import bigquery
+
+    project_id = project_id or default_project_id()
+    if credentials is not None:
+        fingerprint: Optional[Hashable] = _explicit_fingerprint(credentials)
+    else:
+        fingerprint, credentials = resolve_credentials(BQ_SCOPES)
+
+    def factory():
+        client_args = {'project': project_id}
+        if credentials is not None:
+            client_args['credentials'] = credentials
+        return bigquery.Client(**client_args)
+
+    return get_or_create("bigquery", (project_id,), fingerprint, factory)
+
+
+def get_bigquery_storage_client(credentials=None):
+    """
+    Pooled ``BigQueryReadClient`` for the Storage Read API.
+
+    Raises ImportError when google-cloud-bigquery-storage is not installed;
+    callers are expected to fall back to the REST pager.
+    """
+    from google.cloud import bigquery_storage
+
+    if credentials is not None:
+        fingerprint: Optional[Hashable] = _explicit_fingerprint(credentials)
+    else:
+        fingerprint, credentials = resolve_credentials(BQ_SCOPES)
+
+    def factory():
+        if credentials is not None:
+            return bigquery_storage.BigQueryReadClient(credentials=credentials)
+        return bigquery_storage.BigQueryReadClient()
+
+    return get_or_create("bigquery_storage", (), fingerprint, factory)
+
+
+def get_firestore_client(project_id: Optional[str] = None, database_id: Optional[str] = None):
+    """Pooled ``firestore.Client`` for the configured database."""
+    from google.cloud import firestore
+
+    project_id = project_id or default_project_id()
+    database_id = database_id or os.getenv('FIRESTORE_DB_ID', 'adgen-db')
+    fingerprint, credentials = resolve_credentials(FIRESTORE_SCOPES, ('GOOGLE_APPLICATION_CREDENTIALS_BQ',))
+
+    def factory():
+        client_args = {'project': project_id, 'database': database_id}
+        if credentials is not None:
+            client_args['credentials'] = credentials
+        return firestore.Client(**client_args)
+
+    return get_or_create("firestore", (project_id, database_id), fingerprint, factory)
+
+
+def get_storage_client():
+    """Pooled ``storage.Client`` (GCS)."""
+    from google.cloud import storage
+
+    fingerprint, credentials = resolve_credentials(GCS_SCOPES, ('GOOGLE_APPLICATION_CREDENTIALS_AI',))
+
+    def factory():
+        if credentials is not None:
+            return storage.Client(credentials=credentials)
+        return storage.Client()
+
+    return get_or_create("storage", (), fingerprint, factory)
+
+
+def genai_client_kwargs(project: Optional[str] = None, location: Optional[str] = None, *, vertexai: Optional[bool] = None) -> Dict[str, Any]:
+    """
+    ``google.genai.Client`` arguments for the active run (run_context).
+
+    Explicit arguments win; otherwise the run's backend/project/location are
+    used, and outside a run GOOGLE_GENAI_USE_VERTEXAI and GOOGLE_CLOUD_PROJECT/
+    GOOGLE_CLOUD_LOCATION decide as before. API-key mode reads
+    GOOGLE_GENAI_API_KEY or GOOGLE_API_KEY.
+    """
+    run = current_run()
+    if vertexai is None:
+        if run is not None:
+            vertexai = run.backend == "vertex"
+        else:
+            vertexai = os.getenv('GOOGLE_GENAI_USE_VERTEXAI', 'True').strip().lower() in ('true', '1')
+    if not vertexai:
+        return {'vertexai': False, 'api_key': os.getenv('GOOGLE_GENAI_API_KEY') or os.getenv('GOOGLE_API_KEY')}
+    project = project or (run.project if run else None) or os.getenv('GOOGLE_CLOUD_PROJECT') or default_project_id()
+    location = location or (run.location if run else None) or os.getenv('GOOGLE_CLOUD_LOCATION', 'us-central1')
+    return {'vertexai': True, 'project': project, 'location': location}
+
+
+def genai_slot(kwargs: Dict[str, Any]) -> Tuple:
+    """Pool slot for genai_client_kwargs(); API keys are only kept as a digest."""
+    if kwargs['vertexai']:
+        return (True, kwargs['project'], kwargs['location'])
+    digest = hashlib.sha256((kwargs.get('api_key') or '').encode('utf-8')).hexdigest()[:16]
+    return (False, digest)
+
+
+def get_genai_client(project: Optional[str] = None, location: Optional[str] = None, *, vertexai: Optional[bool] = None):
+    """Pooled ``google.genai.Client`` per backend (Vertex project/location or API key) of the active run."""
+    from google import genai
+
+    kwargs = genai_client_kwargs(project, location, vertexai=vertexai)
+
+    def factory():
+        return genai.Client(**kwargs)
+
+    return get_or_create("genai", genai_slot(kwargs), ("adc",), factory)
+
+
+def client_pool_stats() -> Dict[str, Any]:
+    """Snapshot of pool counters (created/reused/replaced per client kind)."""
+    with _lock:
+        return {
+            "pid": _pid,
+            "live_clients": len(_clients),
+            "created": dict(_stats["created"]),
+            "reused": dict(_stats["reused"]),
+            "replaced": dict(_stats["replaced"]),
+            "unpooled": dict(_stats["unpooled"]),
+            "credentials_parsed": _stats["credentials_parsed"],
+            "fork_resets": _stats["fork_resets"],
+        }
+
+
+def reset_client_pool() -> None:
+    """Drop every pooled client and cached credential (e.g. after rotating keys)."""
+    with _lock:
+        for client in list(_clients.values()):
+            _close_quietly(client)
+        _clients.clear()
+        _credentials.clear()
@@ -69,6 +69,7 @@ gcloud run deploy $SERVICE_NAME \
     --memory=2Gi \
     --cpu=2 \
     --timeout=3600 \
+    --no-cpu-throttling \
     --max-instances=10 \
     --set-env-vars="GOOGLE_CLOUD_PROJECT=${PROJECT_ID}" \
     --set-env-vars="GOOGLE_CLOUD_LOCATION=${REGION}" \
@@ -78,7 +79,14 @@ gcloud run deploy $SERVICE_NAME \
     --set-env-vars="FIRESTORE_DATABASE=(default)" \
     --set-env-vars="WEBHOOK_URL=${WEBHOOK_URL}" \
     --set-env-vars="WEBHOOK_SECRET=${WEBHOOK_SECRET}" \
-    --set-env-vars="AGENTS_API_TOKEN=${AGENTS_API_TOKEN}"
+    --set-env-vars="AGENTS_API_TOKEN=${AGENTS_API_TOKEN}" \
+    --set-env-vars="JOB_STORE=firestore"
+
+# GCS_URL_MODE=public (default) serves images straight from the bucket; it needs public read access
+GCS_BUCKET="${GCS_EC_BUCKET_NAME:-ecommerce-ad-contents}"
+echo -e "${YELLOW}ℹ️  GCS_URL_MODE=public requires allUsers:roles/storage.objectViewer on gs://${GCS_BUCKET}${NC}"
+echo "   gcloud storage buckets add-iam-policy-binding gs://${GCS_BUCKET} --member=allUsers --role=roles/storage.objectViewer"
+echo "   (or set GCS_URL_MODE=signed to keep the bucket private)"
 
 # Get the service URL
 SERVICE_URL=$(gcloud run services describe $SERVICE_NAME \
@@ -95,6 +103,8 @@ echo -e "${BLUE}📡 Available Endpoints:${NC}"
 echo -e "   ${GREEN}GET${NC}  ${SERVICE_URL}/"
 echo -e "   ${GREEN}GET${NC}  ${SERVICE_URL}/health"
 echo -e "   ${GREEN}POST${NC} ${SERVICE_URL}/run"
+echo -e "   ${GREEN}POST${NC} ${SERVICE_URL}/jobs"
+echo -e "   ${GREEN}GET${NC}  ${SERVICE_URL}/jobs/<job_id>"
 echo -e "   ${GREEN}POST${NC} ${SERVICE_URL}/pubsub/push"
 echo ""
 echo -e "${BLUE}🧪 Test with curl:${NC}"
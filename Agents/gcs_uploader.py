@@ -0,0 +1,224 @@
+"""
+Concurrent GCS uploader shared by the agents.
+
+All uploads go through the pooled ``storage.Client`` from clients.py and are a
+single request by default: most objects get new names, so reading the
+existing object first would only add a round trip. With
+GCS_UPLOAD_SKIP_UNCHANGED=1 the upload is conditional (ifGenerationMatch=0);
+when the object already exists (412) its CRC32C (or MD5 when google-crc32c is
+unavailable) is compared and identical content is reported as skipped,
+otherwise it is overwritten. Public URLs are derived from configuration
+rather than a per-object ``make_public()`` ACL call, which fails on buckets
+with uniform bucket-level access anyway:
+
+  GCS_URL_MODE=public  (default) https://storage.googleapis.com/<bucket>/<object>;
+                       requires the bucket IAM binding allUsers:roles/storage.objectViewer,
+                       otherwise every URL returns 403
+  GCS_URL_MODE=signed  V4 signed GET URLs (GCS_SIGNED_URL_DAYS, default 7)
+  GCS_PUBLIC_BASE_URL  optional CDN/custom domain replacing the storage host
+
+Other settings: GCS_UPLOAD_WORKERS (upload_many concurrency, default 8) and
+GCS_UPLOAD_SKIP_UNCHANGED ("1" enables the conditional upload above). Latency and byte counters are
+exposed through gcs_upload_stats() (GET /health -> gcs_uploads).
+"""
+
+import base64
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Any, Dict, List, Optional
+from urllib.parse import quote
+
+from clients import get_storage_client
+
+
+DEFAULT_BUCKET = "ecommerce-ad-contents"
+
+_stats_lock = threading.Lock()
+_stats: Dict[str, Any] = {
+    "uploads": 0,
+    "skipped": 0,
+    "errors": 0,
+    "bytes_uploaded": 0,
+    "bytes_skipped": 0,
+    "upload_seconds_total": 0.0,
+    "upload_seconds_max": 0.0,
+}
+
+
+def default_bucket() -> str:
+    return os.getenv("GCS_EC_BUCKET_NAME") or os.getenv("GCS_CONTENT_BUCKET") or DEFAULT_BUCKET
+
+
+def _crc32c_b64(content: bytes) -> Optional[str]:
+    try:
+        import google_crc32c
+    except ImportError:
+        return None
+    return base64.b64encode(google_crc32c.Checksum(content).digest()).decode("ascii")
+
+
+def _md5_b64(content: bytes) -> str:
+    return base64.b64encode(hashlib.md5(content).digest()).decode("ascii")
+
+
+def _unchanged(existing, content: bytes) -> bool:
+    """Existing blob metadata vs local bytes: CRC32C first, then MD5 (absent for composite objects)."""
+    if existing is None or existing.size != len(content):
+        return False
+    crc32c = _crc32c_b64(content)
+    if crc32c is not None and existing.crc32c:
+        return existing.crc32c == crc32c
+    return bool(existing.md5_hash) and existing.md5_hash == _md5_b64(content)
+
+
+def public_url(bucket_name: str, object_name: str, blob=None) -> str:
+    """URL for an object from configuration only (no per-object ACL request)."""
+    if os.getenv("GCS_URL_MODE", "public").strip().lower() == "signed" and blob is not None:
+        days = int(os.getenv("GCS_SIGNED_URL_DAYS", "7"))
+        return blob.generate_signed_url(expiration=timedelta(days=days), method="GET", version="v4")
+    base = os.getenv("GCS_PUBLIC_BASE_URL")
+    path = quote(object_name, safe="/")
+    if base:
+        return f"{base.rstrip('/')}/{path}"
+    return f"https://storage.googleapis.com/{bucket_name}/{path}"
+
+
+def gs_uri(bucket_name: str, object_name: str) -> str:
+    return f"gs://{bucket_name}/{object_name}"
+
+
+def url_for_gs_uri(uri: str) -> str:
+    """
+    Current URL for a gs://bucket/object path (public_url). Store gs:// paths and
+    derive URLs when they are served: signed URLs expire.
+    """
+    if not uri.startswith("gs://"):
+        return uri
+    bucket_name, _, object_name = uri[len("gs://"):].partition("/")
+    blob = None
+    if os.getenv("GCS_URL_MODE", "public").strip().lower() == "signed":
+        blob = get_storage_client().bucket(bucket_name).blob(object_name)
+    return public_url(bucket_name, object_name, blob)
+
+
+def _record(counter: str, size: int, seconds: float = 0.0) -> None:
+    with _stats_lock:
+        if counter == "uploads":
+            _stats["uploads"] += 1
+            _stats["bytes_uploaded"] += size
+            _stats["upload_seconds_total"] += seconds
+            _stats["upload_seconds_max"] = max(_stats["upload_seconds_max"], seconds)
+        elif counter == "skipped":
+            _stats["skipped"] += 1
+            _stats["bytes_skipped"] += size
+        else:
+            _stats["errors"] += 1
+
+
+def upload_bytes(
+    content: bytes,
+    object_name: str,
+    *,
+    content_type: str = "application/octet-stream",
+    bucket_name: Optional[str] = None,
+    cache_control: Optional[str] = None,
+    skip_if_unchanged: Optional[bool] = None,
+) -> Dict[str, Any]:
+    """
+    Upload one object. With skip_if_unchanged an existing object with the same
+    checksum is left alone (see module docstring).
+
+    Returns:
+        {"url", "bucket", "object_name", "bytes", "skipped", "seconds"}
+    """
+    bucket_name = bucket_name or default_bucket()
+    object_name = object_name.lstrip("/")
+    if skip_if_unchanged is None:
+        skip_if_unchanged = os.getenv("GCS_UPLOAD_SKIP_UNCHANGED", "0") == "1"
+
+    bucket = get_storage_client().bucket(bucket_name)
+    started = time.monotonic()
+    try:
+        blob = bucket.blob(object_name)
+        if cache_control:
+            blob.cache_control = cache_control
+        if not skip_if_unchanged:
+            blob.upload_from_string(content, content_type=content_type)
+        else:
+            from google.api_core.exceptions import PreconditionFailed
+
+            try:
+                # Sadece obje yoksa yazılır; yeni isimlerde tek istek
+                blob.upload_from_string(content, content_type=content_type, if_generation_match=0)
+            except PreconditionFailed:
+                existing = bucket.get_blob(object_name)
+                if existing is not None and _unchanged(existing, content):
+                    _record("skipped", len(content))
+                    return {
+                        "url": public_url(bucket_name, object_name, existing),
+                        "bucket": bucket_name,
+                        "object_name": object_name,
+                        "bytes": len(content),
+                        "skipped": True,
+                        "seconds": round(time.monotonic() - started, 4),
+                    }
+                blob.upload_from_string(content, content_type=content_type)
+    except Exception:
+        _record("errors", len(content))
+        raise
+    seconds = time.monotonic() - started
+    _record("uploads", len(content), seconds)
+    return {
+        "url": public_url(bucket_name, object_name, blob),
+        "bucket": bucket_name,
+        "object_name": object_name,
+        "bytes": len(content),
+        "skipped": False,
+        "seconds": round(seconds, 4),
+    }
+
+
+def upload_many(items: List[Dict[str, Any]], *, max_workers: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Upload many objects concurrently.
+
+    Args:
+        items: [{"content": bytes, "object_name": str, "content_type": str, optional "bucket_name"/"cache_control"}, ...]
+
+    Returns:
+        Results in input order (upload_bytes' dict, or {"object_name", "error"} for failed items).
+    """
+    if not items:
+        return []
+    workers = max_workers or int(os.getenv("GCS_UPLOAD_WORKERS", "8"))
+
+    def run(item: Dict[str, Any]) -> Dict[str, Any]:
+        try:
+            return upload_bytes(
+                item["content"],
+                item["object_name"],
+                content_type=item.get("content_type", "application/octet-stream"),
+                bucket_name=item.get("bucket_name"),
+                cache_control=item.get("cache_control"),
+            )
+        except Exception as e:
+            print(f"⚠️  [GCS] upload failed for {item.get('object_name')}: {e}")
+            return {"object_name": item.get("object_name"), "error": str(e)}
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(items))), thread_name_prefix="gcs-upload") as pool:
+        return list(pool.map(run, items))
+
+
+def gcs_upload_stats() -> Dict[str, Any]:
+    with _stats_lock:
+        uploads = _stats["uploads"]
+        return {
+            **_stats,
+            "upload_seconds_total": round(_stats["upload_seconds_total"], 3),
+            "upload_seconds_max": round(_stats["upload_seconds_max"], 3),
+            "upload_seconds_avg": round(_stats["upload_seconds_total"] / uploads, 4) if uploads else 0.0,
+        }
@@ -0,0 +1,89 @@
+"""
+ADK model whose GenAI backend follows the active run.
+
+ADK's ``Gemini`` builds its ``google.genai.Client`` from process environment
+variables (GOOGLE_GENAI_USE_VERTEXAI, GOOGLE_CLOUD_PROJECT, GOOGLE_API_KEY, ...),
+which is why API-key rounds used to pop the Vertex variables for the whole
+process. RunAwareGemini resolves the client per call from run_context instead,
+so concurrent runs on different backends do not interfere.
+
+A 429 from the model is retried here, on the single request that failed, after
+the shared limiter has slowed down; the agent round and the tools it already
+ran are never replayed.
+
+The async HTTP clients inside ``genai.Client`` are bound to the event loop they
+first run on and every /run request uses its own loop, so clients are kept per
+(event loop, backend) and released with the loop.
+"""
+
+import asyncio
+import threading
+import weakref
+from typing import Any, Dict, Tuple
+
+from google.adk.models import google_llm
+from google.adk.models.google_llm import Gemini
+
+from clients import genai_client_kwargs, genai_slot, get_genai_client
+from rate_limiter import estimate_request_tokens, get_rate_limiter, is_rate_limit_error, rate_limit_attempts
+
+
+_lock = threading.Lock()
+_loop_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Tuple, Any]]" = weakref.WeakKeyDictionary()
+
+
+def run_genai_client():
+    """GenAI client for the active run's backend, scoped to the running event loop."""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return get_genai_client()
+    from google import genai
+
+    kwargs = genai_client_kwargs()
+    slot = genai_slot(kwargs)
+    with _lock:
+        clients = _loop_clients.setdefault(loop, {})
+        client = clients.get(slot)
+        if client is None:
+            client = clients[slot] = genai.Client(**kwargs)
+        return client
+
+
+class RunAwareGemini(Gemini):
+    """Gemini that picks Vertex AI or the Google AI API from the current RunContext."""
+
+    @property
+    def api_client(self):
+        return run_genai_client()
+
+    @property
+    def _api_backend(self):
+        # The base class caches this on first use; the backend may differ per run
+        variant = google_llm.GoogleLLMVariant
+        return variant.VERTEX_AI if self.api_client.vertexai else variant.GEMINI_API
+
+    async def generate_content_async(self, llm_request, stream: bool = False):
+        # before_model_callback paced the first attempt; a retry waits for the throttled
+        # limiter again. Once a chunk has been yielded the error is raised unchanged,
+        # a partial answer cannot be retried transparently.
+        model = getattr(llm_request, 'model', None) or self.model
+        limiter = get_rate_limiter(model)
+        attempts = rate_limit_attempts()
+        for attempt in range(1, attempts + 1):
+            yielded = False
+            try:
+                async for response in super().generate_content_async(llm_request, stream=stream):
+                    yielded = True
+                    yield response
+                return
+            except Exception as e:
+                if yielded or not is_rate_limit_error(e) or attempt == attempts:
+                    raise
+                limiter.record_throttle()
+                print(f"⏳ [rate_limiter] {model} 429 (attempt {attempt}/{attempts}), retrying the model call after limiter wait")
+                await limiter.acquire_async(estimate_request_tokens(llm_request))
+
+
+def gemini_model(name: str) -> RunAwareGemini:
+    return RunAwareGemini(model=name)
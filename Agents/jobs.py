@@ -0,0 +1,243 @@
+"""
+Background jobs for the Agents HTTP service.
+
+POST /jobs stores a job record and answers 202 right away. The pipeline runs
+on one of JOB_MAX_CONCURRENCY worker threads, each with its own event loop
+(JobRunner). Later jobs wait as "queued", and GET /jobs/<id> reads the record
+back. Request threads are therefore not held for the whole multi-round run;
+throughput is bounded by the job limit and the model rate limiters.
+
+Job store (JOB_STORE):
+  memory     in-process dict (default); keeps the newest JOB_STORE_MAX_JOBS records (default 1000)
+  firestore  'agent_jobs' collection (JOB_COLLECTION), so GET /jobs/<id> works on any
+             instance and records survive restarts
+
+A job moves queued → running → succeeded | failed. A result that cannot be
+stored as-is (Firestore size/nesting limits) is kept as ``result_json`` text;
+if no final record can be written the job is marked failed.
+
+The service must keep CPU allocated after responses (Cloud Run
+--no-cpu-throttling) for jobs to progress. Work is not persisted: a job that
+is queued or running when the instance stops is lost, and with the memory
+store its record disappears too. Pub/Sub pushes are acked when the job is
+queued, so deployments that use them should set JOB_STORE=firestore (deploy.sh
+does), which at least leaves a "running" record to detect and re-trigger.
+"""
+
+import asyncio
+import contextvars
+import json
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+class MemoryJobStore:
+    """Job records in this process only (single instance / local development)."""
+
+    name = "memory"
+
+    def __init__(self, max_jobs: int):
+        self.max_jobs = max(1, max_jobs)
+        self._jobs: "OrderedDict[str, dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self, job: dict) -> None:
+        with self._lock:
+            self._jobs[job["job_id"]] = dict(job)
+            # En eski bitmiş kayıtlar atılır; çalışan/bekleyen job'lar korunur
+            for job_id in list(self._jobs):
+                if len(self._jobs) <= self.max_jobs:
+                    break
+                if self._jobs[job_id]["status"] in ("succeeded", "failed"):
+                    del self._jobs[job_id]
+
+    def update(self, job_id: str, **fields: Any) -> None:
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id].update(fields)
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+
+class FirestoreJobStore:
+    """Job records in Firestore (doc id = job id), shared by every instance."""
+
+    name = "firestore"
+
+    def __init__(self, collection: str):
+        self.collection = collection
+
+    def _collection(self):
+        from MasterAgent.firestore_helper import get_firestore_client
+        return get_firestore_client().collection(self.collection)
+
+    def create(self, job: dict) -> None:
+        self._collection().document(job["job_id"]).set(job)
+
+    def update(self, job_id: str, **fields: Any) -> None:
+        self._collection().document(job_id).set(fields, merge=True)
+
+    def get(self, job_id: str) -> Optional[dict]:
+        snap = self._collection().document(job_id).get()
+        return snap.to_dict() if snap.exists else None
+
+
+class JobRunner:
+    """
+    Worker threads that each run one job on a fresh event loop (asyncio.run).
+
+    Agent tools are synchronous (BigQuery, Firestore, Imagen waits), so jobs
+    sharing one loop would block each other; a thread per active job keeps
+    them independent, the same way /run runs on its request thread.
+    """
+
+    # Firestore documents are limited to 1 MiB; leave room for the other fields
+    MAX_RESULT_JSON_BYTES = 900_000
+
+    def __init__(self, max_concurrency: int):
+        self.max_concurrency = max(1, max_concurrency)
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="job-worker")
+        self._stats = {"submitted": 0, "queued": 0, "running": 0, "succeeded": 0, "failed": 0, "store_errors": 0}
+
+    def _bump(self, **deltas: int) -> None:
+        with self._lock:
+            for counter, delta in deltas.items():
+                self._stats[counter] += delta
+
+    def submit(self, store, job_id: str, work: Callable[[], Awaitable[Any]]) -> Future:
+        """Schedule ``work()`` for an already stored job; returns a concurrent Future."""
+        self._bump(submitted=1, queued=1)
+        return self._pool.submit(contextvars.copy_context().run, self._run, store, job_id, work)
+
+    def _run(self, store, job_id: str, work: Callable[[], Awaitable[Any]]) -> None:
+        self._bump(queued=-1, running=1)
+        try:
+            store.update(job_id, status="running", started_at=_now())
+            result = asyncio.run(work())
+        except Exception as e:
+            print(f"❌ [jobs] job {job_id} failed: {e}")
+            self._finish(store, job_id, "failed", [{"error": str(e)}])
+            return
+        # Sonuç olduğu gibi yazılamazsa (boyut, iç içe array) JSON metni olarak saklanır
+        attempts = [{"result": result}]
+        try:
+            result_json = json.dumps(result, default=str, ensure_ascii=False)
+        except Exception:
+            result_json = None
+        if result_json is not None and len(result_json.encode("utf-8")) <= self.MAX_RESULT_JSON_BYTES:
+            attempts.append({"result": None, "result_json": result_json})
+        self._finish(store, job_id, "succeeded", attempts)
+
+    def _finish(self, store, job_id: str, status: str, attempts: List[Dict[str, Any]]) -> None:
+        """Write the final record, trying each field set in turn; counters change only after a write succeeds."""
+        last_error = None
+        for fields in attempts:
+            try:
+                store.update(job_id, status=status, finished_at=_now(), **fields)
+                self._bump(running=-1, **{status: 1})
+                return
+            except Exception as e:
+                last_error = e
+                print(f"⚠️ [jobs] could not store {status} record for {job_id}: {e}")
+        # Hiçbiri yazılamadı: job'u depolama hatasıyla failed işaretle
+        self._bump(store_errors=1)
+        try:
+            store.update(job_id, status="failed", finished_at=_now(), result=None,
+                         error=f"job finished as {status} but its record could not be stored: {last_error}")
+        except Exception as e:
+            print(f"❌ [jobs] job {job_id} record is stale: {e}")
+        self._bump(running=-1, failed=1)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"max_concurrency": self.max_concurrency, **self._stats}
+
+
+_store = None
+_runner: Optional[JobRunner] = None
+_state_lock = threading.Lock()
+
+
+def get_job_store():
+    """Process-wide job store from JOB_STORE (memory | firestore)."""
+    global _store
+    with _state_lock:
+        if _store is None:
+            backend = os.getenv("JOB_STORE", "memory").strip().lower()
+            if backend == "firestore":
+                _store = FirestoreJobStore(os.getenv("JOB_COLLECTION", "agent_jobs"))
+            else:
+                _store = MemoryJobStore(int(os.getenv("JOB_STORE_MAX_JOBS", "1000")))
+            print(f"🗂️ [jobs] store={_store.name}")
+        return _store
+
+
+def _get_runner() -> JobRunner:
+    global _runner
+    with _state_lock:
+        if _runner is None:
+            _runner = JobRunner(int(os.getenv("JOB_MAX_CONCURRENCY", str(min(4, os.cpu_count() or 1)))))
+        return _runner
+
+
+def _reset_after_fork() -> None:
+    # Worker threads do not survive fork
+    global _store, _runner, _state_lock
+    _store = None
+    _runner = None
+    _state_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def submit_job(job_id: str, work: Callable[[], Awaitable[Any]], **fields: Any) -> dict:
+    """
+    Store a queued job and schedule ``work()`` (a coroutine function) on a job worker.
+
+    Args:
+        job_id: unique id (also the document id in the Firestore store)
+        work: returns the JSON-serialisable result saved on success
+        fields: extra record fields (run_id, prompt, ...)
+
+    Returns:
+        The stored job record.
+    """
+    job = {
+        "job_id": job_id,
+        "status": "queued",
+        "created_at": _now(),
+        "started_at": None,
+        "finished_at": None,
+        "result": None,
+        "error": None,
+        **fields,
+    }
+    store = get_job_store()
+    store.create(job)
+    _get_runner().submit(store, job_id, work)
+    return job
+
+
+def get_job(job_id: str) -> Optional[dict]:
+    return get_job_store().get(job_id)
+
+
+def job_stats() -> Dict[str, Any]:
+    with _state_lock:
+        runner, store = _runner, _store
+    stats = runner.stats() if runner is not None else {"submitted": 0, "queued": 0, "running": 0, "succeeded": 0, "failed": 0, "store_errors": 0}
+    return {"store": store.name if store is not None else os.getenv("JOB_STORE", "memory"), **stats}
@@ -75,6 +75,7 @@ def _ensure_genai_env() -> None:
 _ensure_genai_env()
 
 from MasterAgent.agent import root_agent  # type: ignore
+from run_context import run_scope  # type: ignore
 import MasterAgent.agent as master_agent_module  # type: ignore
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
@@ -162,20 +163,10 @@ async def run_with_session_rollover(initial_prompt: str, max_rounds: int = 8) ->
                 # 429 fallback: temporarily prefer API key by removing Vertex hints, then retry once
                 if getattr(ce, "status_code", None) == 429 and attempt < max_attempts:
                     logger.warning("Vertex AI rate-limited (429). Falling back to API key for this round.")
-                    original_project = os.environ.pop("GOOGLE_CLOUD_PROJECT", None)
-                    original_location = os.environ.pop("GOOGLE_CLOUD_LOCATION", None)
-                    # Ensure API key variable name is available to client (either is fine)
-                    if os.getenv("GOOGLE_API_KEY") and not os.getenv("GOOGLE_GENAI_API_KEY"):
-                        os.environ["GOOGLE_GENAI_API_KEY"] = os.environ["GOOGLE_API_KEY"]
-                    try:
+                    # Backend is switched for this round's RunContext only; os.environ stays untouched
+                    with run_scope(run_id=session_id, backend="api_key"):
                         last_text = await _run_once()
-                        break
-                    finally:
-                        # Restore env to original state for subsequent rounds
-                        if original_project is not None:
-                            os.environ["GOOGLE_CLOUD_PROJECT"] = original_project
-                        if original_location is not None:
-                            os.environ["GOOGLE_CLOUD_LOCATION"] = original_location
+                    break
                 else:
                     raise
 
@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 """
 Cloud Run HTTP server for AdGen Agents.
-Receives HTTP requests and runs the MasterAgent using InMemoryRunner.
+Receives HTTP requests and runs the MasterAgent using InMemoryRunner,
+either inline (/run) or as a background job (/jobs, see jobs.py).
 """
 
 import os
@@ -78,7 +79,14 @@ from google.adk.runners import InMemoryRunner
 from google.adk.agents.run_config import RunConfig
 from google.genai import types
 from google.genai.errors import ClientError  # type: ignore
-from webhook import report_progress
+from webhook import flush_progress, progress_reporter_stats, report_progress
+from clients import client_pool_stats
+from rate_limiter import rate_limiter_stats
+from DataAnalyticAgent.segmentation_cache import segmentation_cache_stats
+from CreativeAgent.image_cache import image_cache_stats
+from gcs_uploader import gcs_upload_stats
+from run_context import current_run, run_scope
+from jobs import get_job, job_stats, submit_job
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
@@ -125,12 +133,21 @@ def _wrap_segmentation_prompt(user_prompt: str) -> str:
     Add strict guard-rails for the segmentation phase so the agent does only the needed calls
     and returns a minimal JSON status.
     """
+    if os.getenv('SEGMENTATION_MODE', 'llm').strip().lower() == 'rules':
+        return (
+            "You are the MasterAgent coordinating a segmentation workflow in RULE-BASED mode.\n"
+            "1) Call segment_pending_users_with_rules exactly once.\n"
+            "2) Do NOT call read_users_to_segmentate, write_user_segmentation_result, retrieve_user_activity_counts, "
+            "compare_event_counts, or write_user_activity_to_firestore in this phase.\n"
+            "3) Return ONLY {\"status\": <status returned by the tool>}. No extra words.\n\n"
+            f"Task: {user_prompt}"
+        )
     return (
         "You are the MasterAgent coordinating a segmentation workflow.\n"
         "Follow these strict rules:\n"
         "1) First, call read_users_to_segmentate. If it returns status='no_pending_users', "
         "IMMEDIATELY return {\"status\":\"segmentation_finished\"}.\n"
-        "2) Otherwise, process up to 5 users by calling write_user_segmentation_result for each.\n"
+        "2) Otherwise, segment the returned users and save them with ONE write_user_segmentation_results call.\n"
         "3) Do NOT call retrieve_user_activity_counts, compare_event_counts, or write_user_activity_to_firestore in this phase.\n"
         "4) Let remaining = pending_total - processed_count. "
         "If remaining > 0 then return {\"status\":\"continue\"} else return {\"status\":\"segmentation_finished\"}.\n"
@@ -167,22 +184,37 @@ def _wrap_creative_prompt(user_prompt: str) -> str:
     )
 
 
+def _api_key_available() -> bool:
+    return bool(os.getenv("GOOGLE_GENAI_API_KEY") or os.getenv("GOOGLE_API_KEY"))
+
+
 async def run_agent_with_rollover(prompt: str, max_rounds: int = 8, run_id: Optional[str] = None, prefer_api: bool = False) -> dict:
     """
     Run the master agent with session rollover.
     Uses agent cloning for fresh sessions to avoid context pollution.
+
+    Runs inside a RunContext (run_context.py) for run_id; webhook target and deadline
+    are inherited from the caller's scope when there is one.
     """
     run_id = run_id or f"http-{uuid.uuid4().hex[:8]}"
+    with run_scope(run_id=run_id):
+        return await _run_rounds(prompt, max_rounds, run_id, prefer_api)
+
+
+async def _run_rounds(prompt: str, max_rounds: int, run_id: str, prefer_api: bool) -> dict:
     report_progress(run_id=run_id, agent="MasterAgent", status="started", message="Run started")
     rounds = 0
     agent_instance = root_agent
     current_prompt = prompt
     statuses = []
     last_result = None
-    # Propagate run id to tools via environment so they can report progress
-    os.environ["AGENTS_CURRENT_RUN_ID"] = run_id
 
     while True:
+        run = current_run()
+        if rounds and run is not None and run.expired():
+            logger.warning(f"⏱️ Run deadline reached after {rounds} rounds, stopping")
+            report_progress(run_id=run_id, agent="MasterAgent", status="progress", message="Run deadline reached", step=str(rounds))
+            break
         rounds += 1
         logger.info(f"🔄 Agent round {rounds}/{max_rounds}")
         report_progress(run_id=run_id, agent="MasterAgent", status="progress", message=f"Round {rounds} started", step=str(rounds))
@@ -196,8 +228,6 @@ async def run_agent_with_rollover(prompt: str, max_rounds: int = 8, run_id: Opti
         
         # Prefer Google AI API (API key) for segmentation bursts to reduce Vertex 429s,
         # but keep Vertex for content creation (Imagen).
-        original_project = None
-        original_location = None
         lower_prompt = (current_prompt or "").lower()
         is_content_task = any(
             key in lower_prompt
@@ -209,12 +239,9 @@ async def run_agent_with_rollover(prompt: str, max_rounds: int = 8, run_id: Opti
                 "imagen",
             ]
         )
-        # Prefer Google AI API (API key) when requested or for non-content tasks
-        if prefer_api or not is_content_task:
-            original_project = os.environ.pop("GOOGLE_CLOUD_PROJECT", None)
-            original_location = os.environ.pop("GOOGLE_CLOUD_LOCATION", None)
-            if os.getenv("GOOGLE_API_KEY") and not os.getenv("GOOGLE_GENAI_API_KEY"):
-                os.environ["GOOGLE_GENAI_API_KEY"] = os.environ["GOOGLE_API_KEY"]
+        # Prefer Google AI API (API key) when requested or for non-content tasks. The backend is
+        # scoped to this round's RunContext (read by RunAwareGemini), not written to os.environ.
+        backend = "api_key" if (prefer_api or not is_content_task) and _api_key_available() else "vertex"
 
         async def _run_once() -> Optional[str]:
             nonlocal session_id
@@ -222,7 +249,7 @@ async def run_agent_with_rollover(prompt: str, max_rounds: int = 8, run_id: Opti
             async with InMemoryRunner(agent=agent_instance, app_name="agents") as runner:
                 # Build guarded prompt based on phase
                 eff_prompt = _wrap_creative_prompt(current_prompt) if is_content_task else _wrap_segmentation_prompt(current_prompt)
-                logger.info(f"🧭 Using prompt wrapper: {'creative' if is_content_task else 'segmentation'}")
+                logger.info(f"🧭 Using prompt wrapper: {'creative' if is_content_task else 'segmentation'}, backend={backend}")
                 new_message = types.Content(parts=[types.Part(text=eff_prompt)], role="user")
                 # Ensure session exists
                 await runner.session_service.create_session(
@@ -254,34 +281,20 @@ async def run_agent_with_rollover(prompt: str, max_rounds: int = 8, run_id: Opti
                         pass
             return txt
         
-        # Try once; if Vertex rate limits (429) and we weren't already preferring API, retry once via API key
+        # 429s are retried per model call inside RunAwareGemini under the shared limiter;
+        # the round itself runs once so tools (claims, writes, Imagen batches) are not replayed.
         try:
-            last_text = await _run_once()
+            with run_scope(backend=backend):
+                last_text = await _run_once()
         except ClientError as ce:  # type: ignore
-            if getattr(ce, "status_code", None) == 429 and not (prefer_api or is_content_task):
-                logger.warning("Vertex 429 Resource exhausted. Retrying this round with API key path.")
-                # Temporarily drop Vertex hints and map API key
-                tmp_project = os.environ.pop("GOOGLE_CLOUD_PROJECT", None)
-                tmp_location = os.environ.pop("GOOGLE_CLOUD_LOCATION", None)
-                if os.getenv("GOOGLE_API_KEY") and not os.getenv("GOOGLE_GENAI_API_KEY"):
-                    os.environ["GOOGLE_GENAI_API_KEY"] = os.getenv("GOOGLE_API_KEY", "")
-                try:
-                    last_text = await _run_once()
-                finally:
-                    # Restore original env to avoid impacting next rounds
-                    if tmp_project is not None:
-                        os.environ["GOOGLE_CLOUD_PROJECT"] = tmp_project
-                    if tmp_location is not None:
-                        os.environ["GOOGLE_CLOUD_LOCATION"] = tmp_location
-            else:
-                logger.error(f"❌ Error in round {rounds}: {ce}", exc_info=True)
-                report_progress(run_id=run_id, agent="MasterAgent", status="error", message=str(ce), step=str(rounds))
-                return {
-                    "error": str(ce),
-                    "rounds": rounds,
-                    "statuses": statuses,
-                    "success": False
-                }
+            logger.error(f"❌ Error in round {rounds}: {ce}", exc_info=True)
+            report_progress(run_id=run_id, agent="MasterAgent", status="error", message=str(ce), step=str(rounds))
+            return {
+                "error": str(ce),
+                "rounds": rounds,
+                "statuses": statuses,
+                "success": False
+            }
         except Exception as e:
             logger.error(f"❌ Error in round {rounds}: {e}", exc_info=True)
             report_progress(run_id=run_id, agent="MasterAgent", status="error", message=str(e), step=str(rounds))
@@ -291,12 +304,6 @@ async def run_agent_with_rollover(prompt: str, max_rounds: int = 8, run_id: Opti
                 "statuses": statuses,
                 "success": False
             }
-        finally:
-            # Restore Vertex env hints if we had temporarily removed them
-            if original_project is not None:
-                os.environ["GOOGLE_CLOUD_PROJECT"] = original_project
-            if original_location is not None:
-                os.environ["GOOGLE_CLOUD_LOCATION"] = original_location
         
         # Parse result
         try:
@@ -342,19 +349,172 @@ def health():
     return jsonify({
         "status": "healthy",
         "service": "adgen-agents",
-        "agent": root_agent.name
+        "agent": root_agent.name,
+        "client_pool": client_pool_stats(),
+        "rate_limits": rate_limiter_stats(),
+        "segmentation_cache": segmentation_cache_stats(),
+        "image_cache": image_cache_stats(),
+        "gcs_uploads": gcs_upload_stats(),
+        "progress_reporter": progress_reporter_stats(),
+        "jobs": job_stats(),
+    })
+
+
+def _extract_status_from_result(res_obj) -> str:
+    """Parse status safely from a round result."""
+    try:
+        if isinstance(res_obj, dict):
+            status_val = str(res_obj.get("status") or "")
+            return status_val
+        if isinstance(res_obj, str):
+            parsed = json.loads(res_obj)
+            if isinstance(parsed, dict):
+                return str(parsed.get("status") or "")
+    except Exception:
+        return ""
+    return ""
+
+
+async def execute_run(prompt: str, max_rounds: int, run_id: str, prefer_api: bool) -> dict:
+    """
+    Primary run plus follow-ups (continue -> segmentation, segmentation_finished -> creative).
+    Call inside run_scope() so every round shares the run's webhook target and deadline.
+    All rounds run on the caller's event loop (one loop per request or per job worker).
+    """
+    # First run
+    logger.info(f"🚀 Starting primary run (prefer_api={prefer_api})")
+    result = await run_agent_with_rollover(prompt, max_rounds, run_id=run_id, prefer_api=prefer_api)
+    logger.info(f"📤 Primary run completed: rounds={result.get('rounds')}, success={result.get('success')}")
+    
+    statuses = list(result.get("statuses") or [])
+    last_status = _extract_status_from_result(result.get("result"))
+    followups: list[dict] = []
+    logger.info(f"🔎 Extracted status='{last_status or 'n/a'}' from primary run")
+    
+    # Resolve follow-ups similarly to cronjob: continue -> continue prompt; segmentation_finished -> creative prompt
+    max_depth = 8
+    depth = 0
+    while depth < max_depth:
+        s = (last_status or "").strip().lower()
+        if not s:
+            break
+        run = current_run()
+        if run is not None and run.expired():
+            logger.warning(f"⏱️ Run deadline reached, skipping follow-up for status='{s}'")
+            break
+        if s == "continue":
+            depth += 1
+            cont_prompt = "Continue your segmentation task starting from reading_users_to_segmentate step"
+            logger.info(f"🔄 Follow-up {depth}: sending continue prompt")
+            fu = await run_agent_with_rollover(cont_prompt, max_rounds=4, run_id=run_id, prefer_api=True)
+            followups.append({"prompt": cont_prompt, "result": fu.get("result"), "rounds": fu.get("rounds")})
+            statuses.extend(fu.get("statuses") or [])
+            last_status = _extract_status_from_result(fu.get("result"))
+            logger.info(f"🔎 Follow-up {depth} status='{last_status or 'n/a'}'")
+            continue
+        if s == "segmentation_finished":
+            depth += 1
+            creative_prompt = "Write location segmentation pairs to firestore and do your content creation task for ecommerce"
+            logger.info(f"🎨 Triggering creative content step (follow-up {depth})")
+            report_progress(run_id=run_id, agent="MasterAgent", status="progress", message="Starting creative content step", step=f"creative_{depth}")
+            fu = await run_agent_with_rollover(creative_prompt, max_rounds=4, run_id=run_id, prefer_api=False)
+            followups.append({"prompt": creative_prompt, "result": fu.get("result"), "rounds": fu.get("rounds")})
+            statuses.extend(fu.get("statuses") or [])
+            last_status = _extract_status_from_result(fu.get("result"))
+            logger.info(f"🖼️ Creative step status='{last_status or 'n/a'}'")
+            # Continue resolving until terminal
+            continue
+        # Terminal statuses
+        if s in ("flow_finished", "finished", "error", "failed", "no_pending", "no_pending_users"):
+            break
+        # Unrecognized -> stop
+        break
+    
+    final = {
+        **result,
+        "followups": followups,
+        "statuses": statuses,
+        "final_status": last_status or None,
+    }
+    report_progress(run_id=run_id, agent="MasterAgent", status="completed", message="Run completed")
+    return final
+
+
+def _run_request_params(data: dict, req) -> dict:
+    """Run parameters shared by /run and /jobs (JSON body plus X-Run-Id / X-Prefer-Api headers)."""
+    run_id = data.get('run_id') or req.headers.get('X-Run-Id') or f"http-{uuid.uuid4().hex[:8]}"
+    # Prefer API flag can be passed via JSON or header
+    prefer_api = False
+    try:
+        prefer_api = bool(data.get('prefer_api'))
+    except Exception:
+        prefer_api = False
+    header_prefer = (req.headers.get('X-Prefer-Api') or "").strip().lower()
+    if header_prefer in ("1", "true", "yes"):
+        prefer_api = True
+    deadline_seconds = data.get('deadline_seconds') or os.getenv('RUN_DEADLINE_SECONDS')
+    return {
+        "prompt": data['prompt'],
+        "max_rounds": data.get('max_rounds', 8),
+        "run_id": run_id,
+        "prefer_api": prefer_api,
+        # Webhook target and deadline belong to this run only (RunContext), not the process env
+        "webhook_url": data.get('webhook_url') or None,
+        "webhook_secret": data.get('webhook_secret') or None,
+        "deadline_seconds": float(deadline_seconds) if deadline_seconds else None,
+    }
+
+
+async def run_pipeline(params: dict) -> dict:
+    """execute_run inside the run's RunContext; queued progress events are flushed at the end."""
+    try:
+        with run_scope(
+            run_id=params["run_id"],
+            webhook_url=params.get("webhook_url"),
+            webhook_secret=params.get("webhook_secret"),
+            deadline_seconds=params.get("deadline_seconds"),
+        ):
+            return await execute_run(params["prompt"], params["max_rounds"], params["run_id"], params["prefer_api"])
+    finally:
+        # Progress events are sent in the background; deliver the rest before finishing
+        await asyncio.to_thread(flush_progress)
+
+
+def _accept_job(params: dict):
+    """Queue run_pipeline(params) as a background job and answer 202 with its id."""
+    job_id = uuid.uuid4().hex
+    # webhook_secret is only kept in memory for the run, never in the job record
+    job = submit_job(
+        job_id,
+        lambda: run_pipeline(params),
+        run_id=params["run_id"],
+        prompt=str(params["prompt"])[:500],
+        max_rounds=params["max_rounds"],
+        prefer_api=params["prefer_api"],
+    )
+    logger.info(f"🗂️ Job {job_id} queued for run_id={params['run_id']}")
+    response = jsonify({
+        "job_id": job_id,
+        "run_id": params["run_id"],
+        "status": job["status"],
+        "status_url": f"/jobs/{job_id}",
     })
+    response.headers["Location"] = f"/jobs/{job_id}"
+    return response, 202
 
 
 @app.route('/run', methods=['POST'])
 def run_agent():
     """
-    Main endpoint to run the agent.
+    Main endpoint to run the agent (blocks until the whole pipeline finishes).
+    With the header "Prefer: respond-async" it behaves like POST /jobs instead.
     
     Request body:
     {
         "prompt": "Your prompt here",
-        "max_rounds": 8  // optional, default 8
+        "max_rounds": 8,  // optional, default 8
+        "webhook_url": "...", "webhook_secret": "...",  // optional, this run only
+        "deadline_seconds": 900  // optional, default RUN_DEADLINE_SECONDS
     }
     
     Response:
@@ -380,97 +540,18 @@ def run_agent():
                 }
             }), 400
         
-        prompt = data['prompt']
-        max_rounds = data.get('max_rounds', 8)
-        run_id = data.get('run_id') or request.headers.get('X-Run-Id') or f"http-{uuid.uuid4().hex[:8]}"
-        # Prefer API flag can be passed via JSON or header
-        prefer_api = False
-        try:
-            prefer_api = bool(data.get('prefer_api'))
-        except Exception:
-            prefer_api = False
-        header_prefer = (request.headers.get('X-Prefer-Api') or "").strip().lower()
-        if header_prefer in ("1", "true", "yes"):
-            prefer_api = True
-        
-        # Set webhook environment variables if provided in request
-        webhook_url = data.get('webhook_url')
-        webhook_secret = data.get('webhook_secret')
-        if webhook_url:
-            os.environ['WEBHOOK_URL'] = webhook_url
-            logger.info(f"🔔 Webhook URL set: {webhook_url}")
-        if webhook_secret:
-            os.environ['WEBHOOK_SECRET'] = webhook_secret
+        params = _run_request_params(data, request)
+        if params["webhook_url"]:
+            logger.info(f"🔔 Webhook URL set: {params['webhook_url']}")
+        if params["webhook_secret"]:
             logger.info(f"🔑 Webhook secret configured")
         
-        logger.info(f"📥 Received request: prompt='{prompt[:50]}...', max_rounds={max_rounds}, run_id={run_id}, prefer_api={prefer_api}")
-        
-        # Helper to parse status safely
-        def _extract_status_from_result(res_obj) -> str:
-            try:
-                if isinstance(res_obj, dict):
-                    status_val = str(res_obj.get("status") or "")
-                    return status_val
-                if isinstance(res_obj, str):
-                    parsed = json.loads(res_obj)
-                    if isinstance(parsed, dict):
-                        return str(parsed.get("status") or "")
-            except Exception:
-                return ""
-            return ""
-        
-        # First run
-        logger.info(f"🚀 Starting primary run (prefer_api={prefer_api})")
-        result = asyncio.run(run_agent_with_rollover(prompt, max_rounds, run_id=run_id, prefer_api=prefer_api))
-        logger.info(f"📤 Primary run completed: rounds={result.get('rounds')}, success={result.get('success')}")
+        logger.info(f"📥 Received request: prompt='{params['prompt'][:50]}...', max_rounds={params['max_rounds']}, run_id={params['run_id']}, prefer_api={params['prefer_api']}")
         
-        statuses = list(result.get("statuses") or [])
-        last_status = _extract_status_from_result(result.get("result"))
-        followups: list[dict] = []
-        logger.info(f"🔎 Extracted status='{last_status or 'n/a'}' from primary run")
-        
-        # Resolve follow-ups similarly to cronjob: continue -> continue prompt; segmentation_finished -> creative prompt
-        max_depth = 8
-        depth = 0
-        while depth < max_depth:
-            s = (last_status or "").strip().lower()
-            if not s:
-                break
-            if s == "continue":
-                depth += 1
-                cont_prompt = "Continue your segmentation task starting from reading_users_to_segmentate step"
-                logger.info(f"🔄 Follow-up {depth}: sending continue prompt")
-                fu = asyncio.run(run_agent_with_rollover(cont_prompt, max_rounds=4, run_id=run_id, prefer_api=True))
-                followups.append({"prompt": cont_prompt, "result": fu.get("result"), "rounds": fu.get("rounds")})
-                statuses.extend(fu.get("statuses") or [])
-                last_status = _extract_status_from_result(fu.get("result"))
-                logger.info(f"🔎 Follow-up {depth} status='{last_status or 'n/a'}'")
-                continue
-            if s == "segmentation_finished":
-                depth += 1
-                creative_prompt = "Write location segmentation pairs to firestore and do your content creation task for ecommerce"
-                logger.info(f"🎨 Triggering creative content step (follow-up {depth})")
-                report_progress(run_id=run_id, agent="MasterAgent", status="progress", message="Starting creative content step", step=f"creative_{depth}")
-                fu = asyncio.run(run_agent_with_rollover(creative_prompt, max_rounds=4, run_id=run_id, prefer_api=False))
-                followups.append({"prompt": creative_prompt, "result": fu.get("result"), "rounds": fu.get("rounds")})
-                statuses.extend(fu.get("statuses") or [])
-                last_status = _extract_status_from_result(fu.get("result"))
-                logger.info(f"🖼️ Creative step status='{last_status or 'n/a'}'")
-                # Continue resolving until terminal
-                continue
-            # Terminal statuses
-            if s in ("flow_finished", "finished", "error", "failed", "no_pending", "no_pending_users"):
-                break
-            # Unrecognized -> stop
-            break
+        if "respond-async" in (request.headers.get('Prefer') or "").lower():
+            return _accept_job(params)
         
-        final = {
-            **result,
-            "followups": followups,
-            "statuses": statuses,
-            "final_status": last_status or None,
-        }
-        report_progress(run_id=run_id, agent="MasterAgent", status="completed", message="Run completed")
+        final = asyncio.run(run_pipeline(params))
         return jsonify(final), 200
         
     except Exception as e:
@@ -481,6 +562,69 @@ def run_agent():
         }), 500
 
 
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    """
+    Queue an agent run and return immediately.
+    
+    Request body: same as /run.
+    
+    Response (202, Location: /jobs/<job_id>):
+    {"job_id": "...", "run_id": "...", "status": "queued", "status_url": "/jobs/<job_id>"}
+    """
+    try:
+        if not _is_authorized(request):
+            return jsonify({"error": "unauthorized"}), 401
+
+        data = request.get_json(silent=True)
+        if not data or 'prompt' not in data:
+            return jsonify({
+                "error": "Missing 'prompt' in request body",
+                "example": {
+                    "prompt": "Do your segmentation task.",
+                    "max_rounds": 8
+                }
+            }), 400
+
+        params = _run_request_params(data, request)
+        logger.info(f"📥 Job request: prompt='{params['prompt'][:50]}...', max_rounds={params['max_rounds']}, run_id={params['run_id']}, prefer_api={params['prefer_api']}")
+        return _accept_job(params)
+
+    except Exception as e:
+        logger.error(f"❌ Error queuing job: {e}", exc_info=True)
+        return jsonify({
+            "error": str(e),
+            "success": False
+        }), 500
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job_status(job_id: str):
+    """
+    Job status and, once finished, the same result body /run returns.
+    
+    Response:
+    {"job_id", "run_id", "status": "queued|running|succeeded|failed",
+     "created_at", "started_at", "finished_at", "result": {...} | null, "error": str | null}
+    When the result could not be stored as-is it is returned as "result_json" (JSON text).
+    """
+    try:
+        if not _is_authorized(request):
+            return jsonify({"error": "unauthorized"}), 401
+
+        job = get_job(job_id)
+        if job is None:
+            return jsonify({"error": "job not found", "job_id": job_id}), 404
+        return jsonify(job), 200
+
+    except Exception as e:
+        logger.error(f"❌ Error reading job {job_id}: {e}", exc_info=True)
+        return jsonify({
+            "error": str(e),
+            "success": False
+        }), 500
+
+
 @app.route('/pubsub/push', methods=['POST'])
 def pubsub_push():
     """
@@ -515,10 +659,21 @@ def pubsub_push():
         
         logger.info(f"🔔 Pub/Sub trigger received: prompt='{prompt[:50]}...'")
         
-        # Run agent asynchronously
-        result = asyncio.run(run_agent_with_rollover(prompt, max_rounds))
-        
-        logger.info(f"✅ Pub/Sub job completed: rounds={result.get('rounds')}")
+        # Run agent as a background job; the message is acked right away instead of
+        # holding the push request (and risking redelivery) for the whole run
+        run_id = f"pubsub-{uuid.uuid4().hex[:8]}"
+
+        async def work() -> dict:
+            try:
+                return await run_agent_with_rollover(prompt, max_rounds, run_id=run_id)
+            finally:
+                await asyncio.to_thread(flush_progress)
+
+        job_id = uuid.uuid4().hex
+        submit_job(job_id, work, run_id=run_id, prompt=str(prompt)[:500], max_rounds=max_rounds, source="pubsub")
+        if job_stats()["store"] == "memory":
+            logger.warning("⚠️ Pub/Sub message acked into the in-memory job store; it is lost if this instance stops (set JOB_STORE=firestore)")
+        logger.info(f"🗂️ Pub/Sub job {job_id} queued for run_id={run_id}")
         
         # For Pub/Sub, we just need to return 200 OK
         return '', 204
@@ -545,12 +700,21 @@ def index():
                 "description": "Run agent with prompt",
                 "body": {
                     "prompt": "string (required)",
-                    "max_rounds": "number (optional, default 8)"
+                    "max_rounds": "number (optional, default 8)",
+                    "deadline_seconds": "number (optional, default RUN_DEADLINE_SECONDS)"
                 }
             },
+            "/jobs": {
+                "method": "POST",
+                "description": "Queue an agent run; returns 202 with job_id (body as /run)"
+            },
+            "/jobs/<job_id>": {
+                "method": "GET",
+                "description": "Job status (queued, running, succeeded, failed) and result"
+            },
             "/pubsub/push": {
                 "method": "POST",
-                "description": "Pub/Sub push endpoint for async triggers"
+                "description": "Pub/Sub push endpoint for async triggers (queued as a job)"
             }
         },
         "example": {
@@ -0,0 +1,359 @@
+"""
+Process-wide rate limiting for LLM and Imagen calls.
+
+Every model gets a limiter with two token buckets: requests per minute and
+tokens per minute (TPM is skipped when its limit is 0). A caller reserves
+capacity up front and sleeps only for the time its reservation needs, so
+concurrent callers are served in order and the process runs at the quota
+ceiling instead of sleeping a fixed amount between calls.
+
+With adaptive mode on (default) the limiter follows AIMD: a 429 halves the
+effective rate and each successful call adds a small step back until the
+configured limit is reached again.
+
+Configuration (environment):
+  LLM_RPM / LLM_TPM        Gemini defaults (60 requests, 1,000,000 tokens per minute)
+  IMAGEN_RPM               Imagen default (20 requests per minute)
+  RATE_LIMITS              JSON overrides per model, e.g. {"gemini-2.5-pro": {"rpm": 120, "tpm": 2000000}}
+  RATE_LIMIT_ADAPTIVE      "0" disables AIMD
+  RATE_LIMIT_MAX_ATTEMPTS  Attempts per model call on 429 (default 4)
+
+Wait metrics are exposed through rate_limiter_stats() (GET /health -> rate_limits).
+"""
+
+import asyncio
+import contextvars
+import json
+import math
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+
+DEFAULT_LLM_MODEL = 'gemini-2.5-pro'
+
+# AIMD ayarları: 429'da hız yarıya iner, her başarılı çağrı %2 geri ekler
+_DECREASE_FACTOR = 0.5
+_INCREASE_STEP = 0.02
+_MIN_FACTOR = 0.05
+# Aynı dakika penceresinden gelen 429 yığını tek düşüş sayılır
+_DECREASE_COOLDOWN_SECONDS = 5.0
+
+CHARS_PER_TOKEN = 4
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+def _model_family(model: str) -> str:
+    return 'imagen' if 'imagen' in (model or '').lower() else 'llm'
+
+
+def _configured_limits(model: str) -> Tuple[int, int]:
+    """(rpm, tpm) for a model: RATE_LIMITS override, otherwise the family default."""
+    overrides = {}
+    raw = os.getenv('RATE_LIMITS')
+    if raw:
+        try:
+            overrides = json.loads(raw)
+        except ValueError:
+            print(f"⚠️ [rate_limiter] RATE_LIMITS is not valid JSON, ignoring it")
+    short_name = (model or '').rsplit('/', 1)[-1]
+    override = overrides.get(model) or overrides.get(short_name) or {}
+
+    if _model_family(model) == 'imagen':
+        rpm, tpm = _env_int('IMAGEN_RPM', 20), 0
+    else:
+        rpm, tpm = _env_int('LLM_RPM', 60), _env_int('LLM_TPM', 1_000_000)
+    return int(override.get('rpm', rpm)), int(override.get('tpm', tpm))
+
+
+class TokenBucket:
+    """
+    Reservation-style token bucket refilled continuously at ``per_minute / 60``
+    tokens per second, holding at most one minute of quota. Reservations may
+    push the level below zero; the returned delay is how long the caller has
+    to wait before its tokens are actually covered.
+    """
+
+    def __init__(self, per_minute: float):
+        self.per_minute = float(per_minute)
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float, factor: float) -> None:
+        capacity = self.per_minute * factor
+        rate = capacity / 60.0
+        self.level = min(capacity, self.level + (now - self.updated) * rate)
+        self.updated = now
+
+    def reserve(self, amount: float, now: float, factor: float) -> float:
+        self._refill(now, factor)
+        capacity = self.per_minute * factor
+        # Tek istek kovanın tamamından büyükse sonsuza kadar beklemesin
+        amount = min(amount, capacity)
+        self.level -= amount
+        if self.level >= 0:
+            return 0.0
+        return -self.level / (capacity / 60.0)
+
+    def drain(self, now: float, factor: float) -> None:
+        self._refill(now, factor)
+        self.level = min(self.level, 0.0)
+
+
+class ModelRateLimiter:
+    """RPM + TPM buckets for one model, with optional AIMD adaptation."""
+
+    def __init__(self, model: str, rpm: int, tpm: int = 0, *, adaptive: bool = True):
+        self.model = model
+        self.rpm = rpm
+        self.tpm = tpm
+        self.adaptive = adaptive
+        self.factor = 1.0
+        self._lock = threading.Lock()
+        self._requests = TokenBucket(rpm) if rpm > 0 else None
+        self._tokens = TokenBucket(tpm) if tpm > 0 else None
+        self._last_decrease = 0.0
+        self._stats = {
+            "acquired": 0,
+            "waited": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+            "waiting": 0,
+            "tokens_reserved": 0,
+            "successes": 0,
+            "throttled": 0,
+        }
+
+    def reserve(self, tokens: int = 0) -> float:
+        """Reserve one request (and ``tokens`` of TPM); return the seconds to wait."""
+        with self._lock:
+            now = time.monotonic()
+            delay = 0.0
+            if self._requests is not None:
+                delay = max(delay, self._requests.reserve(1, now, self.factor))
+            if self._tokens is not None and tokens > 0:
+                delay = max(delay, self._tokens.reserve(tokens, now, self.factor))
+            self._stats["acquired"] += 1
+            self._stats["tokens_reserved"] += max(0, int(tokens))
+            if delay > 0:
+                self._stats["waited"] += 1
+                self._stats["wait_seconds_total"] += delay
+                self._stats["wait_seconds_max"] = max(self._stats["wait_seconds_max"], delay)
+                self._stats["waiting"] += 1
+            return delay
+
+    def _done_waiting(self, delay: float) -> None:
+        if delay > 0:
+            with self._lock:
+                self._stats["waiting"] -= 1
+
+    def acquire(self, tokens: int = 0) -> float:
+        """Block until the reservation is covered. Returns the time waited."""
+        delay = self.reserve(tokens)
+        if delay > 0:
+            try:
+                time.sleep(delay)
+            finally:
+                self._done_waiting(delay)
+        return delay
+
+    async def acquire_async(self, tokens: int = 0) -> float:
+        """acquire() for coroutines; waits with asyncio.sleep so the event loop keeps running."""
+        delay = self.reserve(tokens)
+        if delay > 0:
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                self._done_waiting(delay)
+        return delay
+
+    def settle(self, reserved: int, actual: int) -> None:
+        """Charge TPM for tokens used beyond the estimate reserved before the call."""
+        extra = int(actual) - int(reserved)
+        if extra <= 0 or self._tokens is None:
+            return
+        with self._lock:
+            self._tokens.reserve(extra, time.monotonic(), self.factor)
+            self._stats["tokens_reserved"] += extra
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._stats["successes"] += 1
+            if self.adaptive and self.factor < 1.0:
+                self.factor = min(1.0, self.factor + _INCREASE_STEP)
+
+    def record_throttle(self) -> None:
+        """A 429 was returned: halve the rate (AIMD) and make queued callers wait for refill."""
+        with self._lock:
+            self._stats["throttled"] += 1
+            now = time.monotonic()
+            if not self.adaptive or now - self._last_decrease < _DECREASE_COOLDOWN_SECONDS:
+                return
+            self._last_decrease = now
+            self.factor = max(_MIN_FACTOR, self.factor * _DECREASE_FACTOR)
+            for bucket in (self._requests, self._tokens):
+                if bucket is not None:
+                    bucket.drain(now, self.factor)
+        print(f"🚦 [rate_limiter] {self.model} throttled, rate factor → {self.factor:.2f}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            acquired = self._stats["acquired"]
+            return {
+                **self._stats,
+                "wait_seconds_total": round(self._stats["wait_seconds_total"], 3),
+                "wait_seconds_max": round(self._stats["wait_seconds_max"], 3),
+                "wait_seconds_avg": round(self._stats["wait_seconds_total"] / acquired, 3) if acquired else 0.0,
+                "rpm_limit": self.rpm,
+                "tpm_limit": self.tpm,
+                "effective_rpm": round(self.rpm * self.factor, 2),
+                "effective_tpm": round(self.tpm * self.factor, 2),
+                "factor": round(self.factor, 3),
+            }
+
+
+_lock = threading.Lock()
+_limiters: Dict[str, ModelRateLimiter] = {}
+
+
+def _reset_state() -> None:
+    global _lock
+    _lock = threading.Lock()
+    _limiters.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_state)
+
+
+def get_rate_limiter(model: Optional[str] = None) -> ModelRateLimiter:
+    """Process-wide limiter for ``model`` (created on first use from the env configuration)."""
+    model = model or DEFAULT_LLM_MODEL
+    with _lock:
+        limiter = _limiters.get(model)
+        if limiter is None:
+            rpm, tpm = _configured_limits(model)
+            adaptive = os.getenv('RATE_LIMIT_ADAPTIVE', '1') != '0'
+            limiter = ModelRateLimiter(model, rpm, tpm, adaptive=adaptive)
+            _limiters[model] = limiter
+        return limiter
+
+
+def record_throttle(model: Optional[str] = None) -> None:
+    """
+    Report a 429. Without a model every LLM limiter is slowed down, for errors
+    raised by the agent runner where the failing model is not known.
+    """
+    if model:
+        get_rate_limiter(model).record_throttle()
+        return
+    with _lock:
+        limiters = [l for l in _limiters.values() if _model_family(l.model) == 'llm']
+    if not limiters:
+        limiters = [get_rate_limiter(DEFAULT_LLM_MODEL)]
+    for limiter in limiters:
+        limiter.record_throttle()
+
+
+def is_rate_limit_error(exc: BaseException) -> bool:
+    """429 / RESOURCE_EXHAUSTED from google-genai, google-api-core or a raw HTTP client."""
+    for attr in ("code", "status_code"):
+        try:
+            if int(getattr(exc, attr, 0) or 0) == 429:
+                return True
+        except (TypeError, ValueError):
+            pass
+    return 'RESOURCE_EXHAUSTED' in str(exc)
+
+
+def rate_limit_attempts() -> int:
+    """Attempts per model call when it keeps failing with 429 (RATE_LIMIT_MAX_ATTEMPTS)."""
+    return max(1, _env_int('RATE_LIMIT_MAX_ATTEMPTS', 4))
+
+
+def call_with_rate_limit(model: str, fn: Callable[..., Any], /, *args, tokens: int = 0, max_attempts: Optional[int] = None, **kwargs) -> Any:
+    """
+    Call ``fn(*args, **kwargs)`` under ``model``'s limiter. A 429 slows the
+    limiter down and the call is retried after waiting for the (now smaller)
+    bucket, up to RATE_LIMIT_MAX_ATTEMPTS attempts; other errors are raised
+    unchanged.
+    """
+    limiter = get_rate_limiter(model)
+    attempts = max_attempts or rate_limit_attempts()
+    for attempt in range(1, attempts + 1):
+        limiter.acquire(tokens)
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            if not is_rate_limit_error(e) or attempt == attempts:
+                raise
+            limiter.record_throttle()
+            print(f"⏳ [rate_limiter] {model} 429 (attempt {attempt}/{attempts}), retrying after limiter wait")
+            continue
+        limiter.record_success()
+        return result
+
+
+def rate_limiter_stats() -> Dict[str, Any]:
+    """Per-model counters: acquisitions, queue waits, throttles and the current effective rate."""
+    with _lock:
+        limiters = list(_limiters.values())
+    return {limiter.model: limiter.stats() for limiter in limiters}
+
+
+# ----- ADK model callbacks -----
+
+_reserved_tokens: contextvars.ContextVar = contextvars.ContextVar('rate_limit_reserved_tokens', default=None)
+
+
+def estimate_request_tokens(llm_request) -> int:
+    chars = 0
+    for content in getattr(llm_request, 'contents', None) or []:
+        for part in getattr(content, 'parts', None) or []:
+            text = getattr(part, 'text', None)
+            if text:
+                chars += len(text)
+            elif getattr(part, 'function_call', None) or getattr(part, 'function_response', None):
+                call = part.function_call or part.function_response
+                chars += len(str(getattr(call, 'args', None) or getattr(call, 'response', None) or ''))
+    config = getattr(llm_request, 'config', None)
+    instruction = getattr(config, 'system_instruction', None) if config is not None else None
+    if isinstance(instruction, str):
+        chars += len(instruction)
+    return math.ceil(chars / CHARS_PER_TOKEN)
+
+
+async def before_model_rate_limit(callback_context, llm_request):
+    """before_model_callback: wait for RPM/TPM capacity before every LLM request."""
+    model = getattr(llm_request, 'model', None) or DEFAULT_LLM_MODEL
+    tokens = estimate_request_tokens(llm_request)
+    waited = await get_rate_limiter(model).acquire_async(tokens)
+    _reserved_tokens.set((model, tokens))
+    if waited >= 1.0:
+        print(f"🚦 [rate_limiter] {model} waited {waited:.1f}s for quota (~{tokens} tokens)")
+    return None
+
+
+def after_model_rate_limit(callback_context, llm_response):
+    """after_model_callback: count the success and charge TPM with the real token usage."""
+    reserved = _reserved_tokens.get()
+    if reserved is None:
+        return None
+    model, tokens = reserved
+    limiter = get_rate_limiter(model)
+    usage = getattr(llm_response, 'usage_metadata', None)
+    total = getattr(usage, 'total_token_count', None) if usage is not None else None
+    if total:
+        limiter.settle(tokens, total)
+    if getattr(llm_response, 'error_code', None) in ('RESOURCE_EXHAUSTED', '429', 429):
+        limiter.record_throttle()
+    else:
+        limiter.record_success()
+    return None
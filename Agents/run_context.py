@@ -0,0 +1,106 @@
+"""
+Per-run context for AdGen Agents.
+
+A run used to be described by process-wide environment variables
+(AGENTS_CURRENT_RUN_ID, WEBHOOK_URL/WEBHOOK_SECRET and GOOGLE_CLOUD_PROJECT/
+GOOGLE_CLOUD_LOCATION popped for API-key mode), so two runs in one Cloud Run
+instance overwrote each other. The run id, GenAI backend, webhook target and
+deadline now live in a RunContext held by a ContextVar:
+
+    with run_scope(run_id="http-1234", backend="api_key", deadline_seconds=900):
+        ...  # tools, progress events and GenAI clients see this run
+
+asyncio tasks inherit the context automatically and ADK copies it into the
+threads that run sync tools. Work handed to a ThreadPoolExecutor must be
+submitted through submit_in_context() to keep it.
+
+Readers fall back to the environment when no run is active (local scripts).
+"""
+
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
+from typing import Any, Callable, Iterator, Optional
+
+
+BACKENDS = ("vertex", "api_key")
+
+
+@dataclass(frozen=True)
+class RunContext:
+    run_id: str
+    # "vertex" (project/location + ADC) or "api_key" (Google AI API)
+    backend: str = "vertex"
+    project: Optional[str] = None
+    location: Optional[str] = None
+    webhook_url: Optional[str] = None
+    webhook_secret: Optional[str] = None
+    # time.monotonic() value after which the run should stop starting new work
+    deadline: Optional[float] = None
+
+    def remaining_seconds(self) -> Optional[float]:
+        """Seconds left until the deadline (never negative), or None without a deadline."""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+
+_current: contextvars.ContextVar[Optional[RunContext]] = contextvars.ContextVar("adgen_run_context", default=None)
+
+
+def current_run() -> Optional[RunContext]:
+    return _current.get()
+
+
+def current_run_id() -> Optional[str]:
+    """Run id of the active run; AGENTS_CURRENT_RUN_ID outside a run (local scripts)."""
+    run = _current.get()
+    return run.run_id if run is not None else os.getenv("AGENTS_CURRENT_RUN_ID")
+
+
+def remaining_seconds(default: Optional[float] = None) -> Optional[float]:
+    """Time left in the active run; ``default`` when there is no run or no deadline."""
+    run = _current.get()
+    remaining = run.remaining_seconds() if run is not None else None
+    return default if remaining is None else remaining
+
+
+@contextmanager
+def run_scope(*, deadline_seconds: Optional[float] = None, **fields: Any) -> Iterator[RunContext]:
+    """
+    Activate a run for the enclosed block.
+
+    Fields not given are inherited from the enclosing run, so a nested scope can
+    switch only the backend of a round. ``deadline_seconds`` is converted to an
+    absolute deadline; an inherited deadline is never extended.
+    """
+    parent = _current.get()
+    if parent is None:
+        if not fields.get("run_id"):
+            raise ValueError("run_scope() needs a run_id when no run is active")
+        run = RunContext(**fields)
+    else:
+        run = replace(parent, **fields)
+    if run.backend not in BACKENDS:
+        raise ValueError(f"unknown backend {run.backend!r}, expected one of {BACKENDS}")
+    if deadline_seconds is not None:
+        deadline = time.monotonic() + float(deadline_seconds)
+        if run.deadline is not None:
+            deadline = min(deadline, run.deadline)
+        run = replace(run, deadline=deadline)
+
+    token = _current.set(run)
+    try:
+        yield run
+    finally:
+        _current.reset(token)
+
+
+def submit_in_context(pool, fn: Callable[..., Any], *args: Any, **kwargs: Any):
+    """``pool.submit`` that carries the current run into the worker thread."""
+    return pool.submit(contextvars.copy_context().run, fn, *args, **kwargs)
@@ -1,9 +1,182 @@
+"""
+Progress events for the WebApp dashboard (POST /api/agent-events).
+
+report_progress() only enqueues: a background worker drains a bounded
+in-memory queue, coalesces events that arrive close together into one
+``{"events": [...]}`` POST and reuses a keep-alive HTTP session, so tool
+latency does not depend on webhook health. When the queue is full the oldest
+event is dropped. Call flush_progress() at the end of a run to deliver what
+is still queued. The target comes from the active RunContext (run_context.py)
+and falls back to WEBHOOK_URL/WEBHOOK_SECRET.
+
+Configuration (environment):
+  WEBHOOK_MODE               "sync" restores one blocking POST per event
+  WEBHOOK_QUEUE_SIZE         queued events before drop-oldest (default 1000)
+  WEBHOOK_BATCH_SIZE         events per POST (default 50)
+  WEBHOOK_BATCH_INTERVAL_MS  how long the worker waits to coalesce events (default 250)
+"""
+
+import atexit
 import os
+import threading
 import time
-from typing import Any, Dict, Optional
+from collections import deque
+from typing import Any, Dict, List, Optional, Tuple
 
 import requests
 
+from run_context import current_run
+
+
+def _webhook_target() -> Tuple[str, str]:
+    # The active run's target (POST /run webhook_url/webhook_secret) wins over the env defaults
+    run = current_run()
+    webhook_url = (run.webhook_url if run else None) or os.getenv("WEBHOOK_URL")
+    webhook_secret = (run.webhook_secret if run else None) or os.getenv("WEBHOOK_SECRET")
+
+    # Default to AdGen-WebApp if not configured
+    if not webhook_url:
+        # Try to determine the webapp URL dynamically
+        webapp_base = os.getenv("WEBAPP_URL", "https://adgen-webapp-710876076445.us-central1.run.app")
+        webhook_url = f"{webapp_base}/api/agent-events"
+
+    if not webhook_secret:
+        webhook_secret = os.getenv("WEBHOOK_SECRET", "your-webhook-secret-here")
+        print(f"⚠️ Using default webhook secret. Set WEBHOOK_SECRET env var for security.")
+    return webhook_url, webhook_secret
+
+
+def _headers(webhook_secret: str) -> Dict[str, str]:
+    return {
+        "Content-Type": "application/json",
+        "x-webhook-secret": webhook_secret,
+        "User-Agent": "AdGen-Agents/1.0"
+    }
+
+
+class ProgressReporter:
+    """Background sender: bounded queue (drop-oldest), batched POSTs, one keep-alive session."""
+
+    def __init__(self, max_queue: int, batch_size: int, batch_interval: float, timeout: float = 5.0):
+        self.batch_size = max(1, batch_size)
+        self.batch_interval = batch_interval
+        self.timeout = timeout
+        # (url, secret, payload); deque(maxlen) drops the oldest item when full
+        self._queue: deque = deque(maxlen=max(1, max_queue))
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._session: Optional[requests.Session] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stats = {"queued": 0, "sent": 0, "batches": 0, "dropped": 0, "failed": 0}
+
+    def submit(self, url: str, secret: str, payload: Dict[str, Any]) -> None:
+        with self._cond:
+            if len(self._queue) == self._queue.maxlen:
+                self._stats["dropped"] += 1
+            self._queue.append((url, secret, payload))
+            self._stats["queued"] += 1
+            self._ensure_worker()
+            self._cond.notify()
+
+    def _ensure_worker(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="progress-reporter", daemon=True)
+            self._thread.start()
+
+    def _next_batch(self) -> List[Tuple[str, str, Dict[str, Any]]]:
+        with self._cond:
+            while not self._queue:
+                self._cond.wait()
+            # İlk event geldikten sonra kısa süre bekle: yakın zamanlı event'ler tek POST'ta gider
+            deadline = time.monotonic() + self.batch_interval
+            while len(self._queue) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            # Aynı hedefe (url, secret) giden ardışık event'ler aynı batch'e girer
+            url, secret, _ = self._queue[0]
+            batch = []
+            while self._queue and len(batch) < self.batch_size and self._queue[0][:2] == (url, secret):
+                batch.append(self._queue.popleft())
+            self._in_flight += 1
+            return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            try:
+                self._send(batch)
+            finally:
+                with self._cond:
+                    self._in_flight -= 1
+                    self._cond.notify_all()
+
+    def _send(self, batch: List[Tuple[str, str, Dict[str, Any]]]) -> None:
+        url, secret, _ = batch[0]
+        events = [payload for _, _, payload in batch]
+        if self._session is None:
+            self._session = requests.Session()
+        ok = False
+        try:
+            response = self._session.post(url, json={"events": events}, headers=_headers(secret), timeout=self.timeout)
+            ok = response.status_code == 200
+            if ok:
+                print(f"✅ WEBHOOK BATCH SUCCESS: {len(events)} events ({events[-1]['runId']} {events[-1]['agent']} {events[-1]['status']})")
+            else:
+                print(f"⚠️ WEBHOOK BATCH ERROR {response.status_code}: {len(events)} events")
+        except Exception as e:
+            print(f"❌ WEBHOOK BATCH ERROR ({len(events)} events): {e}")
+        with self._cond:
+            if ok:
+                self._stats["sent"] += len(events)
+                self._stats["batches"] += 1
+            else:
+                self._stats["failed"] += len(events)
+
+    def flush(self, timeout: float = 10.0) -> bool:
+        """Wait until every queued event has been sent (or timeout). Returns True when drained."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._cond.notify_all()
+            while self._queue or self._in_flight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {**self._stats, "pending": len(self._queue) + self._in_flight}
+
+
+_reporter: Optional[ProgressReporter] = None
+_reporter_lock = threading.Lock()
+
+
+def _get_reporter() -> ProgressReporter:
+    global _reporter
+    with _reporter_lock:
+        if _reporter is None:
+            _reporter = ProgressReporter(
+                max_queue=int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000")),
+                batch_size=int(os.getenv("WEBHOOK_BATCH_SIZE", "50")),
+                batch_interval=int(os.getenv("WEBHOOK_BATCH_INTERVAL_MS", "250")) / 1000.0,
+            )
+        return _reporter
+
+
+def _reset_after_fork() -> None:
+    # Worker thread and HTTP session do not survive fork
+    global _reporter, _reporter_lock
+    _reporter = None
+    _reporter_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
 
 def report_progress(
     *,
@@ -16,23 +189,11 @@ def report_progress(
     timeout: float = 5.0,
 ) -> bool:
     """
-    Send a progress event to the WebApp webhook. 
-    Non-blocking best-effort; failures are swallowed.
+    Send a progress event to the WebApp webhook.
+    Non-blocking best-effort: the event is queued for the background reporter
+    (WEBHOOK_MODE=sync posts it immediately); failures are swallowed.
     """
-    # Read env vars dynamically so they can be updated at runtime
-    webhook_url = os.getenv("WEBHOOK_URL")
-    webhook_secret = os.getenv("WEBHOOK_SECRET")
-    
-    # Default to AdGen-WebApp if not configured
-    if not webhook_url:
-        # Try to determine the webapp URL dynamically
-        webapp_base = os.getenv("WEBAPP_URL", "https://adgen-webapp-710876076445.us-central1.run.app")
-        webhook_url = f"{webapp_base}/api/agent-events"
-    
-    if not webhook_secret:
-        webhook_secret = os.getenv("WEBHOOK_SECRET", "your-webhook-secret-here")
-        print(f"⚠️ Using default webhook secret. Set WEBHOOK_SECRET env var for security.")
-    
+    webhook_url, webhook_secret = _webhook_target()
     payload = {
         "runId": run_id,
         "agent": agent,
@@ -42,22 +203,21 @@ def report_progress(
         "meta": meta or None,
         "timestamp": int(time.time() * 1000),
     }
-    headers = {
-        "Content-Type": "application/json",
-        "x-webhook-secret": webhook_secret,
-        "User-Agent": "AdGen-Agents/1.0"
-    }
-    
+
+    if os.getenv("WEBHOOK_MODE", "async").strip().lower() != "sync":
+        _get_reporter().submit(webhook_url, webhook_secret, payload)
+        return True
+
     try:
-        response = requests.post(webhook_url, json=payload, headers=headers, timeout=timeout)
-        
+        response = requests.post(webhook_url, json=payload, headers=_headers(webhook_secret), timeout=timeout)
+
         if response.status_code == 200:
             print(f"✅ WEBHOOK SUCCESS: {run_id} {agent} {status} {message}")
             return True
         else:
             print(f"⚠️ WEBHOOK ERROR {response.status_code}: {run_id} {agent} {status}")
             return False
-            
+
     except requests.exceptions.Timeout:
         print(f"⏰ WEBHOOK TIMEOUT: {run_id} {agent} {status}")
         return False
@@ -69,3 +229,17 @@ def report_progress(
         return False
 
 
+def flush_progress(timeout: float = 10.0) -> bool:
+    """Deliver queued progress events before returning (call at the end of a run)."""
+    with _reporter_lock:
+        reporter = _reporter
+    return reporter.flush(timeout) if reporter is not None else True
+
+
+def progress_reporter_stats() -> Dict[str, Any]:
+    with _reporter_lock:
+        reporter = _reporter
+    return reporter.stats() if reporter is not None else {"queued": 0, "sent": 0, "batches": 0, "dropped": 0, "failed": 0, "pending": 0}
+
+
+atexit.register(flush_progress, 5.0)
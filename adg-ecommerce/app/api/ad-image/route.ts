@@ -82,12 +82,30 @@ function normalizeGcsUrl(url: string | undefined | null): string | null {
   return trimmed;
 }
 
+// Responsive variants written by the agents next to imageUrl: { webp: { "320": url, ... }, jpeg: { ... } }
+type Renditions = Record<string, Record<string, string>>;
+
+function normalizeRenditions(raw: unknown): Renditions | undefined {
+  if (!raw || typeof raw !== "object") return undefined;
+  const out: Renditions = {};
+  for (const [format, byWidth] of Object.entries(raw as Record<string, unknown>)) {
+    if (!byWidth || typeof byWidth !== "object") continue;
+    const urls: Record<string, string> = {};
+    for (const [width, url] of Object.entries(byWidth as Record<string, unknown>)) {
+      const normalized = normalizeGcsUrl(typeof url === "string" ? url : null);
+      if (normalized) urls[width] = normalized;
+    }
+    if (Object.keys(urls).length > 0) out[format] = urls;
+  }
+  return Object.keys(out).length > 0 ? out : undefined;
+}
+
 async function findImageFromSegmentationsDoc(
   firestore: Firestore,
   segmentation: string,
   city: string,
   country: string
-): Promise<string | null> {
+): Promise<{ imageUrl: string; renditions?: Renditions } | null> {
   if (!segmentation || !city) return null;
   const docId = `${normalize(segmentation)}_${normalize(city)}_${normalize(country)}`;
   let segData: FirebaseFirestore.DocumentSnapshot<FirebaseFirestore.DocumentData> = await firestore
@@ -105,7 +123,8 @@ async function findImageFromSegmentationsDoc(
     if (!q.empty) segData = q.docs[0];
   }
   const imageUrl = segData.exists ? (segData.get("imageUrl") as string | undefined) : undefined;
-  return imageUrl ? imageUrl : null;
+  if (!imageUrl) return null;
+  return { imageUrl, renditions: normalizeRenditions(segData.get("renditions")) };
 }
 
 async function pickRandomGcsImageForLocation(
@@ -239,9 +258,9 @@ export async function POST(request: Request) {
     if (segmentation && city) {
       const fsImage = await findImageFromSegmentationsDoc(firestore, segmentation, city, country);
       if (fsImage) {
-        const normalizedUrl = normalizeGcsUrl(fsImage);
+        const normalizedUrl = normalizeGcsUrl(fsImage.imageUrl);
         if (normalizedUrl) {
-          return NextResponse.json({ ok: true, imageUrl: normalizedUrl, strategy: "firestore_segmentation" });
+          return NextResponse.json({ ok: true, imageUrl: normalizedUrl, renditions: fsImage.renditions, strategy: "firestore_segmentation" });
         }
       }
     }
@@ -3,9 +3,21 @@ import React, { useEffect, useState } from "react";
 import { useAuth } from "@/components/AuthContext";
 import { fetchCityCountry } from "@/lib/geo";
 
+// { webp: { "320": url, "640": url, ... }, jpeg: { ... } } as returned by /api/ad-image
+type Renditions = Record<string, Record<string, string>>;
+
+function srcSetFor(byWidth?: Record<string, string>): string | undefined {
+  if (!byWidth) return undefined;
+  const entries = Object.entries(byWidth)
+    .filter(([width, url]) => Number(width) > 0 && url)
+    .sort((a, b) => Number(a[0]) - Number(b[0]));
+  return entries.length > 0 ? entries.map(([width, url]) => `${url} ${width}w`).join(", ") : undefined;
+}
+
 export default function AdBox({ imageUrl: propUrl, href }: { imageUrl?: string; href?: string }) {
   const { user } = useAuth();
   const [imageUrl, setImageUrl] = useState<string | undefined>(propUrl);
+  const [renditions, setRenditions] = useState<Renditions | undefined>(undefined);
   const [loading, setLoading] = useState(false);
 
   useEffect(() => {
@@ -35,7 +47,10 @@ export default function AdBox({ imageUrl: propUrl, href }: { imageUrl?: string;
         });
         if (res.ok) {
           const j = await res.json();
-          if (!cancelled) setImageUrl(j?.imageUrl as string | undefined);
+          if (!cancelled) {
+            setImageUrl(j?.imageUrl as string | undefined);
+            setRenditions(j?.renditions as Renditions | undefined);
+          }
         }
       } catch {
         // ignore
@@ -47,8 +62,15 @@ export default function AdBox({ imageUrl: propUrl, href }: { imageUrl?: string;
     return () => { cancelled = true; };
   }, [propUrl, user?.id]);
 
+  // Browser picks the smallest rendition that fits; WebP first, JPEG fallback, original as last resort
+  const webpSrcSet = srcSetFor(renditions?.webp);
+  const jpegSrcSet = srcSetFor(renditions?.jpeg);
+  const sizes = "(max-width: 1024px) 100vw, 1024px";
   const content = imageUrl ? (
-    <img src={imageUrl} alt="" />
+    <picture>
+      {webpSrcSet ? <source type="image/webp" srcSet={webpSrcSet} sizes={sizes} /> : null}
+      <img src={imageUrl} srcSet={jpegSrcSet} sizes={jpegSrcSet ? sizes : undefined} alt="" />
+    </picture>
   ) : loading ? (
     <div className="ad-fallback">Loading…</div>
   ) : (
@@ -25,6 +25,16 @@ def _build_run_url(base_url: str) -> str:
     return f"{base}/run"
 
 
+def _build_jobs_url(base_url: str) -> str:
+    """Normalize target URL to the /jobs endpoint (a trailing /run is replaced)."""
+    base = (base_url or "").rstrip("/")
+    if not base:
+        raise ValueError("AGENTS_SERVICE_URL is not set")
+    if base.endswith("/run"):
+        base = base[: -len("/run")]
+    return f"{base}/jobs"
+
+
 @functions_framework.http
 def cronjob(request):
     """
@@ -36,6 +46,8 @@ def cronjob(request):
       - AGENTS_PROMPT: Prompt sent to the /run endpoint (default segmentation task)
       - AGENTS_MAX_ROUNDS: Max rounds to request (default 8)
       - REQUEST_TIMEOUT_SECONDS: HTTP timeout in seconds (default 60)
+      - AGENTS_USE_JOBS: "true" (default) queues one POST /jobs and returns its job id;
+        "false" calls /run and resolves follow-ups here, holding the connection
     """
     
     # Health check endpoint
@@ -94,6 +106,30 @@ async def cronjob_async(request):
             
         logger.info(f"📝 Initial prompt: '{prompt}' (max_rounds: {max_rounds})")
 
+        # Job mode: the Agents service runs the whole chain (continue/segmentation/creative)
+        # in the background, so the cron only needs the 202 and a job id to poll
+        if os.getenv("AGENTS_USE_JOBS", "true").strip().lower() in ("1", "true", "yes"):
+            jobs_url = _build_jobs_url(agents_service_url)
+            timeout = float(os.getenv("REQUEST_TIMEOUT_SECONDS", "60"))
+            logger.info(f"🗂️ Queuing job at {jobs_url}")
+            async with httpx.AsyncClient(timeout=timeout) as client:
+                resp = await client.post(jobs_url, headers=headers, json=payload)
+            try:
+                body = resp.json()
+            except Exception:
+                body = {"raw_body": resp.text}
+            result = {
+                "ok": resp.status_code == 202,
+                "status_code": resp.status_code,
+                "run_id": run_id,
+                "target": jobs_url,
+                "job_id": body.get("job_id") if isinstance(body, dict) else None,
+                "status_url": resp.headers.get("Location"),
+                "response": body,
+            }
+            logger.info(f"🎉 Job queued: OK={result['ok']}, job_id={result['job_id']}")
+            return (json.dumps(result), resp.status_code, {"Content-Type": "application/json"})
+
         # Helper: call Agents /run with given prompt, using same headers/run_id and webhook config
         async def call_agent(run_prompt: str):
             logger.info(f"🚀 Starting API call to {run_url} with prompt: '{run_prompt[:50]}...'")